@@ -0,0 +1,181 @@
+"""Load the running services with whole orders, the way the CPEE process drives them.
+
+    python -m benchmarks.bench_pipeline [--orders 50] [--concurrency 4] [--update-baselines]
+
+Every order goes /createOrder -> /manageOrders -> /svg2gcode and
+/text2gcode -> /executeGcode for the logo and the text, with a stub CPEE
+answering the callbacks. Start the five services first, with a fake GRBL
+(python -m benchmarks.fake_grbl) as the plotter in config.json, or pass
+--skip-drawing to stop after the conversions.
+"""
+import argparse
+import itertools
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks import corpus, report
+from benchmarks.stub_cpee import StubCpee
+
+STAGES = ("create_order", "manage_orders", "svg2gcode", "text2gcode", "execute_gcode", "drawing", "order")
+
+
+class StageError(Exception):
+    pass
+
+
+class Pipeline:
+
+    def __init__(self, arguments, stub):
+        self.arguments = arguments
+        self.stub = stub
+        self.local = threading.local()
+        self.names = itertools.count()
+        self.lock = threading.Lock()
+        self.durations = {stage: [] for stage in STAGES}
+        self.machine_estimates = []
+        self.errors = {}
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _record(self, stage, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+
+    def _timed(self, stage, method, url, record=True, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self._session().request(method, url, timeout=self.arguments.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise StageError(f"{stage}: {e}") from None
+        if record:
+            self._record(stage, time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise StageError(f"{stage}: HTTP {response.status_code} {response.text[:200]}")
+        return response
+
+    def _callback(self, stage):
+        """A fresh callback URL of the stub and a function waiting for its PUT."""
+        name = f"{stage}-{next(self.names)}"
+        return self.stub.callback_url(name), lambda: self.stub.wait(name, self.arguments.timeout)
+
+    def run_order(self, svg_code, text):
+        arguments = self.arguments
+        start = time.perf_counter()
+        response = self._timed("create_order", "POST", f"{arguments.order_creation}/createOrder",
+                               json={"svg": svg_code, "text": text})
+
+        # Like a CPEE instance: take an order, or wait for one on the callback
+        callback_url, wait_for_order = self._callback("order")
+        fetch_start = time.perf_counter()
+        response = self._timed("manage_orders", "GET", f"{arguments.order_management}/manageOrders", record=False,
+                               params={"wait": arguments.fetch_wait}, headers={"Cpee-Callback": callback_url})
+        if response.status_code == 200 and response.content:
+            order = response.json()
+        else:
+            delivered = wait_for_order()
+            if delivered is None:
+                raise StageError("manage_orders: no order delivered to the callback")
+            order = delivered[0]
+        self._record("manage_orders", time.perf_counter() - fetch_start)
+        trace = {"trace_id": order["trace_id"]} if order.get("trace_id") else {}
+
+        svg_gcode = self._timed("svg2gcode", "POST", f"{arguments.svg}/svg2gcode",
+                                data=dict(trace, logo=order["svg"])).json()["gcode"]
+        text_gcode = self._timed("text2gcode", "POST", f"{arguments.text}/text2gcode",
+                                 data=dict(trace, text=order["text"])).json()["gcode"]
+
+        if not arguments.skip_drawing:
+            for gcode in (svg_gcode, text_gcode):
+                callback_url, wait_for_drawing = self._callback("drawing")
+                response = self._timed("execute_gcode", "POST", f"{arguments.grbl}/executeGcode",
+                                       json=dict(trace, gcode=gcode), headers={"Cpee-Callback": callback_url})
+                accepted = time.perf_counter()
+                if wait_for_drawing() is None:
+                    raise StageError("drawing: no callback from grbl-service")
+                self._record("drawing", time.perf_counter() - accepted)
+                job = self._session().get(f"{arguments.grbl}/jobs/{response.headers['X-Job-Id']}",
+                                          timeout=arguments.timeout).json()
+                if job.get("estimated_seconds") is not None:
+                    with self.lock:
+                        self.machine_estimates.append(job["estimated_seconds"])
+
+        self._record("order", time.perf_counter() - start)
+
+    def run(self, orders):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.arguments.concurrency) as executor:
+            futures = [executor.submit(self.run_order, svg_code, text) for svg_code, text in orders]
+            for future in futures:
+                try:
+                    future.result()
+                except StageError as e:
+                    stage = str(e).split(":")[0]
+                    self.errors[stage] = self.errors.get(stage, 0) + 1
+                    print(f"Order failed in {e}", file=sys.stderr)
+                except (ValueError, KeyError) as e:
+                    # A service answered with something other than what the CPEE process expects
+                    self.errors["response"] = self.errors.get("response", 0) + 1
+                    print(f"Order failed on an unexpected response: {e!r}", file=sys.stderr)
+        wall = time.perf_counter() - start
+
+        results = {stage: report.summarize(samples) for stage, samples in self.durations.items() if samples}
+        completed = len(self.durations["order"])
+        results["throughput"] = {"orders": completed, "throughput_orders_per_second": round(completed / wall, 3)}
+        if self.machine_estimates:
+            # What the plotter would spend on the orders, the fake GRBL only spends a fraction of it
+            results["machine_time"] = {
+                "jobs": len(self.machine_estimates),
+                "estimate_seconds_p50": round(report.summarize(self.machine_estimates)["p50"], 3),
+                "estimate_seconds_total": round(sum(self.machine_estimates), 3)
+            }
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4, help="orders in flight at once")
+    parser.add_argument("--order-management", default="http://127.0.0.1:5000")
+    parser.add_argument("--order-creation", default="http://127.0.0.1:5001")
+    parser.add_argument("--text", default="http://127.0.0.1:5002")
+    parser.add_argument("--svg", default="http://127.0.0.1:5003")
+    parser.add_argument("--grbl", default="http://127.0.0.1:5004")
+    parser.add_argument("--fetch-wait", type=float, default=1,
+                        help="seconds /manageOrders long-polls before the callback is used")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--skip-drawing", action="store_true", help="stop after the conversions")
+    report.add_arguments(parser)
+    arguments = parser.parse_args()
+
+    logos = corpus.gallery_svgs()
+    texts = corpus.texts()
+    orders = [(logos[i % len(logos)][1], texts[i % len(texts)]) for i in range(arguments.orders)]
+
+    calibration = report.calibrate()
+    stub = StubCpee().start()
+    try:
+        runs = [Pipeline(arguments, stub) for _ in range(arguments.runs)]
+        results = [pipeline.run(orders) for pipeline in runs]
+    finally:
+        stub.stop()
+
+    errors = {}
+    for pipeline in runs:
+        for stage, count in pipeline.errors.items():
+            errors[stage] = errors.get(stage, 0) + count
+    if errors:
+        report.print_report("pipeline", report.median_of_runs(results))
+        sys.exit(f"\n{sum(errors.values())} orders failed ({errors}), no comparison with the baselines")
+    report.finish("pipeline", report.median_of_runs(results), arguments, calibration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Time every stage of an order in this process, without the HTTP services running.
+
+    python -m benchmarks.bench_stages [--repeat 5] [--update-baselines]
+
+Runs the gallery logos and the text corpus through preflattening,
+svg2gcode (where it is built), text rendering, the optimizer, the
+simulator, the binary encoding and the streamer, which talks to a
+simulated GRBL on a pty.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from benchmarks import corpus, report
+from benchmarks.fake_grbl import FakeGrbl
+
+REPO_DIR = corpus.REPO_DIR
+sys.path.append(REPO_DIR)
+from common.gcode_binary import BinaryProgram, encode
+from common.gcode_optimizer import optimize_gcode
+from common.gcode_simulator import simulate
+
+
+def load_service(directory):
+    """Import a service's app.py under a name of its own, with its directory importable like when it runs."""
+    service_dir = os.path.join(REPO_DIR, directory)
+    if service_dir not in sys.path:
+        sys.path.insert(0, service_dir)
+    spec = importlib.util.spec_from_file_location(directory.replace("-", "_"), os.path.join(service_dir, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def timed_runs(samples, repeat, function, *args):
+    """Run `function` once to warm up and `repeat` times timed into `samples`, returns its result."""
+    result = function(*args)
+    for _ in range(repeat):
+        result, seconds = timed(function, *args)
+        samples.append(seconds)
+    return result
+
+
+def svg_origin(svg_app, root):
+    """Where svg-gcode-service puts a logo on the coaster and its size in mm, as in generate_svg_gcode."""
+    config = svg_app.config
+    width, height = svg_app.final_size(root)
+    coaster_width = config['upper_right_corner_x'] - config['lower_left_corner_x']
+    coaster_height = config['upper_right_corner_y'] - config['lower_left_corner_y']
+    origin_x = config['lower_left_corner_x'] + (coaster_width - width) / 2
+    origin_y = config['lower_left_corner_y'] + coaster_height / 4 + (coaster_height * 3 / 4 - height) / 2
+    return (origin_x, origin_y), (width, height)
+
+
+def bench_conversions(svg_app, text_app, repeat):
+    results = {}
+    durations = {"svg_preflatten": [], "svg2gcode": [], "text2gcode": []}
+    svg_programs = []
+    text_programs = []
+    svg2gcode_built = os.path.exists(svg_app.SVG2GCODE_EXECUTABLE)
+    config = svg_app.config
+
+    for name, svg_code in corpus.gallery_svgs():
+        root = ET.fromstring(svg_code)
+        flattened, _ = timed_runs(durations["svg_preflatten"], repeat, svg_app.preflatten, svg_code, root)
+        if svg2gcode_built:
+            program = timed_runs(durations["svg2gcode"], repeat, svg_app.generate_svg_gcode, svg_code)
+        else:
+            origin, size = svg_origin(svg_app, root)
+            program = corpus.polyline_gcode(flattened, origin, size, config['feedrate'],
+                                            config['z_drawing_height'], config['z_safe_height'])
+        svg_programs.append(program)
+
+    for text in corpus.texts():
+        text_programs.append(timed_runs(durations["text2gcode"], repeat, text_app.generate_text_gcode, text))
+
+    for stage, samples in durations.items():
+        if samples:
+            results[stage] = report.summarize(samples)
+    # The logo and the text of an order are drawn as two jobs, like the CPEE process sends them
+    return results, svg_programs + text_programs
+
+
+def bench_programs(jobs, config, repeat):
+    results = {}
+    optimized_jobs = []
+    durations = {"optimizer": [], "simulate": [], "binary_encode": [], "binary_iter": []}
+    estimate_before = estimate_after = 0.0
+    for job in jobs:
+        optimized, _ = timed_runs(durations["optimizer"], repeat, optimize_gcode,
+                                  job, config['z_drawing_height'], config['z_safe_height'])
+        estimate_before += timed_runs(durations["simulate"], repeat, simulate, job)["estimated_seconds"]
+        estimate_after += simulate(optimized)["estimated_seconds"]
+        encoded = timed_runs(durations["binary_encode"], repeat, encode, optimized)
+        timed_runs(durations["binary_iter"], repeat, lambda: sum(1 for _ in BinaryProgram(encoded).iter_bytes()))
+        optimized_jobs.append(optimized)
+
+    for stage, samples in durations.items():
+        results[stage] = report.summarize(samples)
+    # Simulated drawing time of the whole corpus, what the plotter would spend on it
+    results["machine_time"] = {
+        "estimate_seconds": round(estimate_before, 3),
+        "optimized_estimate_seconds": round(estimate_after, 3),
+        "jobs": len(jobs)
+    }
+    return results, optimized_jobs
+
+
+def bench_streaming(jobs, time_scale, parse_seconds):
+    from grbl_streamer import GrblStreamer
+
+    grbl = FakeGrbl(time_scale=time_scale, parse_seconds=parse_seconds)
+    streamer = GrblStreamer(grbl.start(), wakeup_delay=0.1)
+    durations = []
+    lines = 0
+    try:
+        for job in jobs:
+            # Streamed from the binary format like grbl-service streams its spool files
+            program = BinaryProgram(encode(job, optimized=True))
+            result, seconds = timed(streamer.stream, program.iter_bytes())
+            durations.append(seconds)
+            lines += result["lines"]
+    finally:
+        streamer.close()
+        grbl.stop()
+
+    if grbl.stats["rx_overflows"]:
+        # Not a slowdown but a broken protocol, GRBL would have lost commands
+        sys.exit(f"The streamer overflowed GRBL's receive buffer {grbl.stats['rx_overflows']} times")
+    # Per job times are mostly waits on the pty and the idle polling, the line rate is what is compared
+    return {"grbl_stream": {
+        "count": len(durations),
+        "lines_per_second": round(lines / sum(durations), 1),
+        "job_seconds_p50": round(report.summarize(durations)["p50"], 4),
+        "max_rx_bytes": grbl.stats["max_rx_bytes"],
+        "max_planner_blocks": grbl.stats["max_planner_blocks"]
+    }}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every corpus entry per stage")
+    parser.add_argument("--grbl-time-scale", type=float, default=0.0,
+                        help="fraction of the drawing time the fake GRBL spends on moves, 0 measures the streaming alone")
+    parser.add_argument("--grbl-parse-seconds", type=float, default=0.0)
+    report.add_arguments(parser)
+    arguments = parser.parse_args()
+
+    svg_app = load_service("svg-gcode-service")
+    if not os.path.exists(svg_app.SVG2GCODE_EXECUTABLE):
+        print("svg2gcode is not built, logos are drawn from their preflattened polylines instead")
+    text_app = load_service("text-gcode-service")
+    # The corpus holds texts too long for the coaster on purpose, a warning for every run would bury the results
+    text_app.app.logger.setLevel(logging.ERROR)
+    # Only the streamer, the service itself would open the serial ports of config.json
+    sys.path.insert(0, os.path.join(REPO_DIR, "grbl-service"))
+
+    runs = []
+    calibrations = []
+    for _ in range(arguments.runs):
+        calibrations.append(report.calibrate())
+        results, jobs = bench_conversions(svg_app, text_app, arguments.repeat)
+        program_results, optimized_jobs = bench_programs(jobs, svg_app.config, arguments.repeat)
+        results.update(program_results)
+        results.update(bench_streaming(optimized_jobs, arguments.grbl_time_scale, arguments.grbl_parse_seconds))
+        runs.append(results)
+    report.finish("stages", report.median_of_runs(runs), arguments, min(calibrations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import glob
+import os
+import random
+import re
+import string
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+GALLERY_DIR = os.path.join(REPO_DIR, "frontend", "public", "gallery")
+
+# The interface takes up to 10 characters, longer texts show how the font size search scales
+TEXT_LENGTHS = (1, 3, 5, 8, 10, 16, 24)
+TEXTS_PER_LENGTH = 3
+
+POINT_PATTERN = re.compile(r"([ML])(-?[\d.]+),(-?[\d.]+)")
+
+
+def gallery_svgs():
+    """The logos of the frontend's gallery as (name, SVG code), sorted by name."""
+    logos = []
+    for path in sorted(glob.glob(os.path.join(GALLERY_DIR, "*.svg"))):
+        with open(path, "r", encoding="utf-8") as svg_file:
+            logos.append((os.path.splitext(os.path.basename(path))[0], svg_file.read()))
+    return logos
+
+
+def texts(seed=20):
+    """Texts of several lengths, the same ones on every run."""
+    generator = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + " "
+    corpus = []
+    for length in TEXT_LENGTHS:
+        for _ in range(TEXTS_PER_LENGTH):
+            text = "".join(generator.choice(alphabet) for _ in range(length)).strip() or "X"
+            corpus.append(text)
+    return corpus
+
+
+def polyline_gcode(flattened_svg, origin, size, feedrate, z_drawing_height, z_safe_height):
+    """G-code drawing the polylines of a preflattened SVG at `origin` with `size` in mm, like svg2gcode would.
+
+    Stands in for svg2gcode where it is not built, so that the later stages
+    always get programs of realistic length and shape from the gallery.
+    """
+    import xml.etree.ElementTree as ET
+
+    root = ET.fromstring(flattened_svg)
+    box = [float(value) for value in root.attrib["viewBox"].replace(",", " ").split()]
+    scale_x = size[0] / box[2]
+    scale_y = size[1] / box[3]
+    lines = ["G21", "G90"]
+    for path in root.iter("{http://www.w3.org/2000/svg}path"):
+        for command, x, y in POINT_PATTERN.findall(path.attrib.get("d", "")):
+            # SVG y points down, the plotter's up
+            x_mm = origin[0] + (float(x) - box[0]) * scale_x
+            y_mm = origin[1] + (box[1] + box[3] - float(y)) * scale_y
+            if command == "M":
+                lines.append(f"G0 Z{z_safe_height}")
+                lines.append(f"G0 X{x_mm:.3f} Y{y_mm:.3f}")
+                lines.append(f"G1 Z{z_drawing_height} F{feedrate}")
+            else:
+                lines.append(f"G1 X{x_mm:.3f} Y{y_mm:.3f} F{feedrate}")
+    lines.append(f"G0 Z{z_safe_height}")
+    lines.append("G0 Z-30")
+    lines.append("M2")
+    return "\n".join(lines)
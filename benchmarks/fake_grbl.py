@@ -0,0 +1,199 @@
+import argparse
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+
+# GRBL 1.1 defaults: 127 byte serial receive buffer, 15 block planner
+RX_BUFFER_SIZE = 127
+PLANNER_BLOCKS = 15
+
+WORD_PATTERN = re.compile(rb"([A-Z])(-?[\d.]+)")
+
+
+class FakeGrbl:
+    """A simulated GRBL controller on the master side of a pty.
+
+    GrblStreamer opens the slave side like a serial port. Bytes go into a
+    127 byte receive buffer; a line leaves it when the parser moves it into
+    the 15 block planner and answers `ok`, which waits while the planner is
+    full, like on the real controller. Planned moves are executed one after
+    another for their length at the feedrate (rapids at `rapid_rate`),
+    scaled by `time_scale` so that a benchmark does not take as long as a
+    real drawing. `?` is answered with a status report at once, including
+    the `Bf:` buffer field. Overflowing the receive buffer is counted in
+    `stats` instead of being answered, a correct streamer never does it.
+    """
+
+    def __init__(self, time_scale=0.01, parse_seconds=0.0002, rapid_rate=3000):
+        self.time_scale = time_scale
+        self.parse_seconds = parse_seconds
+        self.rapid_rate = rapid_rate
+        self.condition = threading.Condition()
+        self.rx = bytearray()
+        self.planner = deque()
+        self.executing = False
+        self.position = [0.0, 0.0, 0.0]
+        self.absolute = True
+        self.motion = 0
+        self.feed = 1000.0
+        self.master = None
+        self.slave = None
+        self.running = False
+        self.stats = {"lines": 0, "max_rx_bytes": 0, "rx_overflows": 0, "max_planner_blocks": 0, "machine_seconds": 0.0}
+
+    def start(self):
+        """Open the pty and start the controller, returns the port to give GrblStreamer."""
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.running = True
+        for target, name in ((self._receive, "rx"), (self._parse, "parser"), (self._execute, "stepper")):
+            threading.Thread(target=target, name=f"fake-grbl-{name}", daemon=True).start()
+        return os.ttyname(self.slave)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def _status(self):
+        with self.condition:
+            state = "Run" if self.planner or self.executing else "Idle"
+            x, y, z = self.position
+            free_blocks = PLANNER_BLOCKS - len(self.planner)
+            free_bytes = RX_BUFFER_SIZE - len(self.rx)
+        return f"<{state}|MPos:{x:.3f},{y:.3f},{z:.3f}|Bf:{free_blocks},{free_bytes}|FS:{self.feed:.0f},0>\r\n".encode("ascii")
+
+    def _receive(self):
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            for byte in data:
+                if byte == ord("?"):
+                    # Realtime command, never enters the receive buffer
+                    self._write(self._status())
+                    continue
+                if byte == ord("\r"):
+                    continue
+                with self.condition:
+                    if len(self.rx) >= RX_BUFFER_SIZE:
+                        self.stats["rx_overflows"] += 1
+                        continue
+                    self.rx.append(byte)
+                    self.stats["max_rx_bytes"] = max(self.stats["max_rx_bytes"], len(self.rx))
+                    if byte == ord("\n"):
+                        self.condition.notify_all()
+
+    def _parse(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or b"\n" in self.rx)
+                if not self.running:
+                    return
+                end = self.rx.index(b"\n")
+                line = bytes(self.rx[:end]).strip().upper()
+            if self.parse_seconds:
+                time.sleep(self.parse_seconds)
+            seconds = self._plan(line) if line else None
+            with self.condition:
+                if seconds is not None:
+                    # The line stays in the receive buffer until the planner has room for it
+                    self.condition.wait_for(lambda: not self.running or len(self.planner) < PLANNER_BLOCKS)
+                    self.planner.append(seconds)
+                    self.stats["max_planner_blocks"] = max(self.stats["max_planner_blocks"], len(self.planner))
+                del self.rx[:end + 1]
+                self.condition.notify_all()
+            if line:
+                self.stats["lines"] += 1
+                self._write(b"ok\r\n")
+
+    def _plan(self, line):
+        """Seconds the line keeps the machine busy, None for lines that do not move it."""
+        if line.startswith(b"$"):
+            return None
+        words = WORD_PATTERN.findall(line)
+        target = list(self.position)
+        moved = False
+        dwell = None
+        for letter, value in words:
+            number = float(value)
+            if letter == b"G":
+                if number in (0, 1, 2, 3):
+                    self.motion = int(number)
+                elif number == 90:
+                    self.absolute = True
+                elif number == 91:
+                    self.absolute = False
+                elif number == 4:
+                    dwell = 0.0
+            elif letter == b"F":
+                self.feed = number
+            elif letter == b"P" and dwell is not None:
+                dwell = number
+            elif letter in (b"X", b"Y", b"Z"):
+                axis = b"XYZ".index(letter)
+                target[axis] = number if self.absolute else target[axis] + number
+                moved = True
+        if dwell is not None:
+            return dwell * self.time_scale
+        if not moved:
+            return None
+        distance = math.dist(self.position, target)
+        self.position = target
+        rate = self.rapid_rate if self.motion == 0 else self.feed
+        return distance / (rate / 60.0) * self.time_scale if rate else 0.0
+
+    def _execute(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or self.planner)
+                if not self.running:
+                    return
+                seconds = self.planner[0]
+                self.executing = True
+            time.sleep(seconds)
+            with self.condition:
+                self.planner.popleft()
+                self.executing = bool(self.planner)
+                self.stats["machine_seconds"] += seconds / self.time_scale if self.time_scale else 0.0
+                self.condition.notify_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a simulated GRBL controller on a pty until Ctrl+C.")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="fraction of the real drawing time the moves take (default 0.01)")
+    parser.add_argument("--parse-seconds", type=float, default=0.0002)
+    arguments = parser.parse_args()
+
+    grbl = FakeGrbl(arguments.time_scale, arguments.parse_seconds)
+    port = grbl.start()
+    print(f"Fake GRBL on {port}, add it to config.json as")
+    print(f'  "grbl_devices": [{{"name": "fake-grbl", "port": "{port}"}}]')
+    try:
+        while True:
+            time.sleep(5)
+            print(grbl.stats)
+    except KeyboardInterrupt:
+        grbl.stop()
+
+
+if __name__ == "__main__":
+    main()
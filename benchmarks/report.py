@@ -0,0 +1,164 @@
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# Latencies and throughput may move this much against the baseline before a run fails
+DEFAULT_TOLERANCE = 0.25
+# Twice as much for these: p99 rests on the few slowest samples, the streaming rate on thread scheduling
+NOISY_METRICS = ("p99", "lines_per_second")
+# Differences below this many seconds are timer noise, not regressions
+NOISE_SECONDS = 0.0005
+# Machine time estimates do not depend on the computer, only on the code producing the programs
+ESTIMATE_TOLERANCE = 0.01
+
+
+def summarize(samples):
+    """Count, p50, p99 and mean of a list of durations in seconds."""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=float)
+    return {
+        "count": len(values),
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean())
+    }
+
+
+def calibrate(rounds=5):
+    """Seconds this computer needs for a fixed piece of Python work, the fastest of `rounds` runs.
+
+    Baselines store it with the results; comparisons scale the baselines
+    by how much faster or slower the computer is now, so that a busy or
+    throttled machine is not taken for a regression.
+    """
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        text = " ".join(f"G1 X{i * 0.37:.3f} Y{i * 0.11:.3f}" for i in range(20000))
+        sorted(text.split(), key=len)
+        sum(float(word[1:]) for word in text.split() if word[0] in "XY")
+        samples.append(time.perf_counter() - start)
+    return min(samples)
+
+
+def median_of_runs(runs):
+    """Merge the results of several runs of a suite, every number is the median of its runs."""
+    merged = {}
+    for stage, metrics in runs[0].items():
+        merged[stage] = {}
+        for metric, value in metrics.items():
+            values = [run[stage][metric] for run in runs if metric in run.get(stage, {})]
+            merged[stage][metric] = type(value)(np.median(values)) if isinstance(value, (int, float)) else value
+    return merged
+
+
+def add_arguments(parser):
+    parser.add_argument("--runs", type=int, default=3,
+                        help="runs of the whole suite, each number reported is the median of the runs")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="store this run's results as the new baselines instead of comparing against them")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown against the baseline as a fraction (default %(default)s)")
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+
+
+def print_report(suite, results):
+    print(f"\n{suite}")
+    print(f"{'stage':<28}{'count':>7}{'p50 ms':>11}{'p99 ms':>11}  other")
+    for stage, metrics in results.items():
+        other = ", ".join(f"{name}={_format(value)}" for name, value in metrics.items()
+                          if name not in ("count", "p50", "p99", "mean"))
+        p50 = f"{metrics['p50'] * 1000:.2f}" if "p50" in metrics else "-"
+        p99 = f"{metrics['p99'] * 1000:.2f}" if "p99" in metrics else "-"
+        print(f"{stage:<28}{metrics.get('count', ''):>7}{p50:>11}{p99:>11}  {other}")
+
+
+def _format(value):
+    return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+
+def _higher_is_better(metric):
+    return metric.startswith("throughput") or metric.endswith("per_second")
+
+
+def _compared(metric):
+    return metric in ("p50", "p99") or _higher_is_better(metric) or "estimate" in metric
+
+
+def compare(suite, results, baselines, tolerance, speed=1.0):
+    """Regressions of `results` against the stored baselines of the suite, as messages.
+
+    `speed` is how much longer the calibration work takes now than when
+    the baselines were recorded.
+    """
+    regressions = []
+    for stage, metrics in results.items():
+        baseline = baselines.get(suite, {}).get(stage)
+        if baseline is None:
+            continue
+        for metric, value in metrics.items():
+            if not _compared(metric) or metric not in baseline:
+                continue
+            expected = baseline[metric]
+            if "estimate" not in metric:
+                expected = expected / speed if _higher_is_better(metric) else expected * speed
+            if "estimate" in metric:
+                allowed = ESTIMATE_TOLERANCE
+            else:
+                allowed = 2 * tolerance if metric in NOISY_METRICS else tolerance
+            if _higher_is_better(metric):
+                regressed = value < expected * (1 - allowed)
+            else:
+                regressed = value > expected * (1 + allowed) and (
+                    "estimate" in metric or value - expected > NOISE_SECONDS)
+            if regressed:
+                regressions.append(f"{stage} {metric}: {_format(value)} against a baseline of {_format(expected)}")
+    return regressions
+
+
+def finish(suite, results, arguments, calibration):
+    """Print the results, then store them as baselines or fail the process on a regression."""
+    print_report(suite, results)
+    try:
+        with open(arguments.baselines, "r") as baselines_file:
+            baselines = json.load(baselines_file)
+    except FileNotFoundError:
+        baselines = {}
+
+    if arguments.update_baselines:
+        baselines[suite] = results
+        baselines.setdefault("calibration_seconds", {})[suite] = calibration
+        baselines.setdefault("recorded_on", {})[suite] = f"{platform.node()} ({platform.machine()}, Python {platform.python_version()})"
+        with open(arguments.baselines, "w") as baselines_file:
+            json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write("\n")
+        print(f"\nBaselines of {suite} stored in {arguments.baselines}")
+        return
+
+    if suite not in baselines:
+        # A suite without baselines would pass every run, whatever it measured
+        print(f"\nNo baselines of {suite} in {arguments.baselines}, store them with --update-baselines", file=sys.stderr)
+        sys.exit(1)
+    missing = sorted(set(baselines[suite]) - set(results))
+    if missing:
+        print(f"\nNot measured in this run, not compared: {', '.join(missing)}")
+    recorded = baselines.get("calibration_seconds", {}).get(suite)
+    speed = calibration / recorded if recorded else 1.0
+    print(f"\nThis computer runs the calibration work at {1 / speed:.2f}x the speed of the baseline run")
+    regressions = compare(suite, results, baselines, arguments.tolerance, speed)
+    if regressions:
+        print("\n" + "!" * 72, file=sys.stderr)
+        print(f"PERFORMANCE REGRESSION in {suite}, against the baselines recorded on "
+              f"{baselines.get('recorded_on', {}).get(suite, 'an unknown machine')}:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        print("!" * 72, file=sys.stderr)
+        sys.exit(1)
+    print(f"\nNo regressions against the baselines of {suite}")
@@ -0,0 +1,84 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubCpee:
+    """Stands in for the CPEE engine: accepts the PUTs services send to callbacks.
+
+    `callback_url(name)` is what a benchmark sends as Cpee-Callback header,
+    `wait(name)` blocks until that callback was answered and returns the
+    JSON body and the time it arrived.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.condition = threading.Condition()
+        self.received = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                try:
+                    payload = json.loads(body) if body else None
+                except ValueError:
+                    payload = body.decode("utf-8", errors="replace")
+                with stub.condition:
+                    stub.received[self.path] = (payload, time.monotonic())
+                    stub.condition.notify_all()
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_POST = do_PUT
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stub-cpee", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def callback_url(self, name):
+        return f"http://{self.address[0]}:{self.address[1]}/callbacks/{name}"
+
+    def wait(self, name, timeout=None):
+        """The payload PUT to the callback and when it arrived (time.monotonic), None after `timeout` seconds."""
+        path = f"/callbacks/{name}"
+        with self.condition:
+            if not self.condition.wait_for(lambda: path in self.received, timeout):
+                return None
+            return self.received.pop(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accept and print CPEE callbacks until Ctrl+C.")
+    parser.add_argument("--port", type=int, default=8400)
+    arguments = parser.parse_args()
+
+    stub = StubCpee(port=arguments.port).start()
+    print(f"Stub CPEE on {stub.callback_url('<name>')}")
+    try:
+        while True:
+            with stub.condition:
+                stub.condition.wait()
+                for path, (payload, _) in list(stub.received.items()):
+                    print(path, payload)
+                stub.received.clear()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, jsonify, request
+
+NDJSON = "application/x-ndjson"
+
+
+def iter_batch(items, convert, workers=1, describe_error=str):
+    """Convert items with at most `workers` running at once, yield one result per item in input order.
+
+    A failing item does not stop the batch, its result carries the error
+    message instead of the G-code.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [executor.submit(convert, item) for item in items]
+        for index, future in enumerate(futures):
+            try:
+                yield {"index": index, "status": "success", "gcode": future.result()}
+            except Exception as e:
+                yield {"index": index, "status": "error", "message": describe_error(e)}
+    finally:
+        # A client that hung up on a streamed batch leaves nothing queued behind
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def wants_stream():
+    return request.args.get('stream') in ('1', 'true') or request.accept_mimetypes.best == NDJSON
+
+
+def batch_response(items, convert, workers=1, describe_error=str):
+    """All results as one JSON document, or as NDJSON lines while they finish when the client asks for a stream."""
+    results = iter_batch(items, convert, workers, describe_error)
+    if wants_stream():
+        return Response((json.dumps(result) + "\n" for result in results), mimetype=NDJSON)
+    results = list(results)
+    failed = sum(result["status"] == "error" for result in results)
+    return jsonify({"status": "success" if not failed else "partial", "failed": failed, "results": results}), 200
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.sqlite_util import connect, Transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    claimed_until REAL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+-- Pending deliveries by due time, the next one to send is the first index entry that is not blocked
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt, seq) WHERE state = 'pending';
+-- Earlier pending deliveries to the same callback, which hold back the later ones
+CREATE INDEX IF NOT EXISTS outbox_url ON outbox (url, seq) WHERE state = 'pending';
+"""
+
+# (connect, read) timeouts of one PUT in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackDispatcher:
+    """Delivers PUT requests to CPEE callbacks from a durable outbox.
+
+    `dispatch` only writes the delivery to an SQLite outbox and returns;
+    `workers` threads send the deliveries concurrently over pooled
+    connections, each with bounded timeouts. Deliveries to the same callback
+    URL go out one at a time in the order they were dispatched. A failed
+    delivery is retried with exponential backoff and jitter, from `backoff`
+    seconds up to `max_backoff`, until `max_attempts` is reached or the
+    callback answered with a 4xx status; then `on_failure(url, payload,
+    error)` is called. `on_success(url, payload)` is called once a callback
+    accepted its delivery. Claims are leased like orders in the order queue,
+    so processes sharing an outbox never send the same delivery twice at once
+    and a delivery left behind by a crash is sent again.
+    """
+
+    def __init__(self, path, workers=4, timeout=DEFAULT_TIMEOUT, max_attempts=8, backoff=1.0, max_backoff=300,
+                 on_success=None, on_failure=None, poll_interval=1.0):
+        self.path = path
+        self.workers = workers
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.poll_interval = poll_interval
+        # Longer than any single attempt, a claim outliving it belongs to a process that died
+        self.lease = 2 * sum(timeout if isinstance(timeout, tuple) else (timeout,)) + 30
+        self.local = threading.local()
+        self.wakeup = threading.Condition()
+        self.in_flight = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"callback-dispatcher-{i}", daemon=True).start()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = connect(self.path)
+        return connection
+
+    def _session(self):
+        # One pooled session per worker thread, connections to the same CPEE host are reused
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.local.session = session
+        return session
+
+    def dispatch(self, url, payload):
+        """Queue a PUT of `payload` as JSON to `url`, returns right away."""
+        now = time.time()
+        with Transaction(self._connection()) as connection:
+            connection.execute(
+                "INSERT INTO outbox (url, payload, next_attempt, created_at) VALUES (?, ?, ?, ?)",
+                (url, json.dumps(payload), now, now)
+            )
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def import_outbox(self, path):
+        """Take over the pending deliveries of another outbox, e.g. one left by an earlier version, and delete it."""
+        if not os.path.exists(path):
+            return 0
+        source = connect(path)
+        try:
+            rows = source.execute(
+                "SELECT url, payload, attempts, next_attempt, created_at FROM outbox WHERE state = 'pending' ORDER BY seq"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            source.close()
+        with Transaction(self._connection()) as connection:
+            connection.executemany(
+                "INSERT INTO outbox (url, payload, attempts, next_attempt, created_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return len(rows)
+
+    def flush(self, timeout=None):
+        """Wait until every delivery in the outbox was sent or gave up, False after `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.stats()["pending"]:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def urls(self):
+        """Callback URLs with a delivery in the outbox, pending or given up on."""
+        return {url for (url,) in self._connection().execute("SELECT DISTINCT url FROM outbox")}
+
+    def stats(self):
+        counts = dict(self._connection().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+        return {"pending": counts.get("pending", 0), "failed": counts.get("failed", 0), "in_flight": self.in_flight}
+
+    def _claim(self):
+        """The oldest due delivery whose callback has no earlier one pending, leased to this thread."""
+        now = time.time()
+        with Transaction(self._connection()) as connection:
+            row = connection.execute(
+                "SELECT seq, url, payload, attempts FROM outbox AS o INDEXED BY outbox_due "
+                "WHERE state = 'pending' AND next_attempt <= ? AND (claimed_until IS NULL OR claimed_until < ?) "
+                "AND NOT EXISTS (SELECT 1 FROM outbox AS p WHERE p.state = 'pending' AND p.url = o.url AND p.seq < o.seq) "
+                "ORDER BY next_attempt, seq LIMIT 1", (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE outbox SET claimed_until = ? WHERE seq = ?", (now + self.lease, row[0]))
+        return row
+
+    def _next_due(self):
+        row = self._connection().execute(
+            "SELECT MIN(MAX(next_attempt, COALESCE(claimed_until, 0))) FROM outbox WHERE state = 'pending'"
+        ).fetchone()
+        return row[0]
+
+    def _work(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except sqlite3.Error:
+                logger.exception("Reading the callback outbox failed")
+                claimed = None
+            if claimed is None:
+                self._sleep()
+                continue
+            seq, url, payload, attempts = claimed
+            with self.wakeup:
+                self.in_flight += 1
+            try:
+                self._deliver(seq, url, json.loads(payload), attempts + 1)
+            except Exception:
+                # A failing hook or database error must not take the worker down, the lease makes it retry
+                logger.exception("Delivering callback %s failed", url)
+            finally:
+                with self.wakeup:
+                    self.in_flight -= 1
+                    # The next delivery to the same callback may be due now
+                    self.wakeup.notify()
+
+    def _sleep(self):
+        next_due = self._next_due()
+        wait = self.poll_interval if next_due is None else min(self.poll_interval, max(0.0, next_due - time.time()))
+        with self.wakeup:
+            self.wakeup.wait(wait)
+
+    def _deliver(self, seq, url, payload, attempt):
+        permanent = False
+        try:
+            response = self._session().put(url, json=payload, timeout=self.timeout)
+            if 200 <= response.status_code < 300:
+                self._connection().execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+                if self.on_success:
+                    self.on_success(url, payload)
+                return
+            error = f"HTTP {response.status_code}"
+            # A callback that does not exist (any more) will not start to exist when asked again
+            permanent = 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+
+        if permanent or attempt >= self.max_attempts:
+            self._connection().execute(
+                "UPDATE outbox SET state = 'failed', attempts = ?, claimed_until = NULL, last_error = ? WHERE seq = ?",
+                (attempt, error, seq)
+            )
+            logger.error("Giving up on callback %s after %d attempts: %s", url, attempt, error)
+            if self.on_failure:
+                self.on_failure(url, payload, error)
+            return
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        self._connection().execute(
+            "UPDATE outbox SET attempts = ?, next_attempt = ?, claimed_until = NULL, last_error = ? WHERE seq = ?",
+            (attempt, time.time() + delay, error, seq)
+        )
+        logger.warning("Callback %s failed (%s), attempt %d, retrying in %.1f s", url, error, attempt, delay)
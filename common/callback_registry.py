@@ -0,0 +1,266 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+logger = logging.getLogger(__name__)
+
+
+def _record(op, callback_id):
+    return (json.dumps([op, callback_id]) + "\n").encode('utf-8')
+
+
+def _apply(callbacks, op, callback_id):
+    if op == "+":
+        callbacks.append(callback_id)
+    elif op == "<":
+        callbacks.appendleft(callback_id)
+    elif op == "-":
+        if callbacks and callbacks[0] == callback_id:
+            callbacks.popleft()
+        elif callback_id in callbacks:
+            callbacks.remove(callback_id)
+
+
+def _import_legacy(journal_path, legacy_path):
+    # callbacks.json of earlier versions: a list of {"callback_id": url}
+    try:
+        with open(legacy_path, 'r') as legacy_file:
+            entries = json.load(legacy_file)
+    except (OSError, ValueError):
+        return
+    with open(journal_path, 'ab') as journal:
+        for entry in entries:
+            journal.write(_record("+", entry["callback_id"]))
+    os.remove(legacy_path)
+
+
+class _FileLock:
+    """Exclusive lock on a lock file, shared by all processes using the same journal.
+
+    The lock file also holds the journal's generation, bumped on every compaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            # Blocks, retrying for about ten seconds before raising OSError
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+        return False
+
+    def generation(self):
+        self.file.seek(0)
+        return self.file.read().strip()
+
+    def set_generation(self, generation):
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(generation)
+        self.file.flush()
+
+
+class CallbackRegistry:
+    """FIFO of CPEE callback URLs, kept in memory and in an append-only journal.
+
+    Every change appends one record to the journal instead of rewriting a
+    file. Once the journal holds more than `compact_after` records and
+    mostly dead ones, it is replaced by a snapshot of the live callbacks.
+
+    A `shared` registry may be used by several processes at once: each
+    operation takes a file lock, replays only the records other processes
+    wrote since its last operation and writes its own record before it
+    returns, so it costs O(1) on top of what changed in the meantime.
+    Otherwise the registry belongs to one process: operations only change
+    the queue in memory and leave their record for a writer thread, so
+    nothing waits for the disk or a file lock, and the journal is read only
+    at startup, to recover the callbacks of a process that crashed or was
+    restarted, less the records it had not written yet. Both write the same
+    journal, so one can take over the other's.
+    """
+
+    def __init__(self, journal_path, compact_after=1000, legacy_path=None, shared=True):
+        self.journal_path = journal_path
+        self.compact_after = compact_after
+        self.shared = shared
+        self.lock = threading.Condition()
+        self.file_lock = _FileLock(journal_path + ".lock") if shared else contextlib.nullcontext()
+        self.callbacks = deque()
+        self.records = 0
+        self.offset = 0
+        self.generation = None
+        # Records of changes not in the journal yet, and whether the writer is busy with some
+        self.unwritten = []
+        self.writing = False
+        with self.lock, self.file_lock:
+            if legacy_path is not None and not os.path.exists(journal_path):
+                _import_legacy(journal_path, legacy_path)
+            self._sync()
+        if not shared:
+            threading.Thread(target=self._write, name="callback-journal", daemon=True).start()
+
+    def append(self, callback_id):
+        """Queue a callback at the end."""
+        with self._locked():
+            self._log("+", callback_id)
+
+    def push_front(self, callback_id):
+        """Put a callback back at the head, e.g. after delivering to it failed."""
+        with self._locked():
+            self._log("<", callback_id)
+
+    def pop(self):
+        """Take the oldest callback off the queue, None when there is none."""
+        with self._locked():
+            if not self.callbacks:
+                return None
+            callback_id = self.callbacks[0]
+            self._log("-", callback_id)
+            return callback_id
+
+    def first(self):
+        with self._locked():
+            return self.callbacks[0] if self.callbacks else None
+
+    def remove(self, callback_id):
+        """Drop a callback wherever it is, returns False if it was not queued."""
+        with self._locked():
+            if callback_id not in self.callbacks:
+                return False
+            self._log("-", callback_id)
+            return True
+
+    def snapshot(self):
+        with self._locked():
+            return list(self.callbacks)
+
+    def __len__(self):
+        with self._locked():
+            return len(self.callbacks)
+
+    def flush(self, timeout=None):
+        """Wait until every change is in the journal, False after `timeout` seconds."""
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.unwritten and not self.writing, timeout)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock, self.file_lock:
+            if self.shared:
+                self._sync()
+            yield
+
+    def _log(self, op, callback_id):
+        # Called with both locks held and, when shared, the journal replayed up to its end
+        _apply(self.callbacks, op, callback_id)
+        if not self.shared:
+            self.unwritten.append(_record(op, callback_id))
+            self.lock.notify_all()
+            return
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(_record(op, callback_id))
+            self.offset = journal.tell()
+        self.records += 1
+        if self._compactable(self.records):
+            self._compact(list(self.callbacks))
+
+    def _compactable(self, records):
+        return records > self.compact_after and records > 2 * len(self.callbacks)
+
+    def _sync(self):
+        """Replay the journal records written since the last call, by other processes when shared."""
+        generation = self.file_lock.generation() if self.shared else None
+        try:
+            size = os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            size = 0
+        if generation != self.generation or size < self.offset:
+            # Compacted by another process, start over from the snapshot
+            self.callbacks.clear()
+            self.records = self.offset = 0
+            self.generation = generation
+        if size == self.offset:
+            return
+        torn = False
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self.offset)
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    torn = True
+                    break
+                self.offset += len(line)
+                try:
+                    op, callback_id = json.loads(line)
+                except ValueError:
+                    continue
+                _apply(self.callbacks, op, callback_id)
+                self.records += 1
+        if torn:
+            # Left by a crash in the middle of a write, nobody else writes while we hold the lock
+            os.truncate(self.journal_path, self.offset)
+
+    def _write(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.unwritten)
+                records, self.unwritten = self.unwritten, []
+                self.writing = True
+                # The snapshot holds every change taken from `unwritten` so far, and none of the later ones
+                snapshot = list(self.callbacks) if self._compactable(self.records + len(records)) else None
+            try:
+                if snapshot is not None:
+                    self._compact(snapshot)
+                else:
+                    with open(self.journal_path, 'ab') as journal:
+                        journal.write(b"".join(records))
+                        self.offset = journal.tell()
+                    self.records += len(records)
+            except OSError:
+                logger.exception("Cannot write the callback journal %s", self.journal_path)
+            finally:
+                with self.lock:
+                    self.writing = False
+                    self.lock.notify_all()
+
+    def _compact(self, snapshot):
+        temporary_path = self.journal_path + ".tmp"
+        with open(temporary_path, 'wb') as journal:
+            for callback_id in snapshot:
+                journal.write(_record("+", callback_id))
+            journal.flush()
+            os.fsync(journal.fileno())
+            offset = journal.tell()
+        os.replace(temporary_path, self.journal_path)
+        self.records = len(snapshot)
+        self.offset = offset
+        if self.shared:
+            self.generation = uuid.uuid4().hex
+            self.file_lock.set_generation(self.generation)
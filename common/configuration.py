@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+
+CONFIG_FILE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
+
+# Seconds between two looks at the modification time of a watched file
+RELOAD_INTERVAL = 1.0
+
+# Where the coaster lies on the plotter and how the pen draws on it, every conversion depends on these
+CALIBRATION_KEYS = (
+    'lower_left_corner_x', 'lower_left_corner_y',
+    'upper_right_corner_x', 'upper_right_corner_y',
+    'feedrate', 'z_drawing_height', 'z_safe_height'
+)
+
+# The plotter of grbl-service when config.json lists no grbl_devices
+DEFAULT_GRBL_PORT = "COM5"
+DEFAULT_BAUD_RATE = 115200
+
+NUMBER = "number"
+# Types of the optional settings, checked where they are set; null counts as not set
+SETTING_TYPES = {
+    'batch_max_items': int,
+    'cache_disk_bytes': int,
+    'cache_memory_items': int,
+    'callback_max_attempts': int,
+    'callback_timeout': NUMBER,
+    'callback_workers': int,
+    'compositor_timeout': NUMBER,
+    'compositor_url': str,
+    'compositor_workers': int,
+    'device_retry_seconds': NUMBER,
+    'grbl_devices': list,
+    'machine': dict,
+    'metrics_enabled': bool,
+    'optimize_gcode': bool,
+    'optimizer_tolerance': NUMBER,
+    'order_ack_required': bool,
+    'order_max_overtaken': int,
+    'order_max_wait': NUMBER,
+    'order_notify_port': int,
+    'order_poll_interval': NUMBER,
+    'order_visibility_timeout': NUMBER,
+    'preconvert_orders': bool,
+    'preconvert_queue_size': int,
+    'preconvert_timeout': NUMBER,
+    'preconvert_workers': int,
+    'server': dict,
+    'svg2gcode_queue_size': int,
+    'svg2gcode_serve': bool,
+    'svg2gcode_timeout': NUMBER,
+    'svg2gcode_workers': int,
+    'svg_preflatten': bool,
+    'svg_service_url': str,
+    'svg_simplify_tolerance': NUMBER,
+    'text_service_url': str
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(Exception):
+    pass
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_type(key, value, expected):
+    if expected == NUMBER:
+        valid = is_number(value)
+    elif expected is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    else:
+        valid = isinstance(value, expected)
+    if not valid:
+        name = expected if expected == NUMBER else expected.__name__
+        raise ConfigError(f"{key} must be a {name}, not {json.dumps(value)}")
+
+
+def _validate(data):
+    for key in CALIBRATION_KEYS:
+        if key in data:
+            _check_type(key, data[key], NUMBER)
+    for key, expected in SETTING_TYPES.items():
+        if data.get(key) is not None:
+            _check_type(key, data[key], expected)
+
+    def check_order(low, high, message):
+        if low in data and high in data and not data[low] < data[high]:
+            raise ConfigError(f"{message} ({low} {data[low]}, {high} {data[high]})")
+
+    check_order('lower_left_corner_x', 'upper_right_corner_x', "The lower left corner must be left of the upper right one")
+    check_order('lower_left_corner_y', 'upper_right_corner_y', "The lower left corner must be below the upper right one")
+    check_order('z_drawing_height', 'z_safe_height', "The pen must be lifted above the drawing height")
+    if 'feedrate' in data and data['feedrate'] <= 0:
+        raise ConfigError(f"feedrate must be positive, not {data['feedrate']}")
+
+    for i, entry in enumerate(data.get('grbl_devices') or []):
+        if not isinstance(entry, dict) or not isinstance(entry.get('port'), str):
+            raise ConfigError(f"grbl_devices[{i}] needs a port, e.g. {{\"name\": \"plotter-1\", \"port\": \"COM5\"}}")
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class Config(Mapping):
+    """An immutable snapshot of config.json, validated once when it is loaded.
+
+    It reads like the dict it was loaded from, with nested objects and lists
+    turned read-only as well. The calibration values only need to be set
+    where a service converts or draws; where set, they are checked like the
+    optional settings in SETTING_TYPES, so a typo fails the load instead of
+    a request.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data=None):
+        data = {} if data is None else data
+        if not isinstance(data, dict):
+            raise ConfigError("The configuration must be a JSON object")
+        _validate(data)
+        object.__setattr__(self, "_data", _freeze(data))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config is immutable, edit config.json instead")
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"Config({dict(self._data)!r})"
+
+    @property
+    def calibrated(self):
+        """Whether the coaster corners, feedrate and pen heights are all set."""
+        return all(key in self._data for key in CALIBRATION_KEYS)
+
+    def calibration(self):
+        """The calibration values that are set, as a plain dict, e.g. for cache keys."""
+        return {key: self._data[key] for key in CALIBRATION_KEYS if key in self._data}
+
+    @property
+    def grbl_devices(self):
+        """The plotters of grbl-service with name and baud rate filled in, the default plotter if none are listed."""
+        entries = self._data.get('grbl_devices') or ({"port": DEFAULT_GRBL_PORT},)
+        return tuple(
+            {"name": entry.get('name', f"plotter-{i + 1}"), "port": entry['port'],
+             "baud_rate": entry.get('baud_rate', DEFAULT_BAUD_RATE)}
+            for i, entry in enumerate(entries)
+        )
+
+
+def load_config(path=CONFIG_FILE_PATH):
+    """Read and validate a config file, a ConfigError says what is wrong with it."""
+    try:
+        with open(path, 'r') as config_file:
+            data = json.load(config_file)
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}") from None
+    except ValueError as e:
+        raise ConfigError(f"{path} is not valid JSON: {e}") from None
+    return Config(data)
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigWatcher:
+    """The current version of a config file, replaced by a new one when the file changes.
+
+    A background thread compares the file's modification time every
+    `interval` seconds, requests only read `current` and never touch the
+    file. A changed file is loaded and validated completely before it
+    replaces `current` in one assignment, so a reader sees either the old or
+    the new version, never a mix. Subscribers are called with both afterwards,
+    to drop or rebuild what they derived from the old one. A file that does
+    not load is logged and leaves the previous version in place, a file that
+    does not load at startup leaves `default`; `error` says what is wrong
+    until the file is fixed.
+    """
+
+    def __init__(self, path=CONFIG_FILE_PATH, load=load_config, default=None, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.load = load
+        self.interval = interval
+        self.subscribers = []
+        self.reloads = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.signature = _signature(path)
+        try:
+            self.current = load(path)
+        except ConfigError as e:
+            logger.error("%s", e)
+            self.error = str(e)
+            self.current = Config() if default is None else default
+
+    def subscribe(self, callback):
+        """Call `callback(old, new)` after every reload, usable as a decorator."""
+        self.subscribers.append(callback)
+        return callback
+
+    def check(self):
+        """Reload the file if it changed since the last look, True if a new version is in place."""
+        with self.lock:
+            signature = _signature(self.path)
+            if signature == self.signature:
+                return False
+            # A half-written file fails to load and is retried once the write changes it again
+            self.signature = signature
+            try:
+                new = self.load(self.path)
+            except ConfigError as e:
+                logger.error("Keeping the previous configuration: %s", e)
+                self.error = str(e)
+                return False
+            old, self.current = self.current, new
+            self.error = None
+            self.reloads += 1
+
+        logger.warning("Reloaded %s", self.path)
+        for callback in list(self.subscribers):
+            try:
+                callback(old, new)
+            except Exception:
+                logger.exception("Subscriber %r of %s failed", callback, self.path)
+        return True
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=f"watch {os.path.basename(self.path)}", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def watch_config(path=CONFIG_FILE_PATH, load=load_config, default=None):
+    """The running watcher of `path` shared by everything in this process, started on first use."""
+    path = os.path.abspath(path)
+    with _watchers_lock:
+        watcher = _watchers.get(path)
+        if watcher is None:
+            watcher = _watchers[path] = ConfigWatcher(path, load, default).start()
+        return watcher
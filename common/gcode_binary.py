@@ -0,0 +1,192 @@
+import math
+import struct
+
+import numpy as np
+
+from common.gcode_lexer import iter_commands, format_command
+from common.gcode_simulator import simulate
+
+MIMETYPE = "application/octet-stream"
+
+MAGIC = b"GCB1"
+VERSION = 1
+# The service that encoded the program ran the optimizer on it, grbl-service streams it as it is
+FLAG_OPTIMIZED = 1
+
+# magic, version, flags, reserved, commands, values, raw bytes, min x, min y, max x, max y, estimated seconds
+HEADER = struct.Struct("<4sBBHIIIfffff")
+
+# Leading words with an opcode of their own, anything else is kept as raw text
+OPCODES = ["G0", "G1", "G2", "G3", "G4", "G17", "G20", "G21", "G28", "G90", "G91", "G92",
+           "M0", "M2", "M3", "M4", "M5", "M30"]
+OPCODE_BY_WORD = {word: index for index, word in enumerate(OPCODES)}
+# Commands made of parameter words only, e.g. a modal "X10 Y5" or "F1500"
+OP_PARAMETERS = 254
+OP_RAW = 255
+
+# Parameter letters, bit i of a command's mask says PARAMETERS[i] follows in the value array
+PARAMETERS = "XYZFIJKPSR"
+PARAMETER_BITS = {letter: 1 << index for index, letter in enumerate(PARAMETERS)}
+
+# Commands formatted per block while streaming, so only one block of values is ever a Python list
+BLOCK = 4096
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+def _opcode(letter, value):
+    number = float(value)
+    if number != int(number):
+        return None
+    return OPCODE_BY_WORD.get(f"{letter}{int(number)}")
+
+
+def encode(gcode_text, machine=None, optimized=False):
+    """Pack a program into opcodes, parameter masks and float32 values behind a header.
+
+    Commands are split like iter_commands. The header holds the command
+    count, the drawing bounds and the simulator's time estimate.
+    """
+    opcodes = []
+    masks = []
+    values = []
+    raw = []
+    for command in iter_commands(gcode_text):
+        letter, value = command[0]
+        opcode = _opcode(letter, value) if letter in "GM" else None
+        parameters = command[1:] if opcode is not None else command
+        if opcode is None and letter in PARAMETER_BITS:
+            opcode = OP_PARAMETERS
+        mask = 0
+        for parameter, _ in parameters:
+            bit = PARAMETER_BITS.get(parameter, 0)
+            if not bit or mask & bit:
+                break
+            mask |= bit
+        else:
+            if opcode is not None:
+                # Values go in mask order, the decoder reads them back by bit
+                by_letter = dict(parameters)
+                values.extend(float(by_letter[parameter]) for parameter in PARAMETERS if mask & PARAMETER_BITS[parameter])
+                opcodes.append(opcode)
+                masks.append(mask)
+                continue
+        opcodes.append(OP_RAW)
+        masks.append(0)
+        raw.append(format_command(command))
+
+    report = simulate(gcode_text, machine)
+    bounds = report.get("drawing_bounds")
+    low_high = (bounds["min_x"], bounds["min_y"], bounds["max_x"], bounds["max_y"]) if bounds else (math.nan,) * 4
+    raw_bytes = "\n".join(raw).encode("ascii")
+    header = HEADER.pack(MAGIC, VERSION, FLAG_OPTIMIZED if optimized else 0, 0, len(opcodes), len(values),
+                         len(raw_bytes), *low_high, report["estimated_seconds"])
+    return b"".join((
+        header,
+        np.asarray(values, dtype="<f4").tobytes(),
+        np.asarray(masks, dtype="<u2").tobytes(),
+        np.asarray(opcodes, dtype="u1").tobytes(),
+        raw_bytes
+    ))
+
+
+class BinaryProgram:
+    """Read-only view of an encoded program in any buffer, e.g. an mmap of a spool file.
+
+    The arrays are numpy views into the buffer, nothing is copied or parsed
+    up front.
+    """
+
+    def __init__(self, buffer):
+        # Checked before any view exists, so that a failure leaves the buffer free to be closed
+        validate(buffer, len(buffer))
+        self.flags, self.commands, value_count, raw_size, bounds, self.estimated_seconds = _unpack_header(buffer)
+        offset = HEADER.size
+        self.values = np.frombuffer(buffer, dtype="<f4", count=value_count, offset=offset)
+        offset += 4 * value_count
+        self.masks = np.frombuffer(buffer, dtype="<u2", count=self.commands, offset=offset)
+        offset += 2 * self.commands
+        self.opcodes = np.frombuffer(buffer, dtype="u1", count=self.commands, offset=offset)
+        offset += self.commands
+        self.raw = buffer[offset:offset + raw_size]
+        self.bounds = None if math.isnan(bounds[0]) else dict(zip(("min_x", "min_y", "max_x", "max_y"), (round(value, 3) for value in bounds)))
+
+    @property
+    def optimized(self):
+        return bool(self.flags & FLAG_OPTIMIZED)
+
+    def header(self):
+        return {"commands": self.commands, "bounds": self.bounds,
+                "estimated_seconds": round(self.estimated_seconds, 3), "optimized": self.optimized}
+
+    def iter_bytes(self):
+        """Yield every command as the bytes GRBL gets, e.g. b'G1X10.5Y3', one block of values at a time."""
+        raw_lines = iter(bytes(self.raw).split(b"\n")) if len(self.raw) else iter(())
+        heads = [word.encode("ascii") for word in OPCODES]
+        letters = [letter.encode("ascii") for letter in PARAMETERS]
+        value_index = 0
+        for start in range(0, self.commands, BLOCK):
+            opcodes = self.opcodes[start:start + BLOCK].tolist()
+            masks = self.masks[start:start + BLOCK].tolist()
+            # Values of this block of commands, found by counting their parameter bits
+            count = sum(bin(mask).count("1") for mask in masks)
+            values = self.values[value_index:value_index + count].tolist()
+            value_index += count
+            position = 0
+            for opcode, mask in zip(opcodes, masks):
+                if opcode == OP_RAW:
+                    yield b"".join(next(raw_lines).split())
+                    continue
+                parts = [heads[opcode]] if opcode != OP_PARAMETERS else []
+                bit = 0
+                while mask:
+                    if mask & 1:
+                        parts.append(letters[bit] + _format(values[position]))
+                        position += 1
+                    mask >>= 1
+                    bit += 1
+                yield b"".join(parts)
+
+    def iter_lines(self):
+        """Yield normalized command lines, as iter_lines of the original program with float32 values."""
+        for command in self.iter_bytes():
+            yield _spaced(command.decode("ascii"))
+
+
+def _unpack_header(buffer):
+    if len(buffer) < HEADER.size:
+        raise BinaryFormatError("Binary G-code is shorter than its header.")
+    magic, version, flags, _, commands, value_count, raw_size, *bounds, seconds = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise BinaryFormatError("Not a binary G-code program of a supported version.")
+    return flags, commands, value_count, raw_size, bounds, seconds
+
+
+def validate(header, size):
+    """Raise BinaryFormatError unless a program starting with the `header` bytes fits into `size` bytes."""
+    _, commands, value_count, raw_size, _, _ = _unpack_header(header)
+    if size < HEADER.size + 4 * value_count + 3 * commands + raw_size:
+        raise BinaryFormatError("Binary G-code is truncated.")
+
+
+def is_optimized(header):
+    """Whether the program starting with the `header` bytes went through the optimizer."""
+    return bool(_unpack_header(header)[0] & FLAG_OPTIMIZED)
+
+
+def _format(value):
+    # float32 keeps about seven digits, four decimals are below any plotter's resolution
+    text = f"{value:.4f}".rstrip("0").rstrip(".")
+    return (text if text != "-0" else "0").encode("ascii")
+
+
+def _spaced(command):
+    # 'G1X10Y3' -> 'G1 X10 Y3'
+    return "".join(" " + char if char.isalpha() and index else char for index, char in enumerate(command))
+
+
+def decode(buffer):
+    """The program as G-code text, one command per line."""
+    return "\n".join(BinaryProgram(buffer).iter_lines())
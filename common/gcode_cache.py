@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class GcodeCache:
+    """Content-addressed G-code cache with an in-memory LRU tier and an on-disk tier.
+
+    Keys are hashes of the converted input plus the configuration values the
+    conversion depends on. Both tiers are dropped by `invalidate`, which the
+    services call when those values change; the disk tier is trimmed to
+    `disk_bytes` by evicting the least recently used files.
+    """
+
+    def __init__(self, cache_dir, memory_items=256, disk_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.disk_usage = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".gcode"))
+
+    @staticmethod
+    def key(kind, data, params):
+        digest = hashlib.sha256()
+        digest.update(kind.encode('utf-8'))
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        digest.update(data.encode('utf-8') if isinstance(data, str) else data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self.memory[key]
+
+            path = self._path(key)
+            try:
+                with open(path, 'r') as cached_file:
+                    value = cached_file.read()
+                os.utime(path)
+            except OSError:
+                self.counters["misses"] += 1
+                return None
+
+            self.counters["disk_hits"] += 1
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'w') as cached_file:
+                    cached_file.write(value)
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(tmp_path, path)
+                self.disk_usage += os.path.getsize(path) - old_size
+            except OSError:
+                return
+            if self.disk_usage > self.disk_bytes:
+                self._evict_disk()
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def invalidate(self):
+        """Drop every entry because the configuration the keys were made with changed."""
+        with self.lock:
+            self.counters["invalidations"] += 1
+            self._clear()
+
+    def stats(self):
+        with self.lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            lookups = hits + self.counters["misses"]
+            return dict(
+                self.counters,
+                hits=hits,
+                hit_rate=hits / lookups if lookups else 0.0,
+                memory_entries=len(self.memory),
+                disk_bytes=self.disk_usage
+            )
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.gcode")
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".gcode")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.disk_usage <= self.disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_usage -= size
+            self.counters["evictions"] += 1
+
+    def _clear(self):
+        self.memory.clear()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".gcode"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        self.disk_usage = 0
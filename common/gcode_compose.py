@@ -0,0 +1,115 @@
+from common.gcode_lexer import iter_commands, format_command
+from common.gcode_optimizer import optimize_gcode
+
+# Modal settings a header may hold, by group; programs that set a group differently cannot share one
+MODAL_GROUPS = {20: "units", 21: "units", 90: "distance", 91: "distance", 17: "plane", 18: "plane", 19: "plane"}
+# Program ends, of which only the footer of the composed program keeps one
+PROGRAM_ENDS = (2, 30)
+
+
+class ComposeError(Exception):
+    pass
+
+
+def _ends_program(words):
+    return any(letter == "M" and float(value) in PROGRAM_ENDS for letter, value in words)
+
+
+def _commands(gcode_text):
+    """The program's commands, with program ends split off the moves they share a line with, e.g. `G0 Z-30 M2`."""
+    for words in iter_commands(gcode_text):
+        ends = [word for word in words if _ends_program([word])]
+        rest = [word for word in words if not _ends_program([word])]
+        if rest:
+            yield rest
+        if ends:
+            yield ends
+
+
+def _split(gcode_text, z_drawing_height, z_safe_height):
+    """Split a program into its header settings, its drawing and its footer.
+
+    The header is what comes before the first move, the footer the lifts
+    above the safe height, rapid travels and program ends after the last
+    stroke, e.g. the `G0 Z-30` and `M2` every conversion ends with.
+    """
+    commands = list(_commands(gcode_text))
+    up = 1 if z_safe_height > z_drawing_height else -1
+
+    header = []
+    while commands and not any(letter in "XYZ" for letter, _ in commands[0]) and not _ends_program(commands[0]):
+        header.append(commands.pop(0))
+
+    footer = []
+    while commands:
+        words = commands[-1]
+        values = dict(words)
+        rapid = "G" in values and float(values["G"]) == 0 and not set(values) - set("GXYZ")
+        parks = rapid and "Z" in values and (float(values["Z"]) - z_safe_height) * up > 0
+        travels = rapid and "Z" not in values
+        if not (parks or travels or _ends_program(words)):
+            break
+        footer.insert(0, commands.pop())
+
+    # The next program starts with a travel, the pen must be up by then
+    z = None
+    for words in commands:
+        for letter, value in words:
+            if letter == "Z":
+                z = float(value)
+    if z is not None and abs(z - z_drawing_height) < abs(z - z_safe_height):
+        raise ComposeError("a program ends with the pen down")
+    return header, commands, footer
+
+
+def _merge_headers(headers):
+    merged = []
+    groups = {}
+    for header in headers:
+        for words in header:
+            for letter, value in words:
+                if letter == "G" and float(value) in MODAL_GROUPS:
+                    group = MODAL_GROUPS[float(value)]
+                    if groups.setdefault(group, float(value)) != float(value):
+                        raise ComposeError(f"the programs use different {group} (G{groups[group]:g} and G{value})")
+            command = format_command(words)
+            if command not in merged:
+                merged.append(command)
+    return merged
+
+
+def compose(programs, z_drawing_height, z_safe_height, optimize=True, tolerance=0.01, machine=None, time_budget=0.5):
+    """Merge G-code programs into one program for one session on the plotter.
+
+    The programs share one header and the footer of the last program; the
+    lifts to the parking height and the program ends between them are
+    dropped. With `optimize`, the strokes of all programs are then ordered
+    together by the optimizer, so the plotter may draw part of the text
+    between parts of the logo, and its time estimates use the `machine`
+    limits. Returns the program and a report.
+    """
+    parts = [_split(gcode_text, z_drawing_height, z_safe_height) for gcode_text in programs if gcode_text]
+    if not parts:
+        raise ComposeError("nothing to compose")
+
+    header = _merge_headers(part[0] for part in parts)
+    footer = next((part[2] for part in reversed(parts) if part[2]), [])
+    lines = list(header)
+    dropped = sum(len(part[0]) + len(part[2]) for part in parts) - len(header) - len(footer)
+    for _, body, _ in parts:
+        for index, words in enumerate(body):
+            command = format_command(words)
+            # A program starting with a pen lift repeats the one the previous program ended with
+            if index == 0 and lines and command == lines[-1] and {letter for letter, _ in words} == {"G", "Z"}:
+                dropped += 1
+                continue
+            lines.append(command)
+    lines.extend(format_command(words) for words in footer)
+    gcode_text = "\n".join(lines)
+    report = {"programs": len(parts), "commands_dropped": dropped}
+    if not optimize:
+        return gcode_text, dict(report, optimized=False, reason="disabled")
+
+    optimized_text, optimizer_report = optimize_gcode(gcode_text, z_drawing_height, z_safe_height,
+                                                      tolerance=tolerance, machine=machine, time_budget=time_budget)
+    return optimized_text, dict(report, **optimizer_report)
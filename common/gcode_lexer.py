@@ -0,0 +1,105 @@
+import re
+
+# Newlines, comments and words, found in one left-to-right scan; anything
+# else is stray text and skipped by the regex engine itself.
+# A ';' comment ends at the end of the line or, as in grbl-service's original
+# preprocess_gcode, right before a G code (G followed by a number) that starts
+# the next command, so flattened single-line programs keep all their commands.
+TOKEN = re.compile(r"""
+    (\n)
+  | ;[^\n]*?(?=\n|[\s;(][Gg][ \t]*\d|$)
+  | \([^)\n]*(?:\)|$)
+  | ([A-Za-z])[ \t]*([-+]?(?:\d+\.?\d*|\.\d+))
+""", re.VERBOSE)
+
+# Places where streamed input can be split without changing how it lexes
+BOUNDARY = re.compile(r"\s(?=[Gg][ \t]*\d)")
+BOUNDARY_WINDOW = 512
+
+# Marks a line break in the word stream
+NEWLINE = None
+
+
+def _lex(text):
+    for newline, letter, value in TOKEN.findall(text):
+        if letter:
+            yield letter.upper(), value
+        elif newline:
+            yield NEWLINE
+
+
+def _safe_cut(buffer):
+    """Length of the prefix of `buffer` that lexes the same whatever follows it."""
+    line_start = buffer.rfind("\n") + 1
+    cut = line_start
+    for match in BOUNDARY.finditer(buffer, max(line_start, len(buffer) - BOUNDARY_WINDOW)):
+        cut = match.start()
+    # A '(' comment left open before the cut could still swallow the boundary
+    if cut > line_start and buffer.rfind("(", line_start, cut) > buffer.rfind(")", line_start, cut):
+        cut = line_start
+    return cut
+
+
+def iter_words(chunks):
+    """Yield (letter, value) words and NEWLINE markers from chunks of G-code text.
+
+    `chunks` is a whole program as one string or any iterable of strings,
+    e.g. a file object or a streamed response. Values keep their original
+    text. Comments, whitespace and stray characters are skipped. Runs in
+    linear time: each chunk is scanned once up to the last point where it can
+    be split safely, only the remainder is carried into the next chunk.
+    """
+    if isinstance(chunks, str):
+        yield from _lex(chunks)
+        return
+    carry = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        carry.append(chunk)
+        if "\n" not in chunk and len(chunk) < BOUNDARY_WINDOW and sum(map(len, carry)) < BOUNDARY_WINDOW:
+            continue
+        buffer = "".join(carry)
+        cut = _safe_cut(buffer)
+        if cut:
+            yield from _lex(buffer[:cut])
+            carry = [buffer[cut:]]
+        else:
+            carry = [buffer]
+    yield from _lex("".join(carry))
+
+
+def iter_commands(chunks):
+    """Yield commands as lists of words, one per line and one per G word.
+
+    Splits like the original preprocess_gcode: every G word starts a new
+    command, other words belong to the command before them.
+    """
+    command = []
+    for word in iter_words(chunks):
+        if word is NEWLINE:
+            if command:
+                yield command
+                command = []
+            continue
+        if word[0] == "G" and command:
+            yield command
+            command = []
+        command.append(word)
+    if command:
+        yield command
+
+
+def format_command(words):
+    return " ".join(letter + value for letter, value in words)
+
+
+def iter_lines(chunks):
+    """Yield normalized command lines, e.g. 'G1 X10.5 Y3 F1500'."""
+    for command in iter_commands(chunks):
+        yield format_command(command)
+
+
+def normalize(chunks, separator=" "):
+    """Normalize a whole program into one string of commands."""
+    return separator.join(iter_lines(chunks))
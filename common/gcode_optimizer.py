@@ -0,0 +1,352 @@
+import math
+import time
+
+from common.gcode_lexer import iter_commands, format_command
+from common.gcode_simulator import MachineLimits, simulate
+
+
+class _Stroke:
+    """A pen-down polyline with the commands that lower and lift the pen."""
+
+    def __init__(self, start, pen_down, feed):
+        # points are (x, y, x_text, y_text), feeds[i] is the feed of the segment ending at points[i]
+        self.points = [start]
+        self.feeds = [feed]
+        self.pen_down = pen_down
+        self.pen_up = None
+
+    @property
+    def start(self):
+        return self.points[0]
+
+    @property
+    def end(self):
+        return self.points[-1]
+
+    def reverse(self):
+        self.points.reverse()
+        # Segment i now ends at the point that used to start it
+        self.feeds = [self.feeds[-1]] + self.feeds[:0:-1]
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def _parse_program(commands, z_drawing_height, z_safe_height):
+    """Split a program into header commands, strokes and footer commands."""
+    header, strokes, between = [], [], []
+    x = y = None
+    x_text = y_text = None
+    feed = None
+    motion = None
+    stroke = None
+
+    def is_down(z):
+        return abs(z - z_drawing_height) < abs(z - z_safe_height)
+
+    for words in commands:
+        command = format_command(words)
+        values = {}
+        other = []
+        for letter, value in words:
+            if letter == "G" and float(value) in (0, 1):
+                motion = int(float(value))
+            elif letter == "G" and float(value) in (2, 3):
+                raise _Unsupported("arcs are not supported")
+            elif letter in "XYZF":
+                values[letter] = value
+            else:
+                other.append((letter, value))
+        if "F" in values:
+            feed = values["F"]
+        has_xy = "X" in values or "Y" in values
+        has_z = "Z" in values
+        if (has_xy or has_z) and motion is None:
+            raise _Unsupported("motion without G0/G1")
+        lowers_pen = has_z and is_down(float(values["Z"]))
+
+        if stroke is not None:
+            if other or (has_xy and has_z):
+                raise _Unsupported(f"unexpected command '{command}' while drawing")
+            if has_z and not lowers_pen:
+                stroke.pen_up = command
+                strokes.append(stroke)
+                stroke = None
+            elif has_xy:
+                if motion != 1:
+                    raise _Unsupported("rapid move while the pen is down")
+                x, x_text = (float(values["X"]), values["X"]) if "X" in values else (x, x_text)
+                y, y_text = (float(values["Y"]), values["Y"]) if "Y" in values else (y, y_text)
+                stroke.points.append((x, y, x_text, y_text))
+                stroke.feeds.append(feed)
+            continue
+
+        if lowers_pen:
+            if other or has_xy:
+                raise _Unsupported(f"unexpected command '{command}' while lowering the pen")
+            if x is None or y is None:
+                raise _Unsupported("pen lowered before any XY position")
+            # Travels and lifts between strokes are regenerated, anything else would be reordered
+            if any(not droppable for _, droppable in between):
+                raise _Unsupported("non-motion commands between strokes")
+            between = []
+            stroke = _Stroke((x, y, x_text, y_text), command, feed)
+            continue
+
+        if "X" in values:
+            x, x_text = float(values["X"]), values["X"]
+        if "Y" in values:
+            y, y_text = float(values["Y"]), values["Y"]
+        if strokes:
+            between.append((command, not other))
+        elif not (other or has_z) and has_xy:
+            # The travel to the first stroke is regenerated
+            continue
+        else:
+            header.append(command)
+
+    if stroke is not None:
+        raise _Unsupported("program ends with the pen down")
+    footer = [command for command, _ in between]
+    return header, strokes, footer
+
+
+def _simplify(stroke, tolerance):
+    """Drop interior points that lie within `tolerance` of a straight run.
+
+    A run grows from the last kept point while every point it skips, not
+    only the newest, stays within `tolerance` of the segment replacing
+    them, so deviations cannot add up along the run. Each skipped point
+    narrows the directions the segment may take to a wedge, and the
+    segment must reach at least as far as the skipped points so that
+    spikes are not cut off; that keeps the check linear in the points.
+    Points where the feed changes are always kept.
+    """
+    points, feeds = stroke.points, stroke.feeds
+    if len(points) < 3:
+        return 0
+    kept_points, kept_feeds = [points[0]], [feeds[0]]
+    ax, ay = points[0][0], points[0][1]
+    # Directions are angles relative to the first skipped point further than `tolerance` from the run's start
+    reference = None
+    low, high = -math.pi, math.pi
+    reach = 0.0
+    for i in range(1, len(points) - 1):
+        px, py = points[i][0] - ax, points[i][1] - ay
+        distance = math.hypot(px, py)
+        reach = max(reach, distance)
+        if distance > tolerance:
+            angle = math.atan2(py, px)
+            if reference is None:
+                reference = angle
+            angle = (angle - reference + math.pi) % (2 * math.pi) - math.pi
+            spread = math.asin(tolerance / distance)
+            low, high = max(low, angle - spread), min(high, angle + spread)
+
+        cx, cy = points[i + 1][0] - ax, points[i + 1][1] - ay
+        covered = feeds[i] == feeds[i + 1] and math.hypot(cx, cy) >= reach
+        if covered and reference is not None:
+            angle = (math.atan2(cy, cx) - reference + math.pi) % (2 * math.pi) - math.pi
+            covered = low <= angle <= high
+        if covered:
+            continue
+        kept_points.append(points[i])
+        kept_feeds.append(feeds[i])
+        ax, ay = points[i][0], points[i][1]
+        reference = None
+        low, high = -math.pi, math.pi
+        reach = 0.0
+    kept_points.append(points[-1])
+    kept_feeds.append(feeds[-1])
+    removed = len(points) - len(kept_points)
+    stroke.points, stroke.feeds = kept_points, kept_feeds
+    return removed
+
+
+def _nearest_neighbour(strokes, start):
+    """Greedy tour over the strokes, flipping a stroke when its end is closer."""
+    if not strokes:
+        return []
+    # Bucket stroke endpoints into a grid so each step only looks at nearby cells
+    xs = [p[0] for s in strokes for p in (s.start, s.end)]
+    ys = [p[1] for s in strokes for p in (s.start, s.end)]
+    span = max(max(xs) - min(xs), max(ys) - min(ys), 1e-9)
+    cell = span / max(1, int(math.sqrt(len(strokes))))
+    grid = {}
+    for index, s in enumerate(strokes):
+        for point in (s.start, s.end):
+            key = (int(point[0] // cell), int(point[1] // cell))
+            grid.setdefault(key, set()).add(index)
+
+    remaining = set(range(len(strokes)))
+    order = []
+    position = start
+    while remaining:
+        cx, cy = int(position[0] // cell), int(position[1] // cell)
+        # Enough rings to reach every endpoint from the current position
+        reach = max(abs(position[0] - min(xs)), abs(position[0] - max(xs)),
+                    abs(position[1] - min(ys)), abs(position[1] - max(ys)))
+        max_ring = int(reach // cell) + 2
+        best, best_distance, best_reversed = None, float("inf"), False
+        ring = 0
+        while ring <= max_ring:
+            for gx in range(cx - ring, cx + ring + 1):
+                for gy in range(cy - ring, cy + ring + 1):
+                    if max(abs(gx - cx), abs(gy - cy)) != ring:
+                        continue
+                    for index in grid.get((gx, gy), ()):
+                        s = strokes[index]
+                        for point, flipped in ((s.start, False), (s.end, True)):
+                            d = _distance(position, point)
+                            if d < best_distance or (d == best_distance and best is not None and index < best):
+                                best, best_distance, best_reversed = index, d, flipped
+            # Cells further out than the current ring cannot hold anything closer
+            if best is not None and best_distance <= ring * cell:
+                break
+            ring += 1
+        if best is None:
+            best = min(remaining)
+        remaining.discard(best)
+        for point in (strokes[best].start, strokes[best].end):
+            grid[(int(point[0] // cell), int(point[1] // cell))].discard(best)
+        if best_reversed:
+            strokes[best].reverse()
+        order.append(strokes[best])
+        position = strokes[best].end
+    return order
+
+
+def _two_opt(order, start, window=40, time_budget=0.5):
+    """Improve the tour by reversing runs of strokes while that shortens pen-up travel."""
+    deadline = time.monotonic() + time_budget
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(-1, len(order) - 1):
+            a = start if i < 0 else order[i].end
+            for j in range(i + 2, min(len(order), i + 1 + window)):
+                b = order[i + 1].start
+                c = order[j].end
+                d = order[j + 1].start if j + 1 < len(order) else None
+                before = _distance(a, b) + (_distance(c, d) if d else 0)
+                after = _distance(a, c) + (_distance(b, d) if d else 0)
+                if after < before - 1e-9:
+                    order[i + 1:j + 1] = order[i + 1:j + 1][::-1]
+                    for stroke in order[i + 1:j + 1]:
+                        stroke.reverse()
+                    improved = True
+            if time.monotonic() >= deadline:
+                break
+    return order
+
+
+def _travel(order, start):
+    total = 0.0
+    position = start
+    for stroke in order:
+        total += _distance(position, stroke.start)
+        position = stroke.end
+    return total
+
+
+def _lifts(order, merge_tolerance):
+    lifts = len(order)
+    for previous, stroke in zip(order, order[1:]):
+        if _distance(previous.end, stroke.start) <= merge_tolerance:
+            lifts -= 1
+    return lifts
+
+
+def _emit(header, order, footer, merge_tolerance):
+    lines = list(header)
+    pen_down = False
+    feed = None
+    for index, stroke in enumerate(order):
+        if not pen_down:
+            lines.append(f"G0 X{stroke.start[2]} Y{stroke.start[3]}")
+            lines.append(stroke.pen_down)
+            pen_down = True
+            feed = None
+        for point, segment_feed in zip(stroke.points[1:], stroke.feeds[1:]):
+            if segment_feed != feed and segment_feed is not None:
+                lines.append(f"G1 X{point[2]} Y{point[3]} F{segment_feed}")
+                feed = segment_feed
+            else:
+                lines.append(f"G1 X{point[2]} Y{point[3]}")
+        following = order[index + 1] if index + 1 < len(order) else None
+        # Keep the pen down when the next stroke starts where this one ends
+        if following is None or _distance(stroke.end, following.start) > merge_tolerance:
+            lines.append(stroke.pen_up)
+            pen_down = False
+    lines.extend(footer)
+    return "\n".join(lines)
+
+
+def optimize_gcode(gcode_text, z_drawing_height, z_safe_height, tolerance=0.01, merge_tolerance=0.001,
+                   machine=None, time_budget=0.5):
+    """Reorder, reverse and merge pen strokes to cut pen-up travel and lifts.
+
+    Returns the optimized program (one command per line) and a report with the
+    estimated time saved. Both estimates come from the simulator with the
+    plotter's `machine` limits, so they equal what /simulate reports for the
+    two programs. Programs the optimizer does not understand are returned
+    unchanged with `optimized` set to False.
+    """
+    started = time.perf_counter()
+    try:
+        header, strokes, footer = _parse_program(iter_commands(gcode_text), z_drawing_height, z_safe_height)
+    except (_Unsupported, ValueError) as e:
+        return gcode_text, {"optimized": False, "reason": str(e)}
+    if not strokes:
+        return gcode_text, {"optimized": False, "reason": "no strokes"}
+
+    origin = (0.0, 0.0)
+    machine = machine or MachineLimits()
+    lifts_before = _lifts(strokes, merge_tolerance)
+    travel_before = _travel(strokes, origin)
+    points_before = sum(len(stroke.points) for stroke in strokes)
+
+    removed = sum(_simplify(stroke, tolerance) for stroke in strokes)
+    order = _nearest_neighbour(list(strokes), origin)
+    order = _two_opt(order, origin, time_budget=time_budget)
+
+    lifts_after = _lifts(order, merge_tolerance)
+    optimized_text = _emit(header, order, footer, merge_tolerance)
+    seconds_before = simulate(gcode_text, machine)["estimated_seconds"]
+    seconds_after = simulate(optimized_text, machine)["estimated_seconds"]
+
+    report = {
+        "optimized": True,
+        "strokes": len(strokes),
+        "pen_lifts_before": lifts_before,
+        "pen_lifts_after": lifts_after,
+        "travel_mm_before": round(travel_before, 3),
+        "travel_mm_after": round(_travel(order, origin), 3),
+        "points_before": points_before,
+        "points_removed": removed,
+        "estimated_seconds_before": round(seconds_before, 3),
+        "estimated_seconds_after": round(seconds_after, 3),
+        "estimated_seconds_saved": round(seconds_before - seconds_after, 3),
+        "optimizer_seconds": round(time.perf_counter() - started, 4)
+    }
+    return optimized_text, report
+
+
+def optimize_for_config(gcode_text, config, machine=None):
+    """Optimize a job the way config.json asks for, with its pen heights and optimizer_tolerance.
+
+    `machine` are the plotter limits of the time estimate, read from the
+    config if not given. Returns the program and the optimizer's report, or
+    the program unchanged and None if `optimize_gcode` is off or the pen
+    heights are not set.
+    """
+    if not config.get('optimize_gcode', True) or 'z_drawing_height' not in config or 'z_safe_height' not in config:
+        return gcode_text, None
+    return optimize_gcode(gcode_text, config['z_drawing_height'], config['z_safe_height'],
+                          tolerance=config.get('optimizer_tolerance', 0.01),
+                          machine=machine or MachineLimits.from_config(config))
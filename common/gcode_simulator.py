@@ -0,0 +1,209 @@
+import time
+
+import numpy as np
+
+from common.gcode_lexer import TOKEN, iter_words, NEWLINE
+
+# GRBL-like defaults for machines without a "machine" section in config.json
+DEFAULT_MAX_RATE = {"x": 3000, "y": 3000, "z": 600}
+DEFAULT_ACCELERATION = {"x": 200, "y": 200, "z": 100}
+DEFAULT_JUNCTION_DEVIATION = 0.01
+
+AXES = "xyz"
+INCH = 25.4
+
+
+class MachineLimits:
+    """Per-axis limits of the plotter, as GRBL's $110-$112, $120-$122 and $11 settings.
+
+    `max_rate` is in mm/min, `acceleration` in mm/s^2 and `junction_deviation` in mm.
+    """
+
+    def __init__(self, max_rate=None, acceleration=None, junction_deviation=DEFAULT_JUNCTION_DEVIATION):
+        max_rate = dict(DEFAULT_MAX_RATE, **(max_rate or {}))
+        acceleration = dict(DEFAULT_ACCELERATION, **(acceleration or {}))
+        # Internally everything is in mm/s and mm/s^2
+        self.max_rate = np.array([max_rate[axis] / 60.0 for axis in AXES])
+        self.acceleration = np.array([float(acceleration[axis]) for axis in AXES])
+        self.junction_deviation = float(junction_deviation)
+
+    @classmethod
+    def from_config(cls, config):
+        machine = config.get('machine', {})
+        return cls(machine.get('max_rate'), machine.get('acceleration'),
+                   machine.get('junction_deviation', DEFAULT_JUNCTION_DEVIATION))
+
+
+def _parse(gcode_text):
+    """Turn a program into arrays of move targets, feeds (mm/s, 0 for rapids), dwell time and arc count."""
+    targets = []
+    feeds = []
+    x = y = z = 0.0
+    feed = 0.0
+    motion = 0
+    absolute = True
+    scale = 1.0
+    dwell = 0.0
+    dwelling = False
+    moved = False
+    arcs = 0
+
+    # The lexer's token regex is used directly, without its generators: on 100k line programs
+    # the per-word overhead dominates. A command ends at a newline or the next G word like in iter_commands
+    for newline, letter, value in _tokens(gcode_text):
+        if newline or letter in "Gg":
+            if moved:
+                targets.append((x, y, z))
+                feeds.append(0.0 if motion == 0 else feed)
+                if motion > 1:
+                    # Arcs are rare in our programs, they are timed as straight moves to their end point
+                    arcs += 1
+                moved = False
+            dwelling = False
+            if newline:
+                continue
+        if not letter:
+            continue
+        if letter > "Z":
+            letter = letter.upper()
+        if letter == "X":
+            x = float(value) * scale if absolute else x + float(value) * scale
+            moved = not dwelling
+        elif letter == "Y":
+            y = float(value) * scale if absolute else y + float(value) * scale
+            moved = not dwelling
+        elif letter == "Z":
+            z = float(value) * scale if absolute else z + float(value) * scale
+            moved = not dwelling
+        elif letter == "F":
+            feed = float(value) * scale / 60.0
+        elif letter == "G":
+            code = float(value)
+            if code in (0, 1, 2, 3):
+                motion = int(code)
+            elif code == 4:
+                dwelling = True
+            elif code == 20:
+                scale = INCH
+            elif code == 21:
+                scale = 1.0
+            elif code == 90:
+                absolute = True
+            elif code == 91:
+                absolute = False
+        elif letter == "P" and dwelling:
+            dwell += float(value)
+    if moved:
+        targets.append((x, y, z))
+        feeds.append(0.0 if motion == 0 else feed)
+        arcs += motion > 1
+
+    return np.array(targets, dtype=float).reshape(-1, 3), np.array(feeds, dtype=float), dwell, arcs
+
+
+def _tokens(gcode_text):
+    if isinstance(gcode_text, str):
+        return TOKEN.findall(gcode_text)
+    # Chunked input goes through the lexer, NEWLINE becomes a newline token again
+    return (("\n", "", "") if word is NEWLINE else ("",) + word for word in iter_words(gcode_text))
+
+
+def _plan(starts, ends, feeds, machine):
+    """Entry and exit speeds of every segment under GRBL's look-ahead planner.
+
+    GRBL caps the speed at each junction by the junction deviation, then runs
+    a backward pass (every block must be able to stop in time) and a forward
+    pass (every block can only reach what acceleration allows). Both passes
+    are min-plus recurrences over squared speeds, w[j] = min(limit[j], w[j+1] + 2aL),
+    which prefix sums and a cumulative minimum solve without a Python loop.
+    """
+    delta = ends - starts
+    lengths = np.linalg.norm(delta, axis=1)
+    units = delta / lengths[:, None]
+    abs_units = np.abs(units)
+    with np.errstate(divide='ignore'):
+        # The fastest speed and acceleration along the segment that keeps every axis within its limit
+        axis_rate = np.min(np.where(abs_units > 0, machine.max_rate / abs_units, np.inf), axis=1)
+        accelerations = np.min(np.where(abs_units > 0, machine.acceleration / abs_units, np.inf), axis=1)
+    nominal = np.where(feeds > 0, np.minimum(feeds, axis_rate), axis_rate)
+
+    count = len(lengths)
+    # Squared speed limits at the count + 1 junctions, the machine starts and ends at rest
+    limits = np.zeros(count + 1)
+    if count > 1:
+        cos_theta = -np.einsum('ij,ij->i', units[:-1], units[1:])
+        cos_theta = np.clip(cos_theta, -1.0, 1.0)
+        sin_theta_d2 = np.sqrt(0.5 * (1.0 - cos_theta))
+        junction_acceleration = np.minimum(accelerations[:-1], accelerations[1:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            junction = junction_acceleration * machine.junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2)
+        # Straight continuations are only limited by the nominal speeds, full reversals stop
+        junction = np.where(cos_theta < -0.999999, np.inf, junction)
+        junction = np.where(cos_theta > 0.999999, 0.0, junction)
+        limits[1:-1] = np.minimum(junction, np.minimum(nominal[:-1], nominal[1:]) ** 2)
+
+    # S[j] = sum of 2aL over the segments before junction j
+    reach = 2.0 * accelerations * lengths
+    prefix = np.concatenate(([0.0], np.cumsum(reach)))
+    backward = np.minimum.accumulate((limits + prefix)[::-1])[::-1] - prefix
+    forward = np.minimum.accumulate(backward - prefix) + prefix
+    speeds = np.sqrt(np.maximum(forward, 0.0))
+    return lengths, nominal, accelerations, speeds[:-1], speeds[1:]
+
+
+def _segment_times(lengths, nominal, accelerations, entry, exit):
+    """Time of every segment for a trapezoidal (or triangular) speed profile."""
+    accelerate = (nominal ** 2 - entry ** 2) / (2 * accelerations)
+    decelerate = (nominal ** 2 - exit ** 2) / (2 * accelerations)
+    cruise = lengths - accelerate - decelerate
+    trapezoid = (nominal - entry) / accelerations + (nominal - exit) / accelerations + np.maximum(cruise, 0) / nominal
+    peak = np.sqrt(np.maximum((2 * accelerations * lengths + entry ** 2 + exit ** 2) / 2, 0))
+    triangle = (peak - entry) / accelerations + (peak - exit) / accelerations
+    return np.where(cruise >= 0, trapezoid, triangle)
+
+
+def simulate(gcode_text, machine=None, coaster=None):
+    """Estimate how long a program takes on the plotter and where it draws.
+
+    `coaster` is ((min_x, min_y), (max_x, max_y)); when given, the report
+    says whether every drawing move stays on it. Returns a JSON-ready dict.
+    """
+    started = time.perf_counter()
+    machine = machine or MachineLimits()
+    targets, feeds, dwell, arcs = _parse(gcode_text)
+    starts = np.vstack(([[0.0, 0.0, 0.0]], targets[:-1])) if len(targets) else targets
+    moving = np.linalg.norm(targets - starts, axis=1) > 1e-9 if len(targets) else np.zeros(0, dtype=bool)
+    starts, ends, feeds = starts[moving], targets[moving], feeds[moving]
+
+    seconds = dwell
+    report = {"segments": int(len(ends))}
+    if len(ends):
+        lengths, nominal, accelerations, entry, exit = _plan(starts, ends, feeds, machine)
+        seconds += float(np.sum(_segment_times(lengths, nominal, accelerations, entry, exit)))
+        xy_lengths = np.linalg.norm((ends - starts)[:, :2], axis=1)
+        # Drawing moves are feed moves in XY, everything else is travel or pen movement
+        drawing = (feeds > 0) & (xy_lengths > 1e-9)
+        report["draw_mm"] = round(float(np.sum(xy_lengths[drawing])), 3)
+        report["travel_mm"] = round(float(np.sum(xy_lengths[~drawing])), 3)
+        report["z_mm"] = round(float(np.sum(np.abs(ends[:, 2] - starts[:, 2]))), 3)
+        if drawing.any():
+            drawn = np.vstack((starts[drawing], ends[drawing]))
+            low, high = drawn.min(axis=0), drawn.max(axis=0)
+            report["drawing_bounds"] = {"min_x": round(float(low[0]), 3), "min_y": round(float(low[1]), 3),
+                                        "max_x": round(float(high[0]), 3), "max_y": round(float(high[1]), 3)}
+            if coaster is not None:
+                (min_x, min_y), (max_x, max_y) = coaster
+                report["within_coaster"] = bool(low[0] >= min_x and low[1] >= min_y
+                                                and high[0] <= max_x and high[1] <= max_y)
+    else:
+        report.update({"draw_mm": 0.0, "travel_mm": 0.0, "z_mm": 0.0})
+    report["estimated_seconds"] = round(seconds, 3)
+    if arcs:
+        report["arcs_approximated"] = arcs
+    report["simulator_seconds"] = round(time.perf_counter() - started, 4)
+    return report
+
+
+def coaster_from_config(config):
+    return ((config['lower_left_corner_x'], config['lower_left_corner_y']),
+            (config['upper_right_corner_x'], config['upper_right_corner_y']))
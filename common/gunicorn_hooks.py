@@ -0,0 +1,11 @@
+# gunicorn settings of the services, passed to gunicorn with --config by common/serving.py
+
+
+def worker_exit(server, worker):
+    # Runs in the worker once gunicorn has stopped taking requests and finished the ones in flight,
+    # the shutdown hooks of the service then finish their own work, e.g. callbacks in the outbox
+    from common.metrics import REGISTRY
+    from common.serving import run_shutdown_hooks
+    run_shutdown_hooks(server.cfg.graceful_timeout, worker.log)
+    # The counts of the exited worker stay in the service's totals
+    REGISTRY.dump()
@@ -0,0 +1,427 @@
+import bisect
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, jsonify, request
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Carries an order's trace id from service to service, a `trace_id` field in the body or query works too
+TRACE_HEADER = "X-Trace-Id"
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# Set by common/serving.py for gunicorn workers: the directory where every worker keeps its values
+MULTIPROCESS_ENV = "METRICS_MULTIPROCESS_DIR"
+# Seconds between two dumps of a worker's values, the other workers' part of a scrape is at most that old
+DUMP_INTERVAL = 1.0
+
+# Seconds, from a cache hit to a long drawing
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """The metrics of this process and the spans of recent traces.
+
+    While `enabled` is False, which `install` sets from config.json, every
+    update returns after one attribute check and no request hook is
+    registered, so instrumented code costs next to nothing.
+
+    Under gunicorn every worker has its own registry; `share` makes each
+    worker dump its values into a directory, and a scrape of any worker
+    adds up the values of all of them.
+    """
+
+    def __init__(self, max_traces=1000):
+        self.enabled = False
+        self.service = None
+        self.metrics = []
+        self.lock = threading.Lock()
+        # Spans by trace id, the oldest traces are forgotten first
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+        # The file of this process in the shared directory, None in a single process
+        self.path = None
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def share(self, directory):
+        """Dump this process's values into `directory` every DUMP_INTERVAL seconds and add the other files' values to scrapes."""
+        # The pid alone could be reused by a later worker and overwrite the counts of an exited one
+        self.path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        threading.Thread(target=self._dump_periodically, daemon=True, name="metrics-dump").start()
+
+    def _dump_periodically(self):
+        while True:
+            time.sleep(DUMP_INTERVAL)
+            try:
+                self.dump()
+            except Exception:
+                logger.exception("Dumping the metrics to %s failed", self.path)
+
+    def dump(self):
+        """Write the current values to this process's file, e.g. a last time when the worker exits."""
+        if self.path is None:
+            return
+        with self.lock:
+            metrics = list(self.metrics)
+        values = {}
+        for metric in metrics:
+            try:
+                values[metric.name] = [[list(key), value] for key, value in metric.current().items()]
+            except Exception:
+                # Logged by the next scrape of this worker
+                continue
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as dump_file:
+            json.dump({"pid": os.getpid(), "values": values}, dump_file)
+        os.replace(temporary_path, self.path)
+
+    def _other_processes(self):
+        # (whether the process still runs, its values by metric name) for every other file in the directory
+        directory = os.path.dirname(self.path)
+        others = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(".json") or path == self.path:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as dump_file:
+                    data = json.load(dump_file)
+            except (OSError, ValueError):
+                continue
+            others.append((_running(data["pid"]), data["values"]))
+        return others
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        others = self._other_processes() if self.path is not None else []
+        lines = []
+        for metric in metrics:
+            try:
+                values = metric.current()
+                if others:
+                    values = metric.merge(values, [(running, dumped.get(metric.name, ())) for running, dumped in others])
+                samples = list(metric.samples(values))
+            except Exception:
+                # A collector whose source is unavailable must not break the whole page
+                logger.exception("Collecting metric %s failed", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def record_span(self, trace_id, stage, started_at, seconds):
+        span = {"service": self.service, "stage": stage, "started_at": started_at, "seconds": round(seconds, 6)}
+        with self.lock:
+            spans = self.traces.get(trace_id)
+            if spans is None:
+                spans = self.traces[trace_id] = []
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+            spans.append(span)
+        logger.info("trace=%s service=%s stage=%s seconds=%.6f", trace_id, self.service, stage, seconds)
+
+    def spans(self, trace_id):
+        with self.lock:
+            return list(self.traces.get(trace_id, ()))
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+    # Whether the values of exited worker processes still count, as for counters, or only running ones
+    cumulative = False
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def current(self):
+        """The values of this process by tuple of label values."""
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values, others):
+        """Combine this process's values with those the other workers dumped, as (running, [[key, value], ...])."""
+        gathered = {key: [value] for key, value in values.items()}
+        for running, samples in others:
+            if running or self.cumulative:
+                for key, value in samples:
+                    gathered.setdefault(tuple(key), []).append(value)
+        return {key: self._combine(parts) for key, parts in gathered.items()}
+
+    def _combine(self, parts):
+        return sum(parts)
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name, zip(self.labels, key), value
+
+
+class Counter(_Metric):
+    kind = "counter"
+    cumulative = True
+
+    def inc(self, amount=1, **labels):
+        if not REGISTRY.enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not REGISTRY.enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    cumulative = True
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not REGISTRY.enabled:
+            return
+        key = self._key(labels)
+        # Counts per bucket, made cumulative when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block took, and record it as a span of the current trace, e.g. "svg2gcode"."""
+        if not REGISTRY.enabled:
+            yield
+            return
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(seconds, **labels)
+            trace_id = current_trace_id()
+            if trace_id:
+                stage = self.name[:-len("_seconds")] if self.name.endswith("_seconds") else self.name
+                REGISTRY.record_span(trace_id, stage, started_at, seconds)
+
+    def current(self):
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+    def _combine(self, parts):
+        return [sum(counts) for counts in zip(*parts)]
+
+    def samples(self, values):
+        for key, counts in values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + [("le", bound)], cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Collector(_Metric):
+    """A metric read from its source on every scrape, e.g. a queue length.
+
+    `collect()` returns a number, or a dict of numbers by label value (by
+    tuple of label values for several labels); None leaves the metric out.
+    Across gunicorn workers the running workers' values are added up, or
+    averaged with `aggregate="mean"`, e.g. for a ratio.
+    """
+
+    def __init__(self, name, help, collect, labels=(), kind="gauge", aggregate="sum"):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+        self.aggregate = aggregate
+        # A worker's counts since its start stay in the total once it has exited
+        self.cumulative = kind == "counter"
+
+    def current(self):
+        values = self.collect()
+        if values is None:
+            return {}
+        if not isinstance(values, dict):
+            return {(): values}
+        return {key if isinstance(key, tuple) else (key,): value
+                for key, value in values.items() if value is not None}
+
+    def _combine(self, parts):
+        return sum(parts) / len(parts) if self.aggregate == "mean" else sum(parts)
+
+
+def counter(name, help, labels=()):
+    return Counter(name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return Gauge(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return Histogram(name, help, labels, buckets)
+
+
+def collector(name, help, collect, labels=(), kind="gauge", aggregate="sum"):
+    return Collector(name, help, collect, labels, kind, aggregate)
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    if isinstance(value, float):
+        value = _format_value(value)
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _incoming_trace_id():
+    trace_id = request.headers.get(TRACE_HEADER) or request.args.get("trace_id")
+    if not trace_id:
+        # Bodies are only looked at when they are parsed anyway, a binary job is never read here
+        if request.mimetype == "application/x-www-form-urlencoded":
+            trace_id = request.form.get("trace_id")
+        elif request.is_json:
+            data = request.get_json(silent=True)
+            trace_id = data.get("trace_id") if isinstance(data, dict) else None
+    if isinstance(trace_id, str) and TRACE_ID_PATTERN.match(trace_id):
+        return trace_id
+    return None
+
+
+def current_trace_id():
+    """The trace id of the request being handled, None outside a traced request."""
+    if not REGISTRY.enabled or not has_request_context():
+        return None
+    return g.get("trace_id")
+
+
+def start_trace():
+    """The current request's trace id, a new one if the request came without, e.g. for a new order."""
+    if not REGISTRY.enabled:
+        return None
+    if g.get("trace_id") is None:
+        g.trace_id = uuid.uuid4().hex
+    return g.trace_id
+
+
+def record_span(trace_id, stage, started_at, seconds):
+    """Add a stage that did not run in a request, e.g. a queued drawing, to a trace."""
+    if REGISTRY.enabled and trace_id:
+        REGISTRY.record_span(trace_id, stage, started_at, seconds)
+
+
+def install(app, service, enabled=True):
+    """Serve /metrics and /traces/<trace_id> and time every request of `app` by endpoint.
+
+    A request that carries a trace id, or starts one, gets it back in the
+    X-Trace-Id header and leaves a span with its duration in the trace.
+    """
+    REGISTRY.service = service
+    REGISTRY.enabled = bool(enabled)
+    if not enabled:
+        return
+    if os.environ.get(MULTIPROCESS_ENV):
+        REGISTRY.share(os.environ[MULTIPROCESS_ENV])
+
+    latency = histogram("http_request_duration_seconds", "Time to handle a request, by endpoint",
+                        ("endpoint", "method", "status"))
+
+    @app.before_request
+    def start_request():
+        g.metrics_started_at = time.time()
+        g.metrics_start = time.perf_counter()
+        g.trace_id = _incoming_trace_id()
+
+    @app.after_request
+    def finish_request(response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        # The route pattern, e.g. /jobs/<job_id>, keeps the number of series bounded
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        latency.observe(seconds, endpoint=endpoint, method=request.method, status=response.status_code)
+        trace_id = g.get("trace_id")
+        if trace_id:
+            response.headers[TRACE_HEADER] = trace_id
+            REGISTRY.record_span(trace_id, f"{request.method} {endpoint}", g.metrics_started_at, seconds)
+        return response
+
+    def metrics_endpoint():
+        return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+    def trace_endpoint(trace_id):
+        spans = REGISTRY.spans(trace_id)
+        if not spans:
+            return jsonify({"status": "error", "message": f"No spans of trace '{trace_id}' in {service}."}), 404
+        return jsonify({"trace_id": trace_id, "spans": spans}), 200
+
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint, methods=["GET"])
+    app.add_url_rule("/traces/<trace_id>", "trace", trace_endpoint, methods=["GET"])
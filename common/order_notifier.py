@@ -0,0 +1,78 @@
+import logging
+import socket
+import threading
+import time
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5010
+
+logger = logging.getLogger(__name__)
+
+
+class OrderNotifier:
+    """Wakes up requests long-polling for an order as soon as one was queued.
+
+    The order creation service calls `notify` after queueing an order, which
+    sends one UDP datagram to the order management service on the local
+    machine. There `listen` receives it and wakes every thread blocked in
+    `wait_for`, which then tries to take the order from the queue. The queue
+    stays the only place orders live: a lost datagram, or a second process
+    that could not bind the port, only means the order is found by the next
+    poll, every `poll_interval` seconds.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, poll_interval=1.0):
+        self.address = (host, port)
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def notify(self):
+        """Tell the listening process that an order was queued, never fails."""
+        try:
+            self.sender.sendto(b"order", self.address)
+        except OSError:
+            pass
+
+    def listen(self):
+        """Receive notifications in a background thread, False if another process listens already."""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(self.address)
+        except OSError as e:
+            receiver.close()
+            logger.warning("Not listening for order notifications on %s:%s (%s), polling instead", *self.address, e)
+            return False
+        threading.Thread(target=self._receive, args=(receiver,), name="order-notifier", daemon=True).start()
+        return True
+
+    def wake(self):
+        """Wake up the waiting threads of this process, e.g. after an order was released."""
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait_for(self, take, timeout):
+        """Call `take()` until it returns an order or `timeout` seconds passed, returns the order or None."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                generation = self.generation
+            order = take()
+            if order is not None:
+                return order
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self.condition:
+                # A notification that arrived while take() ran is not missed, the generation moved on
+                self.condition.wait_for(lambda: self.generation != generation, min(remaining, self.poll_interval))
+
+    def _receive(self, receiver):
+        while True:
+            try:
+                receiver.recvfrom(64)
+            except OSError:
+                continue
+            self.wake()
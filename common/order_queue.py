@@ -0,0 +1,241 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from common.sqlite_util import connect, Transaction
+
+DEFAULT_QUEUE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "order-creation-service", "orders.db"))
+
+# Conversion states of an order converted ahead of time by the order creation service
+CONVERSION_PENDING = "pending"
+CONVERSION_READY = "ready"
+CONVERSION_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL UNIQUE,
+    priority INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    payload TEXT NOT NULL,
+    claim_token TEXT,
+    claimed_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    conversion TEXT,
+    overtaken INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added after the first version, with their definitions
+ADDED_COLUMNS = {"conversion": "TEXT", "overtaken": "INTEGER NOT NULL DEFAULT 0"}
+
+# Created after databases of earlier versions got the added columns
+INDEXES = """
+DROP INDEX IF EXISTS orders_ready;
+DROP INDEX IF EXISTS orders_next;
+-- Orders that can be handed out by priority, then enqueue order: the head of the queue is the first index
+-- entry. Orders whose conversion failed are never handed out
+CREATE INDEX IF NOT EXISTS orders_head ON orders (priority DESC, seq)
+    WHERE claimed_until IS NULL AND conversion IS NOT 'failed';
+-- Converted orders that can be handed out, the ones that may go ahead of an unconverted head
+CREATE INDEX IF NOT EXISTS orders_converted ON orders (priority, seq)
+    WHERE claimed_until IS NULL AND conversion IS 'ready';
+-- Claimed orders by expiry, so expired claims are found without a table scan
+CREATE INDEX IF NOT EXISTS orders_claimed ON orders (claimed_until) WHERE claimed_until IS NOT NULL;
+"""
+
+
+class OrderQueue:
+    """Durable order queue in an SQLite database shared by the order services.
+
+    Orders are claimed highest priority first and first-in first-out within a
+    priority. A claimed order stays in the queue, invisible to other workers,
+    until it is acknowledged with its claim token; claims that are not
+    acknowledged within `visibility_timeout` seconds make the order available
+    again. Claiming is a single indexed lookup inside a write transaction, so
+    any number of threads and processes can dequeue concurrently.
+
+    Orders can carry their G-code, converted while they waited
+    (`set_conversion`). Within a priority, a converted order goes ahead of
+    an older unconverted head of the queue, but at most `max_overtaken`
+    orders go ahead of any one, so an order that cannot be converted is not
+    held back by converted ones arriving behind it. Orders whose conversion
+    failed stay in the queue, flagged, and are never handed out.
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH, visibility_timeout=300, max_overtaken=3):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_overtaken = max_overtaken
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(orders)")]
+        for column, definition in ADDED_COLUMNS.items():
+            if column not in columns:
+                try:
+                    connection.execute(f"ALTER TABLE orders ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError:
+                    # The other order service added it meanwhile
+                    pass
+        connection.executescript(INDEXES)
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = connect(self.path)
+        return connection
+
+    def _transaction(self):
+        return Transaction(self._connection())
+
+    def enqueue(self, order_data, priority=0, conversion=None):
+        """Add an order and return its order_id, creating one if the order has none."""
+        order_id = order_data.get("order_id") or str(uuid.uuid4())
+        order_data = dict(order_data, order_id=order_id)
+        if conversion:
+            order_data["conversion"] = conversion
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO orders (order_id, priority, enqueued_at, payload, conversion) VALUES (?, ?, ?, ?, ?)",
+                (order_id, int(priority), time.time(), json.dumps(order_data), conversion)
+            )
+        return order_id
+
+    def set_conversion(self, order_id, conversion, result=None):
+        """Store the outcome of an order's conversion with the order, `result` is merged into its data.
+
+        `conversion` None makes it an order without conversion again. False
+        if the order has left the queue meanwhile.
+        """
+        with self._transaction() as connection:
+            row = connection.execute("SELECT payload FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if row is None:
+                return False
+            order_data = dict(json.loads(row[0]), **(result or {}))
+            order_data.pop("conversion", None)
+            if conversion:
+                order_data["conversion"] = conversion
+            connection.execute(
+                "UPDATE orders SET payload = ?, conversion = ? WHERE order_id = ?",
+                (json.dumps(order_data), conversion, order_id)
+            )
+        return True
+
+    def failed(self):
+        """Orders held back because their conversion failed, oldest first."""
+        rows = self._connection().execute(
+            "SELECT payload, enqueued_at FROM orders WHERE conversion = ? ORDER BY seq", (CONVERSION_FAILED,)
+        ).fetchall()
+        return [dict(json.loads(payload), enqueued_at=enqueued_at) for payload, enqueued_at in rows]
+
+    def discard(self, order_id):
+        """Remove an order whose conversion failed, False if there is none with that id."""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "DELETE FROM orders WHERE order_id = ? AND conversion = ?", (order_id, CONVERSION_FAILED)
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, visibility_timeout=None, token=None):
+        """Claim the next order, returns (order_data, claim_token) or None if the queue is empty.
+
+        `token` is the claim token to use instead of a new random one, and a
+        `visibility_timeout` of math.inf makes a claim that never expires.
+        """
+        timeout = self.visibility_timeout if visibility_timeout is None else visibility_timeout
+        now = time.time()
+        with self._transaction() as connection:
+            row = self._next(connection, now)
+            if row is None:
+                return None
+            token = token or uuid.uuid4().hex
+            connection.execute(
+                "UPDATE orders SET claim_token = ?, claimed_until = ?, attempts = attempts + 1 WHERE seq = ?",
+                (token, now + timeout, row[0])
+            )
+        return json.loads(row[1]), token
+
+    def ack(self, order_id, claim_token):
+        """Remove a claimed order for good. False if the claim expired and was taken over."""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "DELETE FROM orders WHERE order_id = ? AND claim_token = ?", (order_id, claim_token)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, order_id, claim_token):
+        """Give a claimed order back to the queue right away."""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE orders SET claim_token = NULL, claimed_until = NULL WHERE order_id = ? AND claim_token = ?",
+                (order_id, claim_token)
+            )
+        return cursor.rowcount == 1
+
+    def pop(self):
+        """Claim and acknowledge the next order in one step, returns the order or None."""
+        with self._transaction() as connection:
+            row = self._next(connection, time.time())
+            if row is None:
+                return None
+            connection.execute("DELETE FROM orders WHERE seq = ?", (row[0],))
+        return json.loads(row[1])
+
+    def stats(self):
+        now = time.time()
+        connection = self._connection()
+        ready, converted, claimed, failed = connection.execute(
+            "SELECT COUNT(*) FILTER (WHERE (claimed_until IS NULL OR claimed_until < ?) AND conversion IS NOT 'failed'), "
+            "COUNT(*) FILTER (WHERE (claimed_until IS NULL OR claimed_until < ?) AND conversion IS 'ready'), "
+            "COUNT(*) FILTER (WHERE claimed_until >= ?), "
+            "COUNT(*) FILTER (WHERE conversion IS 'failed') FROM orders", (now, now, now)
+        ).fetchone()
+        # converted is the part of ready that carries its G-code
+        return {"ready": ready, "converted": converted, "claimed": claimed, "failed": failed}
+
+    def import_directory(self, directory):
+        """Move orders saved as JSON files by earlier versions into the queue, oldest first."""
+        try:
+            entries = [entry for entry in os.scandir(directory) if entry.name.endswith(".json")]
+        except FileNotFoundError:
+            return 0
+        imported = 0
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            with open(entry.path, 'r') as order_file:
+                order_data = json.load(order_file)
+            self.enqueue(order_data)
+            os.remove(entry.path)
+            imported += 1
+        return imported
+
+    def _next(self, connection, now):
+        # Expired claims go back to the queue first, they keep their original position
+        connection.execute(
+            "UPDATE orders SET claim_token = NULL, claimed_until = NULL "
+            "WHERE claimed_until IS NOT NULL AND claimed_until < ?", (now,)
+        )
+        head = connection.execute(
+            "SELECT seq, payload, priority, conversion IS 'ready', overtaken FROM orders INDEXED BY orders_head "
+            "WHERE claimed_until IS NULL AND conversion IS NOT 'failed' "
+            "ORDER BY priority DESC, seq LIMIT 1"
+        ).fetchone()
+        if head is None:
+            return None
+        seq, payload, priority, ready, overtaken = head
+        if ready or overtaken >= self.max_overtaken:
+            return seq, payload
+        converted = connection.execute(
+            "SELECT seq, payload FROM orders INDEXED BY orders_converted "
+            "WHERE claimed_until IS NULL AND conversion IS 'ready' AND priority = ? "
+            "ORDER BY seq LIMIT 1", (priority,)
+        ).fetchone()
+        if converted is None:
+            return seq, payload
+        connection.execute("UPDATE orders SET overtaken = overtaken + 1 WHERE seq = ?", (seq,))
+        return converted
+
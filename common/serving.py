@@ -0,0 +1,172 @@
+import argparse
+import importlib.util
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from flask import jsonify
+
+from common.configuration import watch_config
+from common.metrics import MULTIPROCESS_ENV
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_THREADS = 8
+DEFAULT_SHUTDOWN_TIMEOUT = 60
+
+# Set once the process is shutting down, /ready answers 503 from then on
+draining = threading.Event()
+_shutdown_hooks = []
+
+
+def on_shutdown(hook):
+    """Register `hook(timeout)`, called on a graceful shutdown before the server stops, e.g. to finish jobs."""
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+def run_shutdown_hooks(timeout, logger):
+    """Drain the process: /ready turns 503 and every hook gets `timeout` seconds to finish its work."""
+    draining.set()
+    for hook in _shutdown_hooks:
+        try:
+            hook(timeout)
+        except Exception:
+            logger.exception("Shutdown hook %r failed", hook)
+
+
+def ready_response(**checks):
+    """Answer of a /ready endpoint: 200 when every check passed and the process is not draining, 503 otherwise."""
+    ready = not draining.is_set() and all(checks.values())
+    body = {"status": "ready" if ready else "not ready", "draining": draining.is_set(), "checks": checks}
+    return jsonify(body), 200 if ready else 503
+
+
+def _server_settings(service):
+    """The "server" section of config.json, with the entry named after the service overriding the shared values."""
+    server = watch_config().current.get('server', {})
+    settings = {key: value for key, value in server.items() if not isinstance(value, dict)}
+    settings.update(server.get(service, {}))
+    return settings
+
+
+def _parse_arguments(settings):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--production', action='store_true', default=settings.get('mode') == 'production',
+                        help="serve with waitress or gunicorn instead of the Flask development server")
+    parser.add_argument('--development', dest='production', action='store_false')
+    parser.add_argument('--workers', type=int, default=settings.get('workers', 1))
+    parser.add_argument('--threads', type=int, default=settings.get('threads', DEFAULT_THREADS))
+    parser.add_argument('--host', default=settings.get('host', DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=settings.get('port'))
+    parser.add_argument('--shutdown-timeout', type=float, default=settings.get('shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT))
+    return parser.parse_known_args()[0]
+
+
+def run(app, service, port, single_process=False):
+    """Start a service the way config.json and the command line ask for.
+
+    Without --production (or "mode": "production" in the "server" section of
+    config.json) this is the Flask development server as before. In
+    production, services that can run as several processes are handed to
+    gunicorn with `workers` processes of `threads` threads each, where
+    gunicorn is available; otherwise, and always for `single_process`
+    services such as the one owning the serial ports, waitress serves the
+    app from this process with `threads` threads. SIGTERM or Ctrl+C drains
+    the process: /ready turns 503, the shutdown hooks get `shutdown_timeout`
+    seconds to finish their work, then the server stops taking connections
+    and gets another `shutdown_timeout` seconds for the requests in flight.
+    Under gunicorn, gunicorn itself stops taking connections on SIGTERM and
+    waits for the requests in flight; the hooks then run in every worker as
+    it exits, through the `worker_exit` hook of common/gunicorn_hooks.py, so
+    /ready does not turn 503 before gunicorn stops accepting.
+    """
+    arguments = _parse_arguments(_server_settings(service))
+    port = arguments.port or port
+    if not arguments.production:
+        app.run(debug=True, host=arguments.host, port=port)
+        return
+
+    if arguments.workers > 1 and not single_process:
+        if os.name == "posix" and importlib.util.find_spec("gunicorn") is not None:
+            _exec_gunicorn(app, service, arguments, port)
+        app.logger.warning("gunicorn is not available, serving %s from a single process", service)
+
+    _serve_waitress(app, service, arguments, port)
+
+
+def _exec_gunicorn(app, service, arguments, port):
+    # The workers import the service module themselves, this process is replaced so that nothing
+    # it started (threads, pools, open files) is inherited by the forked workers
+    service_dir = app.root_path
+    # Every worker keeps its metrics in this directory so that any of them can answer /metrics for all,
+    # emptied so that the counts start again with the service
+    metrics_dir = os.path.join(tempfile.gettempdir(), f"{service}-metrics-{port}")
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    os.environ[MULTIPROCESS_ENV] = metrics_dir
+    os.execv(sys.executable, [
+        sys.executable, "-m", "gunicorn",
+        "--chdir", service_dir,
+        "--workers", str(arguments.workers),
+        "--threads", str(arguments.threads),
+        "--bind", f"{arguments.host}:{port}",
+        "--graceful-timeout", str(int(arguments.shutdown_timeout)),
+        # Loaded by path, the master does not have the repository root on its import path
+        "--config", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn_hooks.py"),
+        "app:app"
+    ])
+
+
+def _serve_waitress(app, service, arguments, port):
+    try:
+        from waitress import create_server, wasyncore
+        from waitress.channel import HTTPChannel
+        from waitress.server import BaseWSGIServer
+    except ImportError:
+        sys.exit("Production mode needs waitress (pip install waitress) or, on Linux and macOS, gunicorn.")
+
+    server = create_server(app, host=arguments.host, port=port, threads=arguments.threads)
+    # The listening sockets and connections, only ever touched by the main loop below
+    socket_map = server.map if hasattr(server, "map") else server._map
+    hooks_done = threading.Event()
+
+    def poll():
+        wasyncore.loop(timeout=server.adj.asyncore_loop_timeout, map=socket_map,
+                       use_poll=server.adj.asyncore_use_poll, count=1)
+
+    def shut_down():
+        run_shutdown_hooks(arguments.shutdown_timeout, app.logger)
+        hooks_done.set()
+
+    def handle_signal(signum, frame):
+        if draining.is_set():
+            # A second signal does not wait for the drain any longer
+            raise SystemExit(1)
+        app.logger.warning("Draining %s before shutting down", service)
+        draining.set()
+        threading.Thread(target=shut_down, name="shutdown", daemon=True).start()
+
+    def requests_in_flight():
+        return any(channel.requests or channel.total_outbufs_len
+                   for channel in list(socket_map.values()) if isinstance(channel, HTTPChannel))
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    app.logger.warning("Serving %s on %s:%s with %d threads", service, arguments.host, port, arguments.threads)
+    while not hooks_done.is_set():
+        poll()
+
+    # No new connections; the responses in flight are still written by this loop
+    for listener in [entry for entry in socket_map.values() if isinstance(entry, BaseWSGIServer)]:
+        wasyncore.dispatcher.close(listener)
+    deadline = time.monotonic() + arguments.shutdown_timeout
+    while requests_in_flight() and time.monotonic() < deadline:
+        poll()
+    if requests_in_flight():
+        app.logger.warning("Stopping %s with requests still in flight", service)
+    server.task_dispatcher.shutdown(timeout=1)
+    wasyncore.close_all(socket_map)
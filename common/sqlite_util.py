@@ -0,0 +1,27 @@
+import sqlite3
+
+
+def connect(path):
+    """A connection in autocommit mode with the write-ahead log, transactions are opened with Transaction."""
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, takes the write lock up front so claims never race."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+        return False
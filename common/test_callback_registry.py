@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+from common.callback_registry import CallbackRegistry
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "callbacks.journal")
+
+
+def fill(registry):
+    for callback_id in ("a", "b", "c", "d"):
+        registry.append(callback_id)
+    assert registry.pop() == "a"
+    registry.push_front("a")
+    assert registry.remove("c")
+    assert not registry.remove("x")
+
+
+def test_journal_is_replayed_on_start(journal_path):
+    fill(CallbackRegistry(journal_path))
+    registry = CallbackRegistry(journal_path)
+    assert registry.snapshot() == ["a", "b", "d"]
+    assert registry.first() == "a"
+    assert len(registry) == 3
+
+
+def test_shared_registries_see_each_others_changes(journal_path):
+    first, second = CallbackRegistry(journal_path), CallbackRegistry(journal_path)
+    first.append("a")
+    second.append("b")
+    assert first.pop() == "a"
+    assert second.snapshot() == ["b"]
+
+
+def test_compaction_keeps_the_live_callbacks(journal_path):
+    registry = CallbackRegistry(journal_path, compact_after=10)
+    other = CallbackRegistry(journal_path, compact_after=10)
+    for i in range(50):
+        registry.append(str(i))
+        if i % 5:
+            assert registry.remove(str(i))
+    with open(journal_path, "rb") as journal:
+        assert len(journal.readlines()) <= 20
+    expected = [str(i) for i in range(0, 50, 5)]
+    # The other registry replays the compacted journal from its start
+    assert other.snapshot() == expected
+    assert CallbackRegistry(journal_path).snapshot() == expected
+
+
+def test_torn_record_of_a_crash_is_dropped(journal_path):
+    CallbackRegistry(journal_path).append("a")
+    with open(journal_path, "ab") as journal:
+        journal.write(b'["+", "http://half')
+    registry = CallbackRegistry(journal_path)
+    assert registry.snapshot() == ["a"]
+    registry.append("b")
+    assert CallbackRegistry(journal_path).snapshot() == ["a", "b"]
+
+
+def test_local_registry_writes_the_same_journal(journal_path):
+    local = CallbackRegistry(journal_path, shared=False)
+    fill(local)
+    assert local.flush(timeout=5)
+    assert CallbackRegistry(journal_path).snapshot() == ["a", "b", "d"]
+    CallbackRegistry(journal_path).append("e")
+    assert CallbackRegistry(journal_path, shared=False).snapshot() == ["a", "b", "d", "e"]
+
+
+def test_legacy_callbacks_file_is_imported(tmp_path, journal_path):
+    legacy_path = tmp_path / "callbacks.json"
+    legacy_path.write_text(json.dumps([{"callback_id": "a"}, {"callback_id": "b"}]))
+    registry = CallbackRegistry(journal_path, legacy_path=str(legacy_path))
+    assert registry.snapshot() == ["a", "b"]
+    assert not os.path.exists(legacy_path)
@@ -0,0 +1,35 @@
+import random
+
+from common.gcode_lexer import BOUNDARY_WINDOW, iter_commands, iter_lines, normalize
+
+PROGRAM = "G21 G90\nG0 X1 Y2 ; travel G1 X3 Y4\ng1 z-0.5 f.5 (pen down\nM3 S100 (spindle) Y5\nG1X+10Y-2.50\n"
+
+
+def test_commands_split_at_lines_and_g_words():
+    assert list(iter_lines(PROGRAM)) == [
+        "G21", "G90", "G0 X1 Y2", "G1 X3 Y4", "G1 Z-0.5 F.5", "M3 S100 Y5", "G1 X+10 Y-2.50"
+    ]
+
+
+def test_words_keep_their_text():
+    assert list(iter_commands("g0 x.50 Y-0")) == [[("G", "0"), ("X", ".50"), ("Y", "-0")]]
+
+
+def test_comment_ends_before_the_next_g_word():
+    # Flattened programs put a whole job on one line, comments included
+    assert normalize("G0 X1 ;move G1 X2 ;draw\tG0 X3") == "G0 X1 G1 X2 G0 X3"
+    assert normalize("G0 X1 ; comment with X9 Y9") == "G0 X1"
+
+
+def test_streamed_chunks_lex_like_the_whole_program():
+    rng = random.Random(7)
+    # Longer than the boundary window without a newline, with comments across chunk borders
+    flat = " ".join(f"G1 X{i}.5 Y-{i} (c{i}) ;note G0 Z{i % 3}" for i in range(200))
+    for text in (PROGRAM * 50, flat):
+        expected = list(iter_lines(text))
+        for size in (1, 7, BOUNDARY_WINDOW - 1, BOUNDARY_WINDOW + 3):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            assert list(iter_lines(iter(chunks))) == expected
+        cuts = sorted(rng.sample(range(len(text)), 60))
+        chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        assert list(iter_lines(chunks)) == expected
@@ -0,0 +1,80 @@
+import math
+
+from common.gcode_lexer import iter_commands
+from common.gcode_optimizer import optimize_gcode
+
+Z_DOWN, Z_UP = 0, 5
+
+
+def program(strokes):
+    lines = ["G21", "G90", f"G0 Z{Z_UP}"]
+    for stroke in strokes:
+        lines.append(f"G0 X{stroke[0][0]} Y{stroke[0][1]}")
+        lines.append(f"G1 Z{Z_DOWN} F500")
+        lines.extend(f"G1 X{x} Y{y} F1500" for x, y in stroke[1:])
+        lines.append(f"G0 Z{Z_UP}")
+    lines.append("M2")
+    return "\n".join(lines)
+
+
+def drawn_polylines(gcode):
+    """The pen-down polylines of a program, as lists of (x, y)."""
+    polylines = []
+    x = y = z = None
+    for words in iter_commands(gcode):
+        values = {letter: float(value) for letter, value in words if letter in "XYZ"}
+        x, y, z = values.get("X", x), values.get("Y", y), values.get("Z", z)
+        if "Z" in values and z == Z_DOWN:
+            polylines.append([(x, y)])
+        elif z == Z_DOWN and ("X" in values or "Y" in values):
+            polylines[-1].append((x, y))
+    return polylines
+
+
+def segments(polylines):
+    return sorted(tuple(sorted((a, b))) for line in polylines for a, b in zip(line, line[1:]))
+
+
+def distance_to_polyline(point, polyline):
+    best = math.inf
+    for (ax, ay), (bx, by) in zip(polyline, polyline[1:]):
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        t = 0 if length == 0 else max(0, min(1, ((point[0] - ax) * dx + (point[1] - ay) * dy) / length))
+        best = min(best, math.hypot(point[0] - ax - t * dx, point[1] - ay - t * dy))
+    return best
+
+
+def test_strokes_are_reordered_and_reversed_without_changing_the_drawing():
+    strokes = [[(90, 90), (80, 90)], [(0, 0), (10, 0)], [(50, 50), (40, 50)], [(10, 0), (20, 0)], [(80, 90), (70, 90)]]
+    gcode = program(strokes)
+    optimized, report = optimize_gcode(gcode, Z_DOWN, Z_UP)
+    assert report["optimized"]
+    assert report["travel_mm_after"] < report["travel_mm_before"]
+    # Strokes that meet end to end are drawn without lifting the pen in between
+    assert report["pen_lifts_after"] == 3
+    assert segments(drawn_polylines(optimized)) == segments(drawn_polylines(gcode))
+    assert optimized.splitlines()[:3] == ["G21", "G90", f"G0 Z{Z_UP}"]
+    assert optimized.splitlines()[-1] == "M2"
+
+
+def test_simplified_strokes_stay_within_tolerance():
+    tolerance = 0.05
+    circle = [(round(50 + 30 * math.cos(i / 100), 4), round(50 + 30 * math.sin(i / 100), 4)) for i in range(629)]
+    # A spike back along the line must not be cut off
+    spike = [(0, 0), (5, 0), (10, 0), (6, 0), (8, 0.001), (20, 0)]
+    gcode = program([circle, spike])
+    optimized, report = optimize_gcode(gcode, Z_DOWN, Z_UP, tolerance=tolerance)
+    assert report["points_removed"] > len(circle) / 2
+    simplified = drawn_polylines(optimized)
+    for original in drawn_polylines(gcode):
+        polyline = next(line for line in simplified if {line[0], line[-1]} == {original[0], original[-1]})
+        assert max(distance_to_polyline(point, polyline) for point in original) <= tolerance + 1e-9
+    assert (10, 0) in next(line for line in simplified if (20, 0) in line)
+
+
+def test_arcs_are_left_unchanged():
+    gcode = program([[(0, 0), (10, 0)]]).replace("M2", "G2 X0 Y0 I5 J0\nM2")
+    optimized, report = optimize_gcode(gcode, Z_DOWN, Z_UP)
+    assert optimized == gcode
+    assert report == {"optimized": False, "reason": "arcs are not supported"}
@@ -0,0 +1,37 @@
+import json
+import os
+
+from common import metrics
+
+
+def test_scrape_adds_up_the_values_of_other_workers(tmp_path, monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    registry.enabled = True
+    registry.path = str(tmp_path / "own.json")
+    jobs = metrics.counter("jobs_total", "Jobs", ("kind",))
+    seconds = metrics.histogram("job_seconds", "Job time", buckets=(1,))
+    metrics.collector("active", "Active jobs", lambda: 2)
+    metrics.collector("hit_ratio", "Hit ratio", lambda: 0.5, aggregate="mean")
+    jobs.inc(3, kind="a")
+    seconds.observe(0.5)
+
+    # One worker still running, the other one has exited
+    running = {"jobs_total": [[["a"], 2], [["b"], 1]], "job_seconds": [[[], [0, 1, 2.0]]],
+               "active": [[[], 1]], "hit_ratio": [[[], 1.0]]}
+    exited = {"jobs_total": [[["a"], 5]], "active": [[[], 7]], "hit_ratio": [[[], 0.0]]}
+    for name, pid, values in (("running", os.getpid(), running), ("exited", 2 ** 22 + 1, exited)):
+        (tmp_path / f"{name}.json").write_text(json.dumps({"pid": pid, "values": values}))
+
+    lines = registry.render().splitlines()
+    assert 'jobs_total{kind="a"} 10' in lines
+    assert 'jobs_total{kind="b"} 1' in lines
+    assert 'job_seconds_bucket{le="1"} 1' in lines
+    assert "job_seconds_count 2" in lines
+    assert "job_seconds_sum 2.5" in lines
+    assert "active 3" in lines
+    assert "hit_ratio 0.75" in lines
+
+    registry.dump()
+    with open(registry.path, "r", encoding="utf-8") as dump_file:
+        assert json.load(dump_file)["values"]["jobs_total"] == [[["a"], 3]]
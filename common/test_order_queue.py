@@ -0,0 +1,118 @@
+import math
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from common.order_queue import CONVERSION_FAILED, CONVERSION_PENDING, CONVERSION_READY, OrderQueue
+
+
+@pytest.fixture
+def order_queue(tmp_path):
+    return OrderQueue(str(tmp_path / "orders.db"))
+
+
+def claimed_ids(order_queue):
+    ids = []
+    while (claimed := order_queue.claim()) is not None:
+        order, token = claimed
+        ids.append(order["order_id"])
+        assert order_queue.ack(order["order_id"], token)
+    return ids
+
+
+def test_orders_are_claimed_by_priority_then_in_order(order_queue):
+    for order_id, priority in (("a", 0), ("b", 1), ("c", 0), ("d", 1)):
+        order_queue.enqueue({"order_id": order_id, "text": order_id}, priority=priority)
+    assert claimed_ids(order_queue) == ["b", "d", "a", "c"]
+    assert order_queue.claim() is None
+
+
+def test_released_and_expired_claims_keep_their_place(order_queue):
+    for order_id in "abc":
+        order_queue.enqueue({"order_id": order_id})
+    order, token = order_queue.claim()
+    assert order_queue.claim()[0]["order_id"] == "b"
+    assert order_queue.release("a", token)
+    assert order_queue.claim()[0]["order_id"] == "a"
+
+    expiring = OrderQueue(order_queue.path, visibility_timeout=0.05)
+    order, token = expiring.claim()
+    assert order["order_id"] == "c"
+    time.sleep(0.1)
+    order, new_token = expiring.claim()
+    assert order["order_id"] == "c"
+    # The first claim was taken over and cannot remove the order any more
+    assert not expiring.ack("c", token)
+    assert expiring.ack("c", new_token)
+
+
+def test_claim_with_own_token_never_expires(order_queue):
+    order_queue.enqueue({"order_id": "a"})
+    order, token = order_queue.claim(visibility_timeout=math.inf, token="http://cpee/callback/1")
+    assert token == "http://cpee/callback/1"
+    assert order_queue.claim() is None
+    assert order_queue.stats()["claimed"] == 1
+    assert order_queue.release("a", "http://cpee/callback/1")
+    assert order_queue.claim()[0]["order_id"] == "a"
+
+
+def test_converted_orders_overtake_an_unconverted_head_a_bounded_number_of_times(tmp_path):
+    order_queue = OrderQueue(str(tmp_path / "orders.db"), max_overtaken=3)
+    order_queue.enqueue({"order_id": "stuck"}, conversion=CONVERSION_PENDING)
+    for i in range(5):
+        order_queue.enqueue({"order_id": f"c{i}"}, conversion=CONVERSION_READY)
+    order_queue.enqueue({"order_id": "urgent"}, priority=1, conversion=CONVERSION_PENDING)
+    assert claimed_ids(order_queue) == ["urgent", "c0", "c1", "c2", "stuck", "c3", "c4"]
+
+
+def test_without_overtaking_the_queue_stays_in_order(tmp_path):
+    order_queue = OrderQueue(str(tmp_path / "orders.db"), max_overtaken=0)
+    order_queue.enqueue({"order_id": "a"}, conversion=CONVERSION_PENDING)
+    order_queue.enqueue({"order_id": "b"}, conversion=CONVERSION_READY)
+    assert claimed_ids(order_queue) == ["a", "b"]
+
+
+def test_failed_conversions_are_held_back(order_queue):
+    order_queue.enqueue({"order_id": "a"}, conversion=CONVERSION_PENDING)
+    order_queue.enqueue({"order_id": "b"})
+    assert order_queue.set_conversion("a", CONVERSION_FAILED, {"error": "Invalid SVG"})
+    assert order_queue.stats() == {"ready": 1, "converted": 0, "claimed": 0, "failed": 1}
+    assert [order["error"] for order in order_queue.failed()] == ["Invalid SVG"]
+    assert claimed_ids(order_queue) == ["b"]
+    assert order_queue.discard("a")
+    assert not order_queue.set_conversion("a", CONVERSION_READY)
+
+
+def test_database_of_the_first_version_is_migrated(tmp_path):
+    path = str(tmp_path / "orders.db")
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE orders (seq INTEGER PRIMARY KEY AUTOINCREMENT, order_id TEXT NOT NULL UNIQUE,
+            priority INTEGER NOT NULL DEFAULT 0, enqueued_at REAL NOT NULL, payload TEXT NOT NULL,
+            claim_token TEXT, claimed_until REAL, attempts INTEGER NOT NULL DEFAULT 0);
+        CREATE INDEX orders_next ON orders (priority DESC, seq) WHERE claimed_until IS NULL;
+        INSERT INTO orders (order_id, enqueued_at, payload) VALUES ('old', 0, '{"order_id": "old"}');
+    """)
+    connection.close()
+    order_queue = OrderQueue(path)
+    order_queue.enqueue({"order_id": "new"}, conversion=CONVERSION_READY)
+    # The converted order goes ahead of the old one, which counts how often it was overtaken
+    assert claimed_ids(order_queue) == ["new", "old"]
+
+
+def test_concurrent_claims_hand_out_every_order_once(order_queue):
+    for i in range(200):
+        order_queue.enqueue({"order_id": str(i)})
+    claimed = []
+
+    def worker():
+        claimed.extend(claimed_ids(order_queue))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed, key=int) == [str(i) for i in range(200)]
@@ -0,0 +1,160 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Flask, Response, request, jsonify
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.configuration import watch_config
+from common.gcode_binary import MIMETYPE, encode
+from common.gcode_compose import compose, ComposeError
+from common.gcode_simulator import MachineLimits, simulate
+from common import metrics
+from common.serving import run, ready_response
+
+app = Flask(__name__)
+
+# config.json, validated once and replaced as a whole when the file changes
+config_watcher = watch_config()
+config = config_watcher.current
+
+# The conversion services the logo and the text of an order are sent to
+SVG_SERVICE_URL = config.get('svg_service_url', "http://127.0.0.1:5003").rstrip('/')
+TEXT_SERVICE_URL = config.get('text_service_url', "http://127.0.0.1:5002").rstrip('/')
+CONVERSION_TIMEOUT = config.get('compositor_timeout', 60)
+
+# Both conversions of an order run at once, on threads shared by all requests
+conversion_executor = ThreadPoolExecutor(max_workers=config.get('compositor_workers', 8), thread_name_prefix="convert")
+# One connection pool per conversion thread, requests sessions are not shared between threads
+sessions = threading.local()
+
+# Plotter limits for the time estimate
+machine_limits = MachineLimits.from_config(config)
+
+
+@config_watcher.subscribe
+def config_changed(old, new):
+    global machine_limits
+    machine_limits = MachineLimits.from_config(new)
+
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "gcode-compositor-service", enabled=config.get('metrics_enabled', True))
+COMPOSE_SECONDS = metrics.histogram("gcode_compose_seconds", "Time to merge and optimize the programs of one order")
+CONVERSION_FAILURES = metrics.counter("compositor_conversion_failures_total", "Conversions of an order that failed, by part",
+                                      ("part",))
+
+
+class ConversionFailed(Exception):
+    """A conversion service did not return G-code; `status` is the answer for the compositor's client."""
+
+    def __init__(self, part, status, message):
+        super().__init__(f"{part} conversion failed: {message}")
+        self.part = part
+        self.status = status
+
+
+#Convert one part of an order with its service, passing the order's trace id on
+def convert(part, url, field, value, trace_id):
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    headers = {"X-Trace-Id": trace_id} if trace_id else {}
+    try:
+        response = session.post(url, data={field: value}, headers=headers, timeout=(3.05, CONVERSION_TIMEOUT))
+    except requests.exceptions.RequestException as e:
+        raise ConversionFailed(part, 502, f"service not reachable ({e})") from None
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code != 200 or body.get("status") != "success":
+        # Bad input and a full converter pool are the client's to handle, anything else is the service's fault
+        status = response.status_code if response.status_code in (400, 429) else 502
+        raise ConversionFailed(part, status, body.get("message") or f"HTTP {response.status_code}")
+    return body["gcode"]
+
+
+#Convert the logo and the text of an order at once, each part as a separate program
+def convert_order(svg_code, text, trace_id=None):
+    futures = []
+    if svg_code:
+        futures.append(("svg", conversion_executor.submit(convert, "svg", f"{SVG_SERVICE_URL}/svg2gcode", "logo", svg_code, trace_id)))
+    if text:
+        futures.append(("text", conversion_executor.submit(convert, "text", f"{TEXT_SERVICE_URL}/text2gcode", "text", text, trace_id)))
+    programs = {}
+    try:
+        for part, future in futures:
+            programs[part] = future.result()
+    except ConversionFailed as e:
+        CONVERSION_FAILURES.inc(part=e.part)
+        for _, future in futures:
+            future.cancel()
+        raise
+    return programs
+
+
+#Merge the programs of an order into one, with the strokes of logo and text ordered together
+def compose_order(programs, config=None):
+    config = config or config_watcher.current
+    with COMPOSE_SECONDS.time():
+        return compose(
+            [programs[part] for part in ("svg", "text") if part in programs],
+            config['z_drawing_height'],
+            config['z_safe_height'],
+            optimize=config.get('optimize_gcode', True),
+            tolerance=config.get('optimizer_tolerance', 0.01),
+            machine=machine_limits
+        )
+
+
+@app.route('/order2gcode', methods=['POST'])
+#One program for one coaster: both conversions at once, merged so that the plotter draws them in one session
+def order_to_gcode():
+    if request.content_type == 'application/json':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.form
+    svg_code = data.get('svg')
+    text = data.get('text')
+    if not svg_code and not text:
+        return jsonify({"status": "error", "message": "SVG code or text is required."}), 400
+
+    config = config_watcher.current
+    if not config.calibrated:
+        return jsonify({"status": "error", "message": "Configuration file is missing or invalid."}), 500
+
+    try:
+        programs = convert_order(svg_code, text, metrics.current_trace_id())
+        gcode, report = compose_order(programs, config)
+    except ConversionFailed as e:
+        return jsonify({"status": "error", "message": str(e), "part": e.part}), e.status
+    except ComposeError as e:
+        # The same order fails the same way every time, unlike an unreachable service
+        return jsonify({"status": "error", "message": f"Cannot merge the programs: {e}"}), 422
+
+    if request.accept_mimetypes.best == MIMETYPE:
+        # grbl-service streams an optimized binary job as it is
+        return Response(encode(gcode, machine_limits, optimized=config.get('optimize_gcode', True)), mimetype=MIMETYPE)
+    return jsonify({
+        "status": "success",
+        "gcode": gcode,
+        "svg_gcode": programs.get("svg"),
+        "text_gcode": programs.get("text"),
+        # The optimizer simulated the merged program already, with the same limits
+        "estimated_seconds": (report["estimated_seconds_after"] if report.get("optimized")
+                              else simulate(gcode, machine_limits)["estimated_seconds"]),
+        "report": report
+    }), 200
+
+
+@app.route('/ready', methods=['GET'])
+#Ready with a valid config.json, unless the service is shutting down
+def ready():
+    return ready_response(config=config_watcher.current.calibrated)
+
+
+if __name__ == '__main__':
+    run(app, "gcode-compositor-service", 5005)
@@ -1,227 +1,376 @@
-from flask import Flask, jsonify, request
-import tempfile
-import subprocess
+from flask import Flask, jsonify, request, Response
 import os
 import json
+import mmap
 import time
-import requests
-import threading
+import sys
+from device_pool import Device, DevicePool, DeviceBusyError, UnknownDeviceError, PoolDrainingError, Job, OFFLINE
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.callback_dispatcher import CallbackDispatcher
+from common.callback_registry import CallbackRegistry
+from common.configuration import watch_config
+from common.gcode_binary import MIMETYPE, HEADER, BinaryProgram, BinaryFormatError, encode, decode, validate
+from common.gcode_optimizer import optimize_for_config
+from common.gcode_simulator import MachineLimits, simulate, coaster_from_config
+from common import metrics
+from common.serving import run, on_shutdown, ready_response
 
 app = Flask(__name__)
 
-# Port Configuration
-PORT = "COM5"
-BAUD_RATE = "115200"
-execution_state = {"running": False}
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CALLBACKS_FILE_PATH = os.path.join(BASE_DIR, "drawing_callbacks.json")
+CALLBACKS_JOURNAL_PATH = os.path.join(BASE_DIR, "drawing_callbacks.journal")
+LEGACY_CALLBACKS_FILE_PATH = os.path.join(BASE_DIR, "drawing_callbacks.json")
+CALLBACK_OUTBOX_PATH = os.path.join(BASE_DIR, "callbacks_outbox.db")
+ROBOT_POSITION_FILE_PATH = os.path.join(BASE_DIR, "robot-position.gcode")
+# Binary programs of queued and running jobs, streamed from memory-mapped files
+SPOOL_DIR = os.path.join(BASE_DIR, "spool")
+# Seconds between events of a job's progress stream, and between keepalives while nothing changes
+PROGRESS_INTERVAL = 0.25
+KEEPALIVE_INTERVAL = 15
+
+# config.json, validated once and replaced as a whole when the file changes. The plotters are
+# opened at startup, the pen heights and machine limits are read from the current version by every job
+config_watcher = watch_config()
+config = config_watcher.current
+
+# One entry per plotter, e.g. {"name": "plotter-1", "port": "COM5", "baud_rate": 115200}, plotter-1 on COM5
+# without grbl_devices. The serial ports stay open between jobs, each job runs on the next idle plotter
+devices = [Device(entry['name'], entry['port'], entry['baud_rate']) for entry in config.grbl_devices]
+device_pool = DevicePool(devices, retry_after=config.get('device_retry_seconds', 30))
+machine_limits = MachineLimits.from_config(config)
+
+
+#Time estimates follow a change of the machine section without a restart
+@config_watcher.subscribe
+def config_changed(old, new):
+    global machine_limits
+    machine_limits = MachineLimits.from_config(new)
+
+# Jobs do not outlive the process, neither do their spool files
+os.makedirs(SPOOL_DIR, exist_ok=True)
+for spool_name in os.listdir(SPOOL_DIR):
+    if spool_name.endswith(".gcb"):
+        os.remove(os.path.join(SPOOL_DIR, spool_name))
+# CPEE callbacks of the drawings in progress, answered once the drawing has finished
+callback_registry = CallbackRegistry(CALLBACKS_JOURNAL_PATH, legacy_path=LEGACY_CALLBACKS_FILE_PATH)
+# A callback is done with once CPEE accepted its answer or the dispatcher gave up on it
+callback_dispatcher = CallbackDispatcher(
+    CALLBACK_OUTBOX_PATH,
+    workers=config.get('callback_workers', 4),
+    timeout=(3.05, config.get('callback_timeout', 10)),
+    max_attempts=config.get('callback_max_attempts', 8),
+    on_success=lambda callback_url, payload: callback_registry.remove(callback_url),
+    on_failure=lambda callback_url, payload, error: callback_registry.remove(callback_url)
+)
+# Callbacks restored from the journal belong to drawings the last run did not finish, their jobs are gone.
+# They are answered as failed, unless the outbox holds their answer already
+answered = callback_dispatcher.urls()
+for callback_url in callback_registry.snapshot():
+    if callback_url not in answered:
+        app.logger.warning("Drawing of %s was interrupted by a restart", callback_url)
+        callback_dispatcher.dispatch(callback_url, {"status": "failed",
+                                                    "error": "The drawing was interrupted by a restart of the GRBL service."})
+# On shutdown the queued and running jobs are drawn and their callbacks answered before the process exits
+on_shutdown(device_pool.drain)
+on_shutdown(callback_dispatcher.flush)
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "grbl-service", enabled=config.get('metrics_enabled', True))
+LINES_ACKED = metrics.counter("grbl_lines_acked_total", "G-code lines GRBL acknowledged, its rate is the streaming rate",
+                              ("device",))
+RX_BUFFER_BYTES = metrics.gauge("grbl_rx_buffer_bytes", "Unacknowledged bytes in GRBL's serial receive buffer",
+                                ("device",))
+JOB_QUEUED_SECONDS = metrics.histogram("grbl_job_queued_seconds", "Time a job waited for a plotter")
+JOB_DRAWING_SECONDS = metrics.histogram("grbl_job_drawing_seconds", "Time a plotter spent on a job, by result",
+                                        ("result",))
+metrics.collector("grbl_planner_blocks_free", "Free blocks of GRBL's planner buffer at the last status report",
+                  lambda: {device.name: device.streamer.planner_blocks_free for device in devices}, labels=("device",))
+metrics.collector("grbl_device_up", "Whether a plotter is connected",
+                  lambda: {device.name: device.state != OFFLINE for device in devices}, labels=("device",))
+metrics.collector("grbl_jobs_queued", "Jobs waiting for a plotter", lambda: device_pool.stats()["queued"])
+metrics.collector("callback_outbox_deliveries", "Deliveries in the callback outbox, by state",
+                  callback_dispatcher.stats, labels=("state",))
 
 # ------------------ Functions ------------------
 
-#Preprocess the G-code text to ensure each command starts on a new line.
-def preprocess_gcode(gcode_text):
+#Stream the G-code lines to the plotter and report how many were sent
+def send_gcode_to_grbl(streamer, gcode_lines):
+    result = streamer.stream(gcode_lines)
+    return {"status": "success", "message": f"G-code executed successfully ({result['lines']} lines)."}
 
-    commands = []
-    current_command = []
 
-    for line in gcode_text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        i = 0
-        while i < len(line):
-            if line[i].upper() == 'G' and (i == 0 or line[i - 1].isspace() or line[i - 1] in [';', '(']):
-                if current_command:
-                    commands.append("".join(current_command).strip())
-                    current_command = []
-            current_command.append(line[i])
-            i += 1
+def send_gcode_file_to_grbl(streamer, gcode_file):
+    with open(gcode_file, 'r') as f:
+        return send_gcode_to_grbl(streamer, f.readlines())
 
-        if current_command:
-            commands.append("".join(current_command).strip())
-            current_command = []
 
-    processed_gcode = "\n".join(commands)
-    return processed_gcode
+#Reorder and merge the strokes of a job to cut pen-up travel, if enabled in config.json
+def optimize_job(gcode_text):
+    optimized_gcode, report = optimize_for_config(gcode_text, config_watcher.current, machine_limits)
+    if report is None:
+        return gcode_text, None
+    if report["optimized"]:
+        app.logger.info("Optimized job: estimated %.1f s saved, pen lifts %d -> %d, travel %.1f -> %.1f mm",
+                        report["estimated_seconds_saved"], report["pen_lifts_before"], report["pen_lifts_after"],
+                        report["travel_mm_before"], report["travel_mm_after"])
+    else:
+        app.logger.info("Job not optimized: %s", report["reason"])
+    return optimized_gcode, report
 
 
-def send_gcode_file_to_grbl(gcode_file):
-    try:
-        command = [
-            "java", "-cp", "UniversalGcodeSender.jar",
-            "com.willwinder.ugs.cli.TerminalClient",
-            "--controller", "GRBL",
-            "--port", PORT,
-            "--baud", BAUD_RATE,
-            "--print-stream",
-            "--file", gcode_file
-        ]
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode == 0:
-            return {"status": "success", "message": f"G-code executed successfully from {gcode_file}."}
-        else:
-            return {"status": "error", "message": result.stderr}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+def spool_path(job):
+    return os.path.join(SPOOL_DIR, f"{job.id}.gcb")
 
 
-def execute_gcode(gcode_text):
+#Write a spool file in one piece, a job never sees half of it
+def write_spool(path, chunks):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'wb') as spool_file:
+        for chunk in chunks:
+            spool_file.write(chunk)
+    os.replace(temporary_path, path)
 
-    try:
-        processed_gcode = preprocess_gcode(gcode_text)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".gcode", dir=".") as temp_file:
-            temp_file.write(processed_gcode.encode('utf-8'))
-            temp_file_name = temp_file.name
+#Spool a text job as an optimized binary program, returns the optimizer's report
+def prepare_spool(path, gcode_text=None):
+    if gcode_text is None or os.path.exists(path):
+        # Binary jobs are streamed as they came, the service that encoded them optimized them already;
+        # text jobs retried on another device are spooled already
+        return None
 
-        response = send_gcode_file_to_grbl(temp_file_name)
+    optimized_gcode, report = optimize_job(gcode_text)
+    write_spool(path, [encode(optimized_gcode, machine_limits, optimized=report is not None)])
+    return report
 
-        return response
 
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+#Draw a job on the plotter it was dispatched to, device failures propagate to the pool
+def execute_gcode(path, streamer, job, gcode_text=None):
 
+    report = prepare_spool(path, gcode_text)
+    with open(path, 'rb') as spool_file:
+        buffer = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+    program = lines = None
+    try:
+        program = BinaryProgram(buffer)
+        total_lines = program.commands
+        # The line count is in the header, so progress is a percentage without a pass over the program
+        job.update(total_lines=total_lines, estimated_seconds=round(program.estimated_seconds, 1))
+
+        def on_progress(sent, acked, buffered):
+            job.report_progress(acked, total_lines, streamer.position)
+            LINES_ACKED.inc(device=job.device)
+            RX_BUFFER_BYTES.set(buffered, device=job.device)
+
+        lines = program.iter_bytes()
+        result = streamer.stream(lines, on_progress)
     finally:
+        # The views into the mapping have to be gone before it can be closed
+        if lines is not None:
+            lines.close()
+        program = lines = None
         try:
-            if os.path.exists(temp_file_name):
-                os.remove(temp_file_name)
-        except Exception:
-            return {"status": "error", "message": str(e)}
+            buffer.close()
+        except BufferError:
+            # Still referenced by a traceback, unmapped when that is collected
+            pass
 
-        execution_state["running"] = False
-
-
-def get_callback_url():
-    if os.path.exists(CALLBACKS_FILE_PATH):
-            with open(CALLBACKS_FILE_PATH, 'r') as callbacks_file:
-                callback_data = json.load(callbacks_file)
-                callback_ids = [callback["callback_id"] for callback in callback_data]
-
-            if callback_ids:
-                callback_url = callback_ids[0] 
-                return callback_url
+    return {
+        "status": "success",
+        "message": f"G-code executed successfully ({result['lines']} lines).",
+        "device": job.device,
+        "optimization": report
+    }
 
 
 #send a put request to continue with process after executing
-def send_callback(callback_url):
-    """Send a callback to the specified URL."""
-    try:
-        response = requests.put(callback_url, json={"status": "done"})
+def send_callback(callback_url, error=None):
+    """Queue the callback to the specified URL, the dispatcher retries it until CPEE accepted it."""
+    if error is not None:
+        # The process has to know the coaster was not drawn, e.g. to release the order again
+        callback_dispatcher.dispatch(callback_url, {"status": "failed", "error": str(error)})
+    else:
+        callback_dispatcher.dispatch(callback_url, {"status": "done"})
 
-        if response.status_code == 200:
-            with open(CALLBACKS_FILE_PATH, 'r') as f:
-                callbacks = json.load(f)
-            callbacks = [cb for cb in callbacks if cb["callback_id"] != callback_url]
-            with open(CALLBACKS_FILE_PATH, 'w') as f:
-                json.dump(callbacks, f, indent=4)
 
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
-
-#launch gcode execution and send callback afterwards 
-def monitor_execution_and_callback(gcode_text):
+#Answer the CPEE callback of a job once it has finished, failed or not
+def job_finished(job):
+    error = job.future.exception()
+    if error is not None:
+        app.logger.error("Job %s failed on %s: %s", job.id, job.device, error)
     try:
-        execute_gcode(gcode_text)
-        while execution_state["running"]:
-            time.sleep(1)
-
-        callback_url = get_callback_url()
-        if callback_url:
-            send_callback(callback_url)
-
-        execution_state["running"] = False
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
-
+        os.remove(spool_path(job))
+    except OSError:
+        pass
+    if job.started_at is not None:
+        JOB_QUEUED_SECONDS.observe(job.started_at - job.created_at)
+        JOB_DRAWING_SECONDS.observe(job.finished_at - job.started_at, result=job.state)
+        metrics.record_span(job.trace_id, "grbl.queued", job.created_at, job.started_at - job.created_at)
+        metrics.record_span(job.trace_id, "grbl.drawing", job.started_at, job.finished_at - job.started_at)
+    if job.callback_url:
+        send_callback(job.callback_url, error)
 
 
 # ------------------ Endpoints ------------------
 
 @app.route('/executeGcode', methods=['POST'])
 def execute_gcode_endpoint():
-    global execution_state
-    if execution_state["running"]:
-        return jsonify({"status": "error", "message": "Another G-code execution is already in progress."}), 400
-    execution_state["running"] = True
-
     cb = request.headers.get('Cpee-Callback')
     if not cb:
-        execution_state["running"] = False
         return jsonify({"error": "Cpee-Callback header is missing"}), 400
 
-    if os.path.exists(CALLBACKS_FILE_PATH):
-            try:
-                with open(CALLBACKS_FILE_PATH, 'r') as f:
-                    callbacks = json.load(f)
-            except json.JSONDecodeError:
-                callbacks = [] 
-    else:
-        callbacks = []
-
-    callbacks.append({"callback_id": cb})
-    with open(CALLBACKS_FILE_PATH, 'w') as f:
-        json.dump(callbacks, f, indent=4)
-
     try:
         # Get gcode_text from request and execute it 
+        gcode_text = None
+        binary = request.content_type == MIMETYPE
         if request.content_type == 'application/x-www-form-urlencoded':
             gcode_text = request.form.get('gcode')
         elif request.content_type == 'application/json':
-            data = request.get_json()
+            data = request.get_json(silent=True) or {}
             gcode_text = data.get('gcode')
-        else:
-            execution_state["running"] = False
+        elif not binary:
             return jsonify({"error": "Unsupported Content-Type."}), 400
-
-        threading.Thread(target=monitor_execution_and_callback, args=(gcode_text,), daemon=True).start()
-
-        response_headers = {'CPEE-CALLBACK': 'true'}
+        if not binary and not gcode_text:
+            return jsonify({"error": "G-code is required."}), 400
+
+        job = Job(None, callback_url=cb, trace_id=metrics.current_trace_id())
+        path = spool_path(job)
+        if binary:
+            # Binary programs go from the request body to the spool file without being held in memory
+            write_spool(path, iter(lambda: request.stream.read(64 * 1024), b""))
+            try:
+                with open(path, 'rb') as spool_file:
+                    validate(spool_file.read(HEADER.size), os.fstat(spool_file.fileno()).st_size)
+            except BinaryFormatError as e:
+                os.remove(path)
+                return jsonify({"error": str(e)}), 400
+
+        job.run = lambda streamer, job: execute_gcode(path, streamer, job, gcode_text)
+        # The callback is held until a plotter has drawn the job, however many jobs are ahead of it
+        callback_registry.append(cb)
+        job.future.add_done_callback(lambda future: job_finished(job))
+        try:
+            device_pool.submit(job)
+        except PoolDrainingError as e:
+            callback_registry.remove(cb)
+            if os.path.exists(path):
+                os.remove(path)
+            return jsonify({"error": str(e)}), 503
+
+        response_headers = {'CPEE-CALLBACK': 'true', 'X-Job-Id': job.id, 'Location': f"/jobs/{job.id}"}
         return '', 200, response_headers
 
     except Exception as e:
-        execution_state["running"] = False
         return jsonify({"error": "An error occurred"}), 500
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = device_pool.job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown job '{job_id}'."}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+#Server-Sent Events with the job's progress, at most one event per PROGRESS_INTERVAL, until it has finished
+def job_events(job_id):
+    job = device_pool.job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown job '{job_id}'."}), 404
+
+    def events():
+        version = None
+        while True:
+            current = job.wait_for_change(version, timeout=KEEPALIVE_INTERVAL)
+            if current == version:
+                # Keeps proxies from closing an idle stream while the job waits in the queue
+                yield ": keepalive\n\n"
+                continue
+            version = current
+            status = job.to_dict()
+            if job.finished:
+                yield f"event: {status['state']}\ndata: {json.dumps(status)}\n\n"
+                return
+            yield f"event: progress\ndata: {json.dumps(status)}\n\n"
+            time.sleep(PROGRESS_INTERVAL)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/home', methods=['POST'])
 def home():
-    global execution_state
-    if execution_state["running"]:
-        return jsonify({"status": "error", "message": "Another operation is in progress."}), 400
-    execution_state["running"] = True
     try:
-        command = [
-            "java", "-cp", "UniversalGcodeSender.jar",
-            "com.willwinder.ugs.cli.TerminalClient",
-            "--controller", "GRBL",
-            "--port", PORT,
-            "--baud", BAUD_RATE,
-            "--home"
-        ]
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode == 0:
-            return jsonify({"status": "success", "output": result.stdout})
-        else:
-            return jsonify({"status": "error", "output": result.stderr}), 500
+        result = device_pool.run_now(request.args.get('device'), lambda streamer: streamer.home())
+        return jsonify({"status": "success", "output": f"Homing finished ({result['lines']} lines)."})
 
+    except UnknownDeviceError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except DeviceBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
-    finally:
-        execution_state["running"] = False
 
 
 @app.route('/robot', methods=['POST'])
 def robot():
-    global execution_state
-    if execution_state["running"]:
-        return jsonify({"status": "error", "message": "Another operation is in progress."}), 400
-    execution_state["running"] = True
     try:
-        response = send_gcode_file_to_grbl("robot-position.gcode")
+        response = device_pool.run_now(
+            request.args.get('device'),
+            lambda streamer: send_gcode_file_to_grbl(streamer, ROBOT_POSITION_FILE_PATH)
+        )
         return jsonify(response)
-    finally:
-        execution_state["running"] = False
+
+    except UnknownDeviceError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except DeviceBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)})
+
+
+@app.route('/simulate', methods=['POST'])
+#Estimate the drawing time of a program and check that it stays on the coaster, without moving the machine
+def simulate_endpoint():
+    if request.content_type == 'application/x-www-form-urlencoded':
+        gcode_text = request.form.get('gcode')
+    elif request.content_type == 'application/json':
+        gcode_text = (request.get_json(silent=True) or {}).get('gcode')
+    elif request.content_type == MIMETYPE:
+        try:
+            gcode_text = decode(request.get_data())
+        except BinaryFormatError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+    else:
+        return jsonify({"error": "Unsupported Content-Type."}), 400
+    if not gcode_text:
+        return jsonify({"status": "error", "message": "G-code is required."}), 400
+
+    try:
+        config = config_watcher.current
+        coaster = coaster_from_config(config) if 'lower_left_corner_x' in config else None
+        report = simulate(gcode_text, machine_limits, coaster)
+        return jsonify({"status": "success", **report}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/ready', methods=['GET'])
+#Ready while at least one plotter is connected and the service is not shutting down
+def ready():
+    return ready_response(plotter_online=any(device.state != OFFLINE for device in devices))
+
+
+@app.route('/callbackStats', methods=['GET'])
+def callback_stats():
+    return jsonify(callback_dispatcher.stats()), 200
+
+
+@app.route('/devices', methods=['GET'])
+def devices_status():
+    return jsonify(device_pool.stats()), 200
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5004)
+    # Threads only: the device pool and its serial ports belong to exactly one process
+    run(app, "grbl-service", 5004, single_process=True)
@@ -0,0 +1,292 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import serial
+
+from grbl_streamer import GrblStreamer, GrblAlarm, GrblTimeout
+
+IDLE = "idle"
+BUSY = "busy"
+OFFLINE = "offline"
+
+# Failures that say something about the machine rather than about the job. The streamer reports
+# I/O errors of the serial port as SerialException, any other OSError is the job's own, e.g. a missing file
+DEVICE_FAULTS = (serial.SerialException, GrblAlarm, GrblTimeout)
+
+
+class DeviceBusyError(Exception):
+    pass
+
+
+class UnknownDeviceError(Exception):
+    pass
+
+
+class PoolDrainingError(Exception):
+    pass
+
+
+class Job:
+    """A drawing waiting for, or running on, one of the plotters.
+
+    `run(streamer, job)` does the work on the streamer of the device the job
+    was dispatched to, its return value becomes the result of `future`.
+    Every change of state or progress bumps `version` and wakes up the
+    threads waiting in `wait_for_change`, e.g. progress streams.
+    """
+
+    def __init__(self, run, callback_url=None, trace_id=None):
+        self.id = uuid.uuid4().hex
+        self.run = run
+        self.callback_url = callback_url
+        self.trace_id = trace_id
+        self.future = Future()
+        self.state = "queued"
+        self.device = None
+        self.attempts = 0
+        # Set once GRBL acknowledged a line, a job that moved the machine is never retried elsewhere
+        self.started_drawing = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.total_lines = None
+        self.estimated_seconds = None
+        self.acked_lines = 0
+        self.position = None
+        self.error = None
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def report_progress(self, acked_lines, total_lines, position):
+        self.update(acked_lines=acked_lines, total_lines=total_lines, position=position, started_drawing=True)
+
+    def wait_for_change(self, version, timeout=None):
+        """Block until the job changed since `version` or the timeout passed, returns the current version."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed")
+
+    def to_dict(self):
+        with self.changed:
+            percent = None
+            eta = None
+            if self.total_lines:
+                percent = round(100 * self.acked_lines / self.total_lines, 1)
+                if self.state == "running" and self.acked_lines and self.started_at:
+                    # Remaining lines at the rate seen so far
+                    elapsed = time.time() - self.started_at
+                    eta = round(elapsed / self.acked_lines * (self.total_lines - self.acked_lines), 1)
+            return {
+                "id": self.id,
+                "state": self.state,
+                "device": self.device,
+                "trace_id": self.trace_id,
+                "attempts": self.attempts,
+                "lines_total": self.total_lines,
+                "lines_acked": self.acked_lines,
+                "estimated_seconds": self.estimated_seconds,
+                "percent": percent,
+                "eta_seconds": eta,
+                "position": self.position,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "error": self.error
+            }
+
+
+class Device:
+
+    def __init__(self, name, port, baud_rate=115200):
+        self.name = name
+        self.streamer = GrblStreamer(port, int(baud_rate))
+        self.state = IDLE
+        self.job = None
+        self.jobs_done = 0
+        self.failures = 0
+        self.last_error = None
+        self.retry_at = 0
+
+    def health(self):
+        return {
+            "name": self.name,
+            "port": self.streamer.port,
+            "state": self.state,
+            "job": self.job.id if self.job else None,
+            "jobs_done": self.jobs_done,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "position": self.streamer.position
+        }
+
+
+class DevicePool:
+    """Runs jobs from one shared FIFO queue on whichever plotter is idle.
+
+    Every device has its own worker thread, so N machines draw N jobs at
+    once. A device that loses its serial connection, raises an alarm or stops
+    answering is taken offline and probed again every `retry_after` seconds;
+    a job that failed on it before drawing anything goes back to the head of
+    the queue for another device, up to `max_attempts` times.
+    """
+
+    def __init__(self, devices, retry_after=30, max_attempts=3, history=1000):
+        if not devices:
+            raise ValueError("At least one GRBL device is required.")
+        self.devices = {device.name: device for device in devices}
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.jobs = deque()
+        # Recent jobs by id, queued and running ones plus the last `history` finished ones
+        self.history = history
+        self.jobs_by_id = OrderedDict()
+        self.condition = threading.Condition()
+        self.draining = False
+        for device in devices:
+            threading.Thread(target=self._work, args=(device,), name=f"grbl-{device.name}", daemon=True).start()
+
+    def submit(self, job):
+        with self.condition:
+            if self.draining:
+                raise PoolDrainingError("The plotters are shutting down and take no new jobs.")
+            self.jobs.append(job)
+            self.jobs_by_id[job.id] = job
+            self._forget_old_jobs()
+            self.condition.notify_all()
+        return job
+
+    def drain(self, timeout=None):
+        """Stop taking jobs and wait until the queued and running ones have finished.
+
+        Returns False if jobs were still left after `timeout` seconds, e.g.
+        because every plotter went offline.
+        """
+        with self.condition:
+            self.draining = True
+            return self.condition.wait_for(
+                lambda: not self.jobs and all(device.state != BUSY for device in self.devices.values()), timeout)
+
+    def job(self, job_id):
+        with self.condition:
+            return self.jobs_by_id.get(job_id)
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs_by_id.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs_by_id[job_id]
+
+    def run_now(self, device_name, run):
+        """Run `run(streamer)` on a specific idle device in the calling thread, e.g. homing."""
+        device = self.device(device_name)
+        with self.condition:
+            if device.state != IDLE:
+                raise DeviceBusyError(f"Device '{device.name}' is {device.state}.")
+            device.state = BUSY
+        try:
+            return run(device.streamer)
+        except DEVICE_FAULTS as e:
+            self._take_offline(device, e)
+            raise
+        finally:
+            self._release(device)
+
+    def device(self, device_name=None):
+        if device_name is None:
+            return next(iter(self.devices.values()))
+        try:
+            return self.devices[device_name]
+        except KeyError:
+            raise UnknownDeviceError(f"Unknown device '{device_name}'.") from None
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": len(self.jobs),
+                "draining": self.draining,
+                "devices": [device.health() for device in self.devices.values()]
+            }
+
+    def _work(self, device):
+        while True:
+            if device.state == OFFLINE:
+                self._probe(device)
+                continue
+            with self.condition:
+                while device.state != OFFLINE and (device.state != IDLE or not self.jobs):
+                    self.condition.wait()
+                if device.state == OFFLINE:
+                    continue
+                job = self.jobs.popleft()
+                device.state = BUSY
+                device.job = job
+            self._run(device, job)
+
+    def _run(self, device, job):
+        job.update(state="running", device=device.name, attempts=job.attempts + 1, started_at=time.time())
+        try:
+            result = job.run(device.streamer, job)
+        except DEVICE_FAULTS as e:
+            self._take_offline(device, e)
+            if not job.started_drawing and job.attempts < self.max_attempts:
+                job.update(state="queued", error=str(e))
+                with self.condition:
+                    self.jobs.appendleft(job)
+                    self.condition.notify_all()
+            else:
+                self._finish(job, error=e)
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            device.jobs_done += 1
+            self._finish(job, result=result)
+        finally:
+            self._release(device)
+
+    def _finish(self, job, result=None, error=None):
+        if error is not None:
+            job.update(state="failed", error=str(error), finished_at=time.time())
+            job.future.set_exception(error)
+        else:
+            job.update(state="done", error=None, finished_at=time.time())
+            job.future.set_result(result)
+
+    def _take_offline(self, device, error):
+        with self.condition:
+            device.state = OFFLINE
+            device.failures += 1
+            device.last_error = str(error)
+            device.retry_at = time.monotonic() + self.retry_after
+
+    def _release(self, device):
+        with self.condition:
+            if device.state == BUSY:
+                device.state = IDLE
+            device.job = None
+            self.condition.notify_all()
+
+    def _probe(self, device):
+        time.sleep(max(0, device.retry_at - time.monotonic()))
+        try:
+            device.streamer.open()
+        except DEVICE_FAULTS as e:
+            device.last_error = str(e)
+            device.retry_at = time.monotonic() + self.retry_after
+            return
+        with self.condition:
+            device.state = IDLE
+            device.last_error = None
+            self.condition.notify_all()
@@ -0,0 +1,208 @@
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import serial
+
+# Size of GRBL's serial receive buffer, the streamer never has more unacknowledged bytes in flight
+RX_BUFFER_SIZE = 127
+
+STATUS_PATTERN = re.compile(r"<(?P<state>[A-Za-z]+)[^>]*?(?:MPos|WPos):(?P<x>-?[\d.]+),(?P<y>-?[\d.]+),(?P<z>-?[\d.]+)")
+# Free planner blocks and receive buffer bytes, reported when $10 includes 2 (GRBL 1.1)
+BUFFER_PATTERN = re.compile(r"\|Bf:(?P<blocks>\d+),(?P<bytes>\d+)")
+COMMENT_PATTERN = re.compile(r"\([^)]*\)|;.*")
+
+
+class GrblError(Exception):
+    pass
+
+
+class GrblAlarm(GrblError):
+    pass
+
+
+class GrblTimeout(GrblError):
+    pass
+
+
+#Strip comments and whitespace so that every byte sent to GRBL is a command byte
+def clean_line(line):
+    return "".join(COMMENT_PATTERN.sub("", line).split()).upper()
+
+
+class GrblStreamer:
+    """Keeps the serial port to a GRBL controller open and streams G-code to it.
+
+    Uses GRBL's character-counting protocol: lines are sent as long as the
+    unacknowledged bytes fit into the 127 byte receive buffer, so the planner
+    never runs dry between short segments. `port` can be a device name or any
+    pyserial URL, e.g. the slave side of a pty running a simulated GRBL.
+    """
+
+    def __init__(self, port, baud_rate=115200, response_timeout=120, wakeup_delay=2, status_interval=0.5):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.response_timeout = response_timeout
+        self.wakeup_delay = wakeup_delay
+        # While streaming, GRBL is asked for its position this often
+        self.status_interval = status_interval
+        self.serial = None
+        self.lock = threading.Lock()
+        self.state = None
+        self.position = None
+        # Free blocks of GRBL's planner buffer from the last status report, None if GRBL does not report it
+        self.planner_blocks_free = None
+
+    def open(self):
+        if self.serial is not None and self.serial.is_open:
+            return
+        with self._port_errors():
+            self.serial = serial.serial_for_url(self.port, baudrate=self.baud_rate, timeout=0.1)
+            # Wake GRBL up and drop its startup banner
+            self.serial.write(b"\r\n\r\n")
+            time.sleep(self.wakeup_delay)
+            self.serial.reset_input_buffer()
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    def stream(self, lines, on_progress=None):
+        """Send G-code lines and wait until the machine has executed them.
+
+        Lines are text, or bytes of commands without spaces or comments.
+
+        `on_progress(sent, acked, buffered)` is called whenever GRBL acknowledges a line.
+        Raises GrblError on an `error:` response, GrblAlarm on an alarm and
+        GrblTimeout when the controller stops answering.
+        """
+        with self.lock:
+            try:
+                self.open()
+                return self._stream(lines, on_progress)
+            except (serial.SerialException, GrblAlarm, GrblTimeout):
+                # The port is re-opened on the next job, which also resets the controller
+                self.close()
+                raise
+
+    def home(self):
+        return self.stream(["$H"])
+
+    @contextmanager
+    def _port_errors(self):
+        # A port that went away fails with a plain OSError on some platforms, it is a device fault all the same
+        try:
+            yield
+        except serial.SerialException:
+            raise
+        except OSError as e:
+            raise serial.SerialException(f"Lost {self.port}: {e}") from e
+
+    def _write(self, data):
+        with self._port_errors():
+            self.serial.write(data)
+
+    def _readline(self):
+        with self._port_errors():
+            return self.serial.readline().decode("ascii", errors="replace").strip()
+
+    def _stream(self, lines, on_progress):
+        pending = deque()
+        buffered = 0
+        sent = 0
+        acked = 0
+        last_status = time.monotonic()
+
+        for line in lines:
+            if isinstance(line, bytes):
+                # Binary jobs yield commands that are clean already, e.g. b'G1X10Y3'
+                command = line
+                data = line + b"\n"
+            else:
+                command = clean_line(line)
+                data = (command + "\n").encode("ascii")
+            if not command:
+                continue
+            while pending and buffered + len(data) > RX_BUFFER_SIZE:
+                buffered -= self._wait_ack(pending)
+                acked += 1
+                if on_progress:
+                    on_progress(sent, acked, buffered)
+            self._write(data)
+            pending.append((len(data), command))
+            buffered += len(data)
+            sent += 1
+            if time.monotonic() - last_status > self.status_interval:
+                # '?' is a realtime command, it bypasses the receive buffer and is answered with a status report
+                self._write(b"?")
+                last_status = time.monotonic()
+
+        while pending:
+            buffered -= self._wait_ack(pending)
+            acked += 1
+            if on_progress:
+                on_progress(sent, acked, buffered)
+
+        self._wait_idle()
+        return {"lines": sent}
+
+    def _drain(self, pending):
+        # Collect the responses to lines already in GRBL's buffer so the next job starts in sync
+        while pending:
+            response = self._read_line()
+            if response == "ok" or response.startswith("error"):
+                pending.popleft()
+
+    def _wait_ack(self, pending):
+        while True:
+            response = self._read_line()
+            if response == "ok":
+                return pending.popleft()[0]
+            if response.startswith("error"):
+                command = pending.popleft()[1]
+                if isinstance(command, bytes):
+                    command = command.decode("ascii", errors="replace")
+                self._drain(pending)
+                raise GrblError(f"GRBL rejected '{command}': {response}")
+            if response.startswith("ALARM"):
+                raise GrblAlarm(f"GRBL alarm: {response}")
+            self._handle_message(response)
+
+    def _wait_idle(self):
+        # 'ok' means planned, not executed: poll the status until the motion has finished
+        deadline = time.monotonic() + self.response_timeout
+        self.state = None
+        while True:
+            self._write(b"?")
+            poll_until = time.monotonic() + 0.2
+            while time.monotonic() < poll_until:
+                response = self._readline()
+                if not response:
+                    continue
+                if response.startswith("ALARM"):
+                    raise GrblAlarm(f"GRBL alarm: {response}")
+                self._handle_message(response)
+                if self.state == "Idle":
+                    return
+            if time.monotonic() > deadline:
+                raise GrblTimeout("GRBL did not become idle in time.")
+
+    def _read_line(self):
+        deadline = time.monotonic() + self.response_timeout
+        while time.monotonic() < deadline:
+            response = self._readline()
+            if response:
+                return response
+        raise GrblTimeout("No response from GRBL.")
+
+    def _handle_message(self, response):
+        match = STATUS_PATTERN.match(response)
+        if match:
+            self.state = match.group("state")
+            self.position = tuple(float(match.group(axis)) for axis in "xyz")
+            buffer_match = BUFFER_PATTERN.search(response)
+            if buffer_match:
+                self.planner_blocks_free = int(buffer_match.group("blocks"))
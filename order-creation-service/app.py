@@ -1,18 +1,89 @@
-import requests
-import json
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
+import sys
+import threading
+import time
 import uuid
 
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.configuration import watch_config
+from common import metrics
+from common.order_notifier import OrderNotifier, DEFAULT_PORT
+from common.order_queue import OrderQueue
+from common.serving import run, on_shutdown, ready_response
+from preconverter import Preconverter
+
 app = Flask(__name__)
 
 CORS(app, origins="*", methods=["GET", "POST", "OPTIONS"])
 
-ORDER_CREATION_SERVICE_DIR = os.path.dirname(__file__)
-JSON_STORAGE_DIR = os.path.join(ORDER_CREATION_SERVICE_DIR, 'orders')
-os.makedirs(JSON_STORAGE_DIR, exist_ok=True)
-CALLBACKS_FILE_PATH = os.path.join(ORDER_CREATION_SERVICE_DIR, '../order-management-service/callbacks.json')
+# config.json, validated once and replaced as a whole when the file changes
+config_watcher = watch_config()
+config = config_watcher.current
+
+# Orders waiting for the order management service, shared with it through orders.db
+order_queue = OrderQueue()
+# Tells the order management service about queued orders: it delivers them to the CPEE callbacks
+# waiting there, or to the requests long-polling there
+order_notifier = OrderNotifier(port=config.get('order_notify_port', DEFAULT_PORT))
+
+
+# Queued orders are converted by the G-code compositor while they wait, off the plotter's critical path
+COMPOSITOR_URL = config.get('compositor_url', "http://127.0.0.1:5005").rstrip('/')
+preconverter = Preconverter(
+    order_queue,
+    f"{COMPOSITOR_URL}/order2gcode",
+    workers=config.get('preconvert_workers', 2),
+    queue_size=config.get('preconvert_queue_size', 32),
+    timeout=config.get('preconvert_timeout', 120)
+) if config.get('preconvert_orders', True) else None
+
+
+# Texts are checked by the text service before an order is accepted, a text it rejects would only fail later
+TEXT_SERVICE_URL = config.get('text_service_url', "http://127.0.0.1:5002").rstrip('/')
+sessions = threading.local()
+
+
+#Why the text service cannot draw a text, None if it can or cannot be asked; an order whose text
+#could not be checked is accepted and converted later as before
+def text_error(text):
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    try:
+        response = session.post(f"{TEXT_SERVICE_URL}/text2gcode", data={"text": text}, timeout=(3.05, 10))
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code != 400:
+        return None
+    try:
+        return response.json().get("message") or "Text cannot be drawn."
+    except ValueError:
+        return "Text cannot be drawn."
+
+
+#Queue an order and tell the order management service about it, then start converting it
+def queue_order(order_data, priority=0):
+    order_queue.enqueue(order_data, priority)
+    order_notifier.notify()
+    if preconverter:
+        # An order a waiting callback took meanwhile is converted by its process, not here
+        preconverter.submit(order_data)
+
+
+if preconverter:
+    # Conversions still running when the service stops leave their orders to be converted by the process
+    on_shutdown(preconverter.flush)
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "order-creation-service", enabled=config.get('metrics_enabled', True))
+ORDERS_CREATED = metrics.counter("orders_created_total", "Orders created")
+if preconverter:
+    metrics.collector("order_preconversions", "Orders converted ahead since the start, by result, and those in progress",
+                      preconverter.stats, labels=("result",))
 
 @app.route('/createOrder', methods=['POST', 'OPTIONS'])
 def create_order():
@@ -30,49 +101,47 @@ def create_order():
         text = data.get('text')
         if not svg or not text:
             return jsonify({'error': 'SVG and text are required'}), 400
+        error = text_error(text)
+        if error:
+            return jsonify({'error': error}), 400
 
         order_id = str(uuid.uuid4())
         order_data = {'order_id': order_id, 'svg': svg, 'text': text}
+        # The trace id follows the order through CPEE to the conversions and the drawing
+        trace_id = metrics.start_trace()
+        if trace_id:
+            order_data.update(trace_id=trace_id, created_at=time.time())
+        try:
+            priority = int(data.get('priority', 0))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Priority must be an integer'}), 400
 
-        
-        if os.path.exists(CALLBACKS_FILE_PATH):
-            with open(CALLBACKS_FILE_PATH, 'r') as callbacks_file:
-                callback_data = json.load(callbacks_file)
-                callback_ids = [callback["callback_id"] for callback in callback_data]
-
-            if callback_ids:
-                callback_url = callback_ids[0]  
-                try:
-                    # Send a PUT request to the callback URL with the order data 
-                    callback_response = requests.put(callback_url, json=order_data, timeout=10)
-
-                    if callback_response.status_code == 200:
-                        callback_data = [callback for callback in callback_data if callback["callback_id"] != callback_url]
-                        with open(CALLBACKS_FILE_PATH, 'w') as callbacks_file:
-                            json.dump(callback_data, callbacks_file)
-                        return jsonify({'message': 'Order sent to callback successfully'}), 200
-
-                except requests.exceptions.Timeout:
-                    return jsonify({'error': f'Request to callback URL {callback_url} timed out'}), 504
-                except requests.exceptions.RequestException as e:
-                     return jsonify({'error': f'Error during callback request: {str(e)}'}), 500
-
-                order_file_path = os.path.join(JSON_STORAGE_DIR, f"{order_id}.json")
-                with open(order_file_path, 'w') as order_file:
-                    json.dump(order_data, order_file)
-                return jsonify({'message': 'Callback triggered or failed, order saved to directory'}), 200
-            
-            else:
-                # Save to the orders directory when no callback found
-                order_file_path = os.path.join(JSON_STORAGE_DIR, f"{order_id}.json")
-                with open(order_file_path, 'w') as order_file:
-                    json.dump(order_data, order_file)
-                return jsonify({'message': 'No callback available, order saved to directory'}), 200
-        else:
-            return jsonify({'error': 'Failed to retrieve callback list'}), 500
+        # The order management service hands it to a waiting CPEE callback as soon as it is notified
+        queue_order(order_data, priority)
+        ORDERS_CREATED.inc()
+        return jsonify({'message': 'Order added to the queue'}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+
+@app.route('/preconversionStats', methods=['GET'])
+def preconversion_stats():
+    if not preconverter:
+        return jsonify({'error': 'Orders are not converted ahead, preconvert_orders is off'}), 404
+    return jsonify(preconverter.stats()), 200
+
+
+@app.route('/ready', methods=['GET'])
+#Ready while the order queue can be read and the service is not shutting down
+def ready():
+    try:
+        order_queue.stats()
+        queue_readable = True
+    except Exception:
+        queue_readable = False
+    return ready_response(order_queue=queue_readable)
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5001)
+    run(app, "order-creation-service", 5001)
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common.order_queue import CONVERSION_PENDING, CONVERSION_READY, CONVERSION_FAILED
+
+# Answers of the compositor that the same order would get again: its logo or text cannot be converted.
+# A 422 only says the two programs cannot be merged, they can still be drawn one after the other
+PERMANENT_FAILURES = (400,)
+
+logger = logging.getLogger(__name__)
+
+
+class Preconverter:
+    """Converts queued orders in the background, while the plotter draws the orders before them.
+
+    `submit` marks the order as pending in the queue and returns; at most
+    `workers` conversions run at once through the G-code compositor at
+    `url`, at most `queue_size` more wait for a worker, and orders beyond
+    that stay unconverted. A converted order gets its G-code and time
+    estimate stored with it and is handed out before the unconverted orders
+    of its priority. An order whose logo or text a conversion service
+    rejects is flagged as failed and never handed out. On any other error,
+    including programs the compositor cannot merge, and for orders a crash
+    left pending, the order is handed out unconverted and converted by the
+    CPEE process as before.
+    """
+
+    def __init__(self, order_queue, url, workers=2, queue_size=32, timeout=120):
+        self.order_queue = order_queue
+        self.url = url
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preconvert")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {"ready": 0, "failed": 0, "unavailable": 0, "skipped": 0}
+        self.in_flight = 0
+
+    def submit(self, order_data):
+        """Convert a queued order in the background, False if too many conversions are waiting already."""
+        if not self.slots.acquire(blocking=False):
+            self._count("skipped")
+            return False
+        with self.lock:
+            self.in_flight += 1
+        try:
+            if not self.order_queue.set_conversion(order_data['order_id'], CONVERSION_PENDING):
+                # Already handed out
+                self._done()
+                return False
+            self.executor.submit(self._convert, order_data)
+        except Exception:
+            self._done()
+            raise
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until the conversions in progress are stored, False after `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.in_flight:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, in_flight=self.in_flight)
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _count(self, result):
+        with self.lock:
+            self.counts[result] += 1
+
+    def _done(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def _convert(self, order_data):
+        order_id = order_data['order_id']
+        try:
+            state, result = self._request(order_data)
+            # Only the reason of a rejection is kept with the order, the process retries the others itself
+            stored = result if state else None
+            if not self.order_queue.set_conversion(order_id, state, stored):
+                # Handed out and drawn unconverted meanwhile
+                return
+            if state == CONVERSION_FAILED:
+                logger.error("Order %s cannot be converted, held back from the plotter: %s",
+                             order_id, result['conversion_error'])
+                self._count("failed")
+            elif state == CONVERSION_READY:
+                self._count("ready")
+            else:
+                logger.warning("Order %s was not converted ahead, the process converts it instead: %s",
+                               order_id, result['conversion_error'])
+                self._count("unavailable")
+        except Exception:
+            logger.exception("Converting order %s failed", order_id)
+        finally:
+            self._done()
+
+    def _request(self, order_data):
+        """The conversion state and the fields to store with the order."""
+        headers = {"X-Trace-Id": order_data['trace_id']} if order_data.get('trace_id') else {}
+        try:
+            response = self._session().post(self.url, json={"svg": order_data.get('svg'), "text": order_data.get('text')},
+                                            headers=headers, timeout=(3.05, self.timeout))
+        except requests.exceptions.RequestException as e:
+            return None, {"conversion_error": f"compositor not reachable ({e})"}
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+
+        if response.status_code == 200 and body.get("status") == "success":
+            return CONVERSION_READY, {
+                "gcode": body['gcode'],
+                "svg_gcode": body.get('svg_gcode'),
+                "text_gcode": body.get('text_gcode'),
+                "estimated_seconds": body.get('estimated_seconds')
+            }
+        error = body.get("message") or f"HTTP {response.status_code}"
+        if response.status_code in PERMANENT_FAILURES:
+            return CONVERSION_FAILED, {"conversion_error": error}
+        return None, {"conversion_error": error}
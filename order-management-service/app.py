@@ -1,56 +1,238 @@
 from flask import Flask, jsonify, request
 import os
-import json
+import math
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.callback_dispatcher import CallbackDispatcher
+from common.callback_registry import CallbackRegistry
+from common.configuration import watch_config
+from common import metrics
+from common.order_notifier import OrderNotifier, DEFAULT_PORT
+from common.order_queue import OrderQueue
+from common.serving import run, on_shutdown, ready_response
 
 app = Flask(__name__)
 
 ORDER_CREATION_SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../order-creation-service/orders'))  
-CALLBACKS_FILE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'callbacks.json'))
-os.makedirs(ORDER_CREATION_SERVICE_DIR, exist_ok=True)
+CALLBACKS_JOURNAL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'callbacks.journal'))
+LEGACY_CALLBACKS_FILE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'callbacks.json'))
+CALLBACK_OUTBOX_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'callbacks_outbox.db'))
+# The outbox the order creation service delivered orders from before this service took that over
+LEGACY_CALLBACK_OUTBOX_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../order-creation-service/callbacks_outbox.db'))
+
+# config.json, validated once and replaced as a whole when the file changes
+config_watcher = watch_config()
+config = config_watcher.current
+
+# With order_ack_required, a fetched order stays claimed until /ackOrder and is handed out again after the timeout
+ACK_REQUIRED = config.get('order_ack_required', False)
+order_queue = OrderQueue(visibility_timeout=config.get('order_visibility_timeout', 300),
+                         max_overtaken=config.get('order_max_overtaken', 3))
+# Orders saved as files by earlier versions of the order creation service
+order_queue.import_directory(ORDER_CREATION_SERVICE_DIR)
+# CPEE callbacks waiting for an order, kept by this process alone; the journal only restores them after a restart
+callback_registry = CallbackRegistry(CALLBACKS_JOURNAL_PATH, legacy_path=LEGACY_CALLBACKS_FILE_PATH, shared=False)
+# Long-polling requests and the waiting callbacks are woken up by the order creation service as soon as
+# an order was queued
+MAX_WAIT = config.get('order_max_wait', 60)
+order_notifier = OrderNotifier(port=config.get('order_notify_port', DEFAULT_PORT),
+                               poll_interval=config.get('order_poll_interval', 1.0))
+order_notifier.listen()
+
+
+#An order its callback never accepted goes back to its place in the queue, for the next CPEE instance asking for one
+def return_order(callback_url, order_data, error):
+    app.logger.error("Order %s could not be delivered to %s (%s), back in the queue", order_data['order_id'], callback_url, error)
+    claim_token = order_data.pop('claim_token', None) or callback_url
+    if not order_queue.release(order_data['order_id'], claim_token):
+        # Delivered by an earlier version, which took the order off the queue
+        order_queue.enqueue(order_data)
+    order_notifier.wake()
+
+
+#Without acknowledgements an order is done with once its callback accepted it
+def remove_order(callback_url, order_data):
+    order_queue.ack(order_data['order_id'], callback_url)
+
+
+# Orders are handed to the waiting CPEE instances in the background, retried from an outbox if one does not answer
+callback_dispatcher = CallbackDispatcher(
+    CALLBACK_OUTBOX_PATH,
+    workers=config.get('callback_workers', 4),
+    timeout=(3.05, config.get('callback_timeout', 10)),
+    max_attempts=config.get('callback_max_attempts', 8),
+    on_success=remove_order,
+    on_failure=return_order
+)
+callback_dispatcher.import_outbox(LEGACY_CALLBACK_OUTBOX_PATH)
+on_shutdown(callback_dispatcher.flush)
+on_shutdown(callback_registry.flush)
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "order-management-service", enabled=config.get('metrics_enabled', True))
+metrics.collector("orders_queued", "Orders in the queue, by whether they are ready, converted ahead, claimed or failed to convert",
+                  order_queue.stats, labels=("state",))
+metrics.collector("callbacks_waiting", "CPEE callbacks waiting for an order", lambda: len(callback_registry))
+metrics.collector("callback_outbox_deliveries", "Deliveries in the callback outbox, by state",
+                  callback_dispatcher.stats, labels=("state",))
+
+
+#Take the first available order off the queue, or claim it when orders have to be acknowledged
+def take_order():
+    if ACK_REQUIRED:
+        claimed = order_queue.claim()
+        if claimed:
+            order_data, claim_token = claimed
+            return dict(order_data, claim_token=claim_token)
+        return None
+    return order_queue.pop()
+
+
+def record_queued_span(order_data):
+    if order_data.get('trace_id') and order_data.get('created_at'):
+        # Time the order spent in the queue, the first stage of its trace here
+        metrics.record_span(order_data['trace_id'], "order.queued", order_data['created_at'],
+                            time.time() - order_data['created_at'])
+
+
+#Give the next queued order to the longest waiting callback, returns the order or None
+def deliver_order():
+    # The callbacks are in memory, the queue is only looked at while one is waiting
+    if not len(callback_registry):
+        return None
+    callback_url = callback_registry.first()
+    if ACK_REQUIRED:
+        order_data = take_order()
+    else:
+        # Claimed by the callback until it accepted the order, so a failed delivery keeps the order's place
+        claimed = order_queue.claim(visibility_timeout=math.inf, token=callback_url)
+        order_data = claimed[0] if claimed else None
+    if order_data is None:
+        return None
+    callback_registry.pop()
+    record_queued_span(order_data)
+    callback_dispatcher.dispatch(callback_url, order_data)
+    return order_data
+
+
+#Deliver orders to the waiting callbacks as they are queued, woken up by the order creation service
+def deliver_orders():
+    while True:
+        try:
+            order_notifier.wait_for(deliver_order, 60)
+        except Exception:
+            app.logger.exception("Delivering an order to a waiting callback failed")
+            time.sleep(order_notifier.poll_interval)
+
+
+# Only this thread takes callbacks off the registry
+threading.Thread(target=deliver_orders, name="order-delivery", daemon=True).start()
+
 
 @app.route('/manageOrders', methods=['GET'])
-#Fetch and return the first available order, or store the callback if no orders found
+#Fetch and return the first available order, or store the callback if no orders found.
+#Converted orders may go ahead of a few older ones within a priority, orders that failed to convert never come.
+#With ?wait=<seconds> the request waits up to that long for an order first
 def manage_orders():
-
     try:
-        orders = os.listdir(ORDER_CREATION_SERVICE_DIR)
-    except FileNotFoundError:
-        return jsonify({"error": f"Directory '{ORDER_CREATION_SERVICE_DIR}' not found"}), 404
-
-    if orders:
-        order_file = orders[0]
-        order_path = os.path.join(ORDER_CREATION_SERVICE_DIR, order_file)
-        with open(order_path, 'r') as f:
-            order_data = json.load(f)
-        
-        os.remove(order_path)
+        wait = min(float(request.args.get('wait', 0)), MAX_WAIT)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    order_data = order_notifier.wait_for(take_order, wait) if wait > 0 else take_order()
+    if order_data:
+        record_queued_span(order_data)
         return jsonify(order_data), 200
 
     # If no orders are found, save the callback ID
     cb = request.headers.get('Cpee-Callback')
     if not cb:
+        if wait > 0:
+            # A long poll without a callback simply ends empty
+            return '', 204
         return jsonify({"error": "Cpee-Callback header is missing"}), 400
 
-    try:
-        if os.path.exists(CALLBACKS_FILE_PATH):
-            try:
-                with open(CALLBACKS_FILE_PATH, 'r') as f:
-                    callbacks = json.load(f)
-            except json.JSONDecodeError:
-                callbacks = [] 
-        else:
-            callbacks = []
-
-        callbacks.append({"callback_id": cb})
-        with open(CALLBACKS_FILE_PATH, 'w') as f:
-            json.dump(callbacks, f, indent=4)
-
-    except Exception as e:
-        return jsonify({"error": "Failed to save callback ID"}), 500
+    # Kept in memory, the next order queued is delivered to it by deliver_orders
+    callback_registry.append(cb)
+    # An order queued since take_order() looked is delivered right away
+    order_notifier.wake()
 
     response_headers = {'CPEE-CALLBACK': 'true'}
     return '', 200, response_headers
 
 
+@app.route('/ackOrder', methods=['POST'])
+#Remove a claimed order from the queue once it has been drawn
+def ack_order():
+    data = request.get_json(silent=True) or request.form
+    order_id = data.get('order_id')
+    claim_token = data.get('claim_token')
+    if not order_id or not claim_token:
+        return jsonify({"error": "order_id and claim_token are required"}), 400
+
+    if not order_queue.ack(order_id, claim_token):
+        return jsonify({"error": "Claim expired or unknown, the order will be handed out again"}), 409
+    return jsonify({"status": "success"}), 200
+
+
+@app.route('/releaseOrder', methods=['POST'])
+#Put a claimed order back at its place in the queue, e.g. after a failed drawing
+def release_order():
+    data = request.get_json(silent=True) or request.form
+    order_id = data.get('order_id')
+    claim_token = data.get('claim_token')
+    if not order_id or not claim_token:
+        return jsonify({"error": "order_id and claim_token are required"}), 400
+
+    if not order_queue.release(order_id, claim_token):
+        return jsonify({"error": "Claim expired or unknown"}), 409
+    order_notifier.wake()
+    return jsonify({"status": "success"}), 200
+
+
+@app.route('/failedOrders', methods=['GET'])
+#Orders held back because their logo or text could not be converted
+def failed_orders():
+    return jsonify(order_queue.failed()), 200
+
+
+@app.route('/discardOrder', methods=['POST'])
+#Remove an order that failed to convert from the queue
+def discard_order():
+    data = request.get_json(silent=True) or request.form
+    order_id = data.get('order_id')
+    if not order_id:
+        return jsonify({"error": "order_id is required"}), 400
+
+    if not order_queue.discard(order_id):
+        return jsonify({"error": "No failed order with this order_id"}), 404
+    return jsonify({"status": "success"}), 200
+
+
+@app.route('/callbackStats', methods=['GET'])
+def callback_stats():
+    return jsonify(callback_dispatcher.stats()), 200
+
+
+@app.route('/queueStats', methods=['GET'])
+def queue_stats():
+    return jsonify(order_queue.stats()), 200
+
+
+@app.route('/ready', methods=['GET'])
+#Ready while the order queue can be read and the service is not shutting down
+def ready():
+    try:
+        order_queue.stats()
+        queue_readable = True
+    except Exception:
+        queue_readable = False
+    return ready_response(order_queue=queue_readable)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # One process: the waiting callbacks live in its memory, and only one process can receive the notifications
+    run(app, "order-management-service", 5000, single_process=True)
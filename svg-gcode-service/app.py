@@ -1,30 +1,187 @@
 import os
-import json
-import subprocess
+import sys
 import re
 import xml.etree.ElementTree as ET
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from converter_pool import ConverterPool, PoolFullError, ConversionTimeout, ConversionError
+from svg_preflatten import preflatten_svg, view_box, PreflattenError
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.batch import batch_response
+from common.configuration import watch_config
+from common.gcode_binary import MIMETYPE, encode
+from common.gcode_cache import GcodeCache
+from common.gcode_lexer import normalize
+from common.gcode_optimizer import optimize_for_config
+from common.gcode_simulator import MachineLimits
+from common import metrics
+from common.serving import run, ready_response
 
 app = Flask(__name__)
 
 # Path configuration for svg2gcode executable
 SVG2GCODE_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), 'svg2gcode'))
 SVG2GCODE_EXECUTABLE = os.path.abspath(os.path.join(SVG2GCODE_FOLDER, "target", "release", "svg2gcode"))
-CONFIG_FILE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
-
-config = {}
-try:
-    with open(CONFIG_FILE_PATH, 'r') as config_file:
-        config = json.load(config_file)
-    required_keys = [
-        'lower_left_corner_x', 'lower_left_corner_y',
-        'upper_right_corner_x', 'upper_right_corner_y',
-        'feedrate', 'z_drawing_height', 'z_safe_height'
+
+# config.json, validated once and replaced as a whole when the file changes. Pool sizes and the
+# like are read at startup, the calibration by every conversion from the current version
+config_watcher = watch_config()
+config = config_watcher.current
+
+# Worker threads shared by all requests, sized by config.json or the number of cores; each
+# keeps an `svg2gcode --serve` process alive unless svg2gcode_serve is false
+converter_pool = ConverterPool(
+    SVG2GCODE_FOLDER,
+    SVG2GCODE_EXECUTABLE,
+    workers=config.get('svg2gcode_workers'),
+    queue_size=config.get('svg2gcode_queue_size'),
+    timeout=config.get('svg2gcode_timeout', 30),
+    serve=config.get('svg2gcode_serve', True)
+)
+
+# Plotter limits for the time estimate in binary jobs
+machine_limits = MachineLimits.from_config(config)
+
+# Largest number of logos accepted by /svg2gcode/batch
+BATCH_MAX_ITEMS = config.get('batch_max_items', 500)
+
+# Repeated logos are served from the cache, it is emptied whenever the values of cache_params change
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cache'))
+gcode_cache = GcodeCache(
+    CACHE_DIR,
+    memory_items=config.get('cache_memory_items', 256),
+    disk_bytes=config.get('cache_disk_bytes', 64 * 1024 * 1024)
+)
+
+
+#Everything in config.json a conversion depends on besides the logo, part of its cache key.
+#Preflattening simplifies away detail below svg_simplify_tolerance mm at the size the logo is drawn
+def cache_params(config):
+    return dict(config.calibration(),
+                svg_preflatten=config.get('svg_preflatten', True),
+                svg_simplify_tolerance=config.get('svg_simplify_tolerance', 0.1))
+
+
+#A recalibration applies from the next conversion on, without a restart
+@config_watcher.subscribe
+def config_changed(old, new):
+    global machine_limits
+    machine_limits = MachineLimits.from_config(new)
+    if cache_params(old) != cache_params(new):
+        app.logger.warning("Calibration changed, emptying the G-code cache")
+        gcode_cache.invalidate()
+
+
+#Cache lookups by result, read by /metrics on every scrape
+def cache_lookups():
+    stats = gcode_cache.stats()
+    return {"memory_hit": stats["memory_hits"], "disk_hit": stats["disk_hits"], "miss": stats["misses"]}
+
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "svg-gcode-service", enabled=config.get('metrics_enabled', True))
+SVG2GCODE_SECONDS = metrics.histogram("svg2gcode_seconds", "Time of one svg2gcode run in the converter pool")
+PREFLATTEN_SECONDS = metrics.histogram("svg_preflatten_seconds", "Time to preflatten one SVG")
+metrics.collector("svg2gcode_workers_active", "Converter workers running svg2gcode",
+                  lambda: converter_pool.stats()["active"])
+metrics.collector("svg2gcode_queued", "Conversions waiting for a converter worker",
+                  lambda: converter_pool.stats()["queued"])
+metrics.collector("gcode_cache_lookups_total", "G-code cache lookups by result", cache_lookups,
+                  labels=("result",), kind="counter")
+metrics.collector("gcode_cache_hit_ratio", "Share of G-code cache lookups that were hits",
+                  lambda: gcode_cache.stats()["hit_rate"], aggregate="mean")
+
+
+#Convert an SVG to G-code, reusing the result of an identical earlier conversion
+def convert_svg(svg_code):
+    # One version of config.json for the key and the conversion, even if it is replaced meanwhile
+    config = config_watcher.current
+    key = GcodeCache.key("svg", svg_code, cache_params(config))
+    gcode = gcode_cache.get(key)
+    if gcode is None:
+        gcode = generate_svg_gcode(svg_code, config)
+        gcode_cache.put(key, gcode)
+    return gcode
+
+
+#Size of the drawing on the coaster in mm
+def final_size(root):
+    def extract_dimension(value):
+        return float(re.sub(r'[a-zA-Z]', '', value))  
+
+    svg_width = extract_dimension(root.attrib['width'])
+    svg_height = extract_dimension(root.attrib['height'])
+
+    # Set the images to the specific size to fit within dimensions
+    target_size = 200
+    if svg_width > svg_height:
+        manual_scaling_factor = target_size / svg_width
+    else:
+        manual_scaling_factor = target_size / svg_height
+
+    resized_width = svg_width * manual_scaling_factor
+    resized_height = svg_height * manual_scaling_factor
+
+    # Apply scaling factor for proper positioning and offsets
+    scaling_factor = 16 / 64  
+    return resized_width * scaling_factor, resized_height * scaling_factor
+
+
+#Simplify an SVG to the plotter's resolution at the size it is drawn, returns the new SVG and what was removed
+def preflatten(svg_code, root, config=None):
+    config = config or config_watcher.current
+    scaled_width, _ = final_size(root)
+    user_width = view_box(root)[2]
+    # The tolerance is in mm on the coaster, the SVG is simplified in its own user units
+    tolerance = cache_params(config)['svg_simplify_tolerance'] * user_width / scaled_width
+    return preflatten_svg(svg_code, tolerance)
+
+
+#Scale and center the SVG on the coaster and convert it to G-code
+def generate_svg_gcode(svg_code, config=None):
+    config = config or config_watcher.current
+    # Parse SVG to get the width and height attributes
+    tree = ET.ElementTree(ET.fromstring(svg_code))
+    root = tree.getroot()
+    scaled_width, scaled_height = final_size(root)
+
+    if cache_params(config)['svg_preflatten']:
+        try:
+            with PREFLATTEN_SECONDS.time():
+                svg_code, report = preflatten(svg_code, root, config)
+            app.logger.info("Preflattened SVG: %s", report)
+        except (PreflattenError, ET.ParseError, ValueError) as e:
+            # svg2gcode gets the original, it may still cope with what the preprocessor does not understand
+            app.logger.warning("SVG preflattening skipped: %s", e)
+
+    coaster_height = config['upper_right_corner_y'] - config['lower_left_corner_y']
+    available_svg_height = coaster_height * 3 / 4  
+
+    # Calculate the X origin for centering SVG horizontally and vertically 
+    coaster_width = config['upper_right_corner_x'] - config['lower_left_corner_x']
+    offset_x = (coaster_width - scaled_width) / 2
+    origin_x = config['lower_left_corner_x'] + offset_x
+    offset_y = (available_svg_height - scaled_height) / 2
+    origin_y = config['lower_left_corner_y'] + (coaster_height * 1 / 4) + offset_y  
+
+    origin = f"{origin_x},{origin_y}"  
+    dimensions = f"{scaled_width}mm,{scaled_height}mm"
+
+
+    command = [
+        SVG2GCODE_EXECUTABLE,
+        f"--origin={origin}",
+        f"--dimensions={dimensions}",
+        f"--feedrate={config['feedrate']}",
+        "--on", f"G0 Z{config['z_drawing_height']} ",
+        "--off", f"G0 Z{config['z_safe_height']} ",
+        "--end", "G0 Z-30 \n M2"
     ]
-    if not all(key in config for key in required_keys):
-        raise KeyError("Missing required keys in config.json.")
-except Exception as e:
-    config = {}
+
+    with SVG2GCODE_SECONDS.time():
+        gcode_content = converter_pool.run(command, svg_code)
+    # Flatten to one line of commands, dropping comments and anything that is not a G-code word
+    return normalize(gcode_content)
 
 
 @app.route('/svg2gcode', methods=['POST'])
@@ -40,79 +197,80 @@ def svg_to_gcode():
     if not svg_code:
         return jsonify({"status": "error", "message": "SVG code is required."}), 400
 
-    if not config:
+    if not config_watcher.current.calibrated:
         return jsonify({"status": "error", "message": "Configuration file is missing or invalid."}), 500
 
     try:
-        # Parse SVG to get the width and height attributes
-        tree = ET.ElementTree(ET.fromstring(svg_code))
-        root = tree.getroot()
-        def extract_dimension(value):
-            return float(re.sub(r'[a-zA-Z]', '', value))  
-
-        svg_width = extract_dimension(root.attrib['width'])
-        svg_height = extract_dimension(root.attrib['height'])
- 
-        # Set the images to the specific size to fit within dimensions
-        target_size = 200
-        if svg_width > svg_height:
-            manual_scaling_factor = target_size / svg_width
-        else:
-            manual_scaling_factor = target_size / svg_height
-
-        resized_width = svg_width * manual_scaling_factor
-        resized_height = svg_height * manual_scaling_factor
-
-        # Apply scaling factor for proper positioning and offsets
-        scaling_factor = 16 / 64  
-        scaled_width = resized_width * scaling_factor
-        scaled_height = resized_height * scaling_factor
-        
-        coaster_height = config['upper_right_corner_y'] - config['lower_left_corner_y']
-        available_svg_height = coaster_height * 3 / 4  
-
-        # Calculate the X origin for centering SVG horizontally and vertically 
-        coaster_width = config['upper_right_corner_x'] - config['lower_left_corner_x']
-        offset_x = (coaster_width - scaled_width) / 2
-        origin_x = config['lower_left_corner_x'] + offset_x
-        offset_y = (available_svg_height - scaled_height) / 2
-        origin_y = config['lower_left_corner_y'] + (coaster_height * 1 / 4) + offset_y  
-
-        origin = f"{origin_x},{origin_y}"  
-        dimensions = f"{scaled_width}mm,{scaled_height}mm"
-
-
-        command = [
-            SVG2GCODE_EXECUTABLE,
-            f"--origin={origin}",
-            f"--dimensions={dimensions}",
-            f"--feedrate={config['feedrate']}",
-            "--on", f"G0 Z{config['z_drawing_height']} ",
-            "--off", f"G0 Z{config['z_safe_height']} ",
-            "--end", "G0 Z-30 \n M2"
-        ]
-
-        result = subprocess.run(
-            command,
-            input=svg_code,  
-            capture_output=True,
-            text=True,
-            cwd=SVG2GCODE_FOLDER
-        )
-
-        if result.returncode == 0:
-            gcode_content = result.stdout.strip()
-            valid_gcode = re.sub(r'[^G0-9.\-XYZF;M2]', ' ', gcode_content)
-            valid_gcode = re.sub(r'\s+', ' ', valid_gcode)
-            return jsonify({"status": "success", "gcode": valid_gcode.strip()}), 200
-        else:
-            return jsonify({"status": "error", "message": result.stderr.strip()}), 500
-        
+        gcode = convert_svg(svg_code)
+        if request.accept_mimetypes.best == MIMETYPE:
+            # The compact binary job grbl-service accepts as well, instead of the G-code in JSON. It is
+            # optimized here, grbl-service streams binary jobs as they are
+            gcode, report = optimize_for_config(gcode, config_watcher.current, machine_limits)
+            return Response(encode(gcode, machine_limits, optimized=report is not None), mimetype=MIMETYPE)
+        return jsonify({"status": "success", "gcode": gcode}), 200
+
+    except PoolFullError as e:
+        return jsonify({"status": "error", "message": str(e)}), 429
+    except ConversionTimeout as e:
+        return jsonify({"status": "error", "message": str(e)}), 504
+    except ConversionError as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
     except FileNotFoundError:
         return jsonify({"status": "error", "message": "svg2gcode executable not found."}), 500
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
     
 
+@app.route('/svg2gcode/batch', methods=['POST'])
+#Convert a list of logos in one request, as many at once as the converter pool has workers
+def svg_to_gcode_batch():
+    data = request.get_json(silent=True) or {}
+    logos = data.get('logos')
+    if not isinstance(logos, list) or not logos:
+        return jsonify({"status": "error", "message": "A non-empty list of logos is required."}), 400
+    if len(logos) > BATCH_MAX_ITEMS:
+        return jsonify({"status": "error", "message": f"At most {BATCH_MAX_ITEMS} logos per batch."}), 413
+    if not config_watcher.current.calibrated:
+        return jsonify({"status": "error", "message": "Configuration file is missing or invalid."}), 500
+
+    def convert_item(svg_code):
+        if not isinstance(svg_code, str) or not svg_code:
+            raise ValueError("SVG code is required.")
+        return convert_svg(svg_code)
+
+    def describe_error(error):
+        if isinstance(error, FileNotFoundError):
+            return "svg2gcode executable not found."
+        return str(error)
+
+    # Keeping at most one conversion per worker in flight leaves the pool's queue to other requests
+    return batch_response(logos, convert_item, workers=converter_pool.workers, describe_error=describe_error)
+
+
+@app.route('/svg2gcode/preflatten', methods=['POST'])
+#Show what preflattening does to a logo: the simplified SVG and how much smaller it is
+def svg_preflatten():
+    data = request.get_json(silent=True) or {}
+    svg_code = data.get('logo') or request.form.get('logo')
+    if not svg_code:
+        return jsonify({"status": "error", "message": "SVG code is required."}), 400
+    try:
+        simplified, report = preflatten(svg_code, ET.fromstring(svg_code))
+    except (PreflattenError, ET.ParseError, KeyError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Cannot preflatten SVG: {e}"}), 400
+    return jsonify({"status": "success", "svg": simplified, "report": report}), 200
+
+
+@app.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    return jsonify(gcode_cache.stats()), 200
+
+
+@app.route('/ready', methods=['GET'])
+#Ready with a valid config.json and a built svg2gcode, unless the service is shutting down
+def ready():
+    return ready_response(config=config_watcher.current.calibrated, svg2gcode=os.path.exists(SVG2GCODE_EXECUTABLE))
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0", port=5003)
+    run(app, "svg-gcode-service", 5003)
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import queue
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Exit code of svg2gcode for command line errors, an executable built before --serve exits with it
+USAGE_ERROR = 2
+
+
+class PoolFullError(Exception):
+    pass
+
+
+class ConversionTimeout(Exception):
+    pass
+
+
+class ConversionError(Exception):
+    pass
+
+
+class _Job:
+
+    def __init__(self, command, input_text, deadline):
+        self.command = command
+        self.input_text = input_text
+        self.deadline = deadline
+        self.future = Future()
+
+
+class _ServeUnsupported(Exception):
+    pass
+
+
+class _Expired(Exception):
+    pass
+
+
+class _Converter:
+    """One `svg2gcode --serve` process converting the documents of one worker.
+
+    Requests and answers are framed as described by `--serve` in
+    svg2gcode/cli/src/main.rs. The process is killed when a conversion runs
+    past its deadline; a converter whose process died is not used again.
+    """
+
+    def __init__(self, executable, cwd):
+        self.process = subprocess.Popen(
+            [executable, "--serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd
+        )
+        self.answered = False
+        self.timed_out = False
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def convert(self, args, input_text, timeout):
+        request = json.dumps({"args": args, "svg": input_text}).encode()
+        timer = threading.Timer(timeout, self._expire)
+        timer.start()
+        try:
+            self.process.stdin.write(struct.pack(">I", len(request)) + request)
+            self.process.stdin.flush()
+            header = self._read(5)
+            status, length = struct.unpack(">BI", header)
+            answer = self._read(length).decode("utf-8", errors="replace")
+        except (OSError, EOFError, struct.error):
+            self.close()
+            if self.timed_out:
+                raise _Expired() from None
+            if not self.answered and self.process.returncode == USAGE_ERROR:
+                raise _ServeUnsupported() from None
+            raise ConversionError(f"svg2gcode exited with code {self.process.returncode}") from None
+        finally:
+            timer.cancel()
+        self.answered = True
+        if status != 0:
+            raise ConversionError(answer.strip())
+        return answer
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) < size:
+            raise EOFError()
+        return data
+
+    def _expire(self):
+        if self.alive():
+            self.timed_out = True
+            self.process.kill()
+
+
+class ConverterPool:
+    """Bounded pool of worker threads, each with its own svg2gcode converter.
+
+    Every worker keeps one `svg2gcode --serve` process alive and hands it its
+    jobs one after another, so a conversion does not pay for starting the
+    converter. A process that crashes or is killed is replaced before the
+    worker's next job. An executable built without `--serve` is detected on
+    its first run and the pool falls back to one process per job, as does
+    `serve=False`. At most `workers` conversions run at once, at most
+    `queue_size` wait for a free worker and further submissions are rejected
+    with PoolFullError. Every job has `timeout` seconds from submission until
+    its converter is killed.
+    """
+
+    def __init__(self, cwd, executable=None, workers=None, queue_size=None, timeout=30, serve=True):
+        self.cwd = cwd
+        self.executable = executable
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size if queue_size is not None else 2 * self.workers
+        self.timeout = timeout
+        self.serve = serve
+        self.jobs = queue.Queue(maxsize=self.queue_size)
+        self.active = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"svg2gcode-worker-{i}", daemon=True).start()
+
+    def submit(self, command, input_text):
+        job = _Job(command, input_text, time.monotonic() + self.timeout)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            raise PoolFullError("Too many conversions in progress, try again later.") from None
+        return job.future
+
+    def run(self, command, input_text):
+        """Convert in the pool and wait for the G-code."""
+        future = self.submit(command, input_text)
+        # The worker enforces the deadline, the grace period covers killing the process
+        return future.result(timeout=self.timeout + 5)
+
+    def stats(self):
+        return {"workers": self.workers, "active": self.active,
+                "queued": self.jobs.qsize(), "queue_size": self.queue_size,
+                "mode": "serve" if self.serve else "process", "restarts": self.restarts}
+
+    def _work(self):
+        # Started right away when the executable is known, so that the first conversions do not wait for it
+        converter = None
+        if self.serve and self.executable:
+            try:
+                converter = _Converter(self.executable, self.cwd)
+            except OSError as e:
+                logger.warning("Could not start svg2gcode: %s", e)
+        while True:
+            job = self.jobs.get()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.active += 1
+            try:
+                remaining = job.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConversionTimeout("Conversion timed out while waiting for a free worker.")
+                if self.serve:
+                    if converter is not None and not converter.alive():
+                        self._retire(converter)
+                        converter = None
+                    if converter is None:
+                        converter = _Converter(job.command[0], self.cwd)
+                    try:
+                        job.future.set_result(converter.convert(job.command[1:], job.input_text, remaining))
+                        continue
+                    except _Expired:
+                        raise ConversionTimeout(f"Conversion did not finish within {self.timeout} seconds.") from None
+                    except _ServeUnsupported:
+                        logger.warning("svg2gcode has no --serve mode, starting one process per conversion")
+                        self.serve = False
+                        converter = None
+                job.future.set_result(self._convert(job, remaining))
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def _retire(self, converter):
+        """Reap a converter whose process is gone, the worker starts a new one for its next job."""
+        converter.close()
+        with self.lock:
+            self.restarts += 1
+
+    def _convert(self, job, remaining):
+        process = subprocess.Popen(
+            job.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=self.cwd
+        )
+        try:
+            stdout, stderr = process.communicate(job.input_text, timeout=remaining)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise ConversionTimeout(f"Conversion did not finish within {self.timeout} seconds.")
+
+        if process.returncode != 0:
+            raise ConversionError(stderr.strip())
+        return stdout
@@ -9,6 +9,7 @@ use std::{
     env,
     fs::File,
     io::{self, Read, Write},
+    panic,
     path::PathBuf,
 };
 use svgtypes::LengthListParser;
@@ -86,6 +87,15 @@ struct Opt {
     ///
     /// Workaround for parsers that don't accept comments on the same line
     newline_before_comment: Option<bool>,
+    #[arg(long)]
+    /// Convert documents from standard input until it is closed, instead of one
+    ///
+    /// Every request is a 4-byte big-endian length followed by a JSON object
+    /// `{"args": [...], "svg": "..."}`, where `args` are the options of that
+    /// conversion as they would be passed on the command line. Every answer is
+    /// one status byte (0 for G-code, 1 for an error message), a 4-byte
+    /// big-endian length and the G-code or the message.
+    serve: bool,
 }
 
 fn main() -> io::Result<()> {
@@ -96,90 +106,16 @@ fn main() -> io::Result<()> {
 
     let opt = Opt::parse();
 
-    let settings = {
-        let mut settings = if let Some(path) = opt.settings {
-            serde_json::from_reader(File::open(path)?)?
-        } else {
-            Settings::default()
-        };
-
-        {
-            let conversion = &mut settings.conversion;
-            conversion.dpi = opt.dpi.unwrap_or(conversion.dpi);
-            conversion.feedrate = opt.feedrate.unwrap_or(conversion.feedrate);
-            conversion.tolerance = opt.tolerance.unwrap_or(conversion.tolerance);
-        }
-        {
-            let machine = &mut settings.machine;
-            machine.supported_functionality = SupportedFunctionality {
-                circular_interpolation: opt
-                    .circular_interpolation
-                    .unwrap_or(machine.supported_functionality.circular_interpolation),
-            };
-            if let seq @ Some(_) = opt.tool_on_sequence {
-                machine.tool_on_sequence = seq;
-            }
-            if let seq @ Some(_) = opt.tool_off_sequence {
-                machine.tool_off_sequence = seq;
-            }
-            if let seq @ Some(_) = opt.begin_sequence {
-                machine.begin_sequence = seq;
-            }
-            if let seq @ Some(_) = opt.end_sequence {
-                machine.end_sequence = seq;
-            }
-        }
-        {
-            if let Some(origin) = opt.origin {
-                for (i, dimension_origin) in origin
-                    .split(',')
-                    .map(|point| {
-                        if point.is_empty() {
-                            Default::default()
-                        } else {
-                            point.parse::<f64>().expect("could not parse coordinate")
-                        }
-                    })
-                    .take(2)
-                    .enumerate()
-                {
-                    settings.conversion.origin[i] = Some(dimension_origin);
-                }
-            }
-        }
-
-        if let Some(line_numbers) = opt.line_numbers {
-            settings.postprocess.line_numbers = line_numbers;
-        }
-
-        if let Some(checksums) = opt.checksums {
-            settings.postprocess.checksums = checksums;
-        }
-
-        if let Some(newline_before_comment) = opt.newline_before_comment {
-            settings.postprocess.newline_before_comment = newline_before_comment;
-        }
-
-        if let Version::Unknown(ref unknown) = settings.version {
-            error!(
-                "Your settings use an unknown version. Your version: {unknown}, latest: {}. See {} to download the latest CLI version.",
-                Version::latest(),
-                env!("CARGO_PKG_REPOSITORY"),
-            );
-            std::process::exit(1);
-        }
+    if opt.serve {
+        return serve();
+    }
 
-        let old_version = settings.version.clone();
-        if let Err(msg) = settings.try_upgrade() {
-            error!(
-                "Your settings are out of date and require manual intervention: {msg}. Your version: {old_version}, latest: {}. See {} for instructions.",
-                Version::latest(),
-                env!("CARGO_PKG_REPOSITORY"),
-            );
+    let settings = match load_settings(&opt) {
+        Ok(settings) => settings,
+        Err(msg) => {
+            error!("{msg}");
             std::process::exit(1);
         }
-
-        settings
     };
 
     if let Some(export_path) = opt.export {
@@ -191,30 +127,7 @@ fn main() -> io::Result<()> {
         }
     }
 
-    let options = {
-        let mut dimensions = [None, None];
-
-        if let Some(dimensions_str) = opt.dimensions {
-            dimensions_str
-                .split(',')
-                .map(|dimension_str| {
-                    if dimension_str.is_empty() {
-                        None
-                    } else {
-                        LengthListParser::from(dimension_str)
-                            .next()
-                            .transpose()
-                            .expect("could not parse dimension")
-                    }
-                })
-                .take(2)
-                .enumerate()
-                .for_each(|(i, dimension_origin)| {
-                    dimensions[i] = dimension_origin;
-                });
-        }
-        ConversionOptions { dimensions }
-    };
+    let options = conversion_options(opt.dimensions.as_deref());
 
     let input = match opt.file {
         Some(filename) => {
@@ -333,3 +246,237 @@ fn main() -> io::Result<()> {
         )
     }
 }
+
+/// Settings of the JSON file given by `--settings`, or the defaults, overridden by the other options
+fn load_settings(opt: &Opt) -> Result<Settings, String> {
+    let mut settings: Settings = if let Some(path) = &opt.settings {
+        let file = File::open(path).map_err(|err| format!("Cannot open {}: {err}", path.display()))?;
+        serde_json::from_reader(file).map_err(|err| format!("Invalid settings in {}: {err}", path.display()))?
+    } else {
+        Settings::default()
+    };
+
+    {
+        let conversion = &mut settings.conversion;
+        conversion.dpi = opt.dpi.unwrap_or(conversion.dpi);
+        conversion.feedrate = opt.feedrate.unwrap_or(conversion.feedrate);
+        conversion.tolerance = opt.tolerance.unwrap_or(conversion.tolerance);
+    }
+    {
+        let machine = &mut settings.machine;
+        machine.supported_functionality = SupportedFunctionality {
+            circular_interpolation: opt
+                .circular_interpolation
+                .unwrap_or(machine.supported_functionality.circular_interpolation),
+        };
+        if let seq @ Some(_) = opt.tool_on_sequence.clone() {
+            machine.tool_on_sequence = seq;
+        }
+        if let seq @ Some(_) = opt.tool_off_sequence.clone() {
+            machine.tool_off_sequence = seq;
+        }
+        if let seq @ Some(_) = opt.begin_sequence.clone() {
+            machine.begin_sequence = seq;
+        }
+        if let seq @ Some(_) = opt.end_sequence.clone() {
+            machine.end_sequence = seq;
+        }
+    }
+    {
+        if let Some(origin) = &opt.origin {
+            for (i, dimension_origin) in origin
+                .split(',')
+                .map(|point| {
+                    if point.is_empty() {
+                        Default::default()
+                    } else {
+                        point.parse::<f64>().expect("could not parse coordinate")
+                    }
+                })
+                .take(2)
+                .enumerate()
+            {
+                settings.conversion.origin[i] = Some(dimension_origin);
+            }
+        }
+    }
+
+    if let Some(line_numbers) = opt.line_numbers {
+        settings.postprocess.line_numbers = line_numbers;
+    }
+
+    if let Some(checksums) = opt.checksums {
+        settings.postprocess.checksums = checksums;
+    }
+
+    if let Some(newline_before_comment) = opt.newline_before_comment {
+        settings.postprocess.newline_before_comment = newline_before_comment;
+    }
+
+    if let Version::Unknown(ref unknown) = settings.version {
+        return Err(format!(
+            "Your settings use an unknown version. Your version: {unknown}, latest: {}. See {} to download the latest CLI version.",
+            Version::latest(),
+            env!("CARGO_PKG_REPOSITORY"),
+        ));
+    }
+
+    let old_version = settings.version.clone();
+    if let Err(msg) = settings.try_upgrade() {
+        return Err(format!(
+            "Your settings are out of date and require manual intervention: {msg}. Your version: {old_version}, latest: {}. See {} for instructions.",
+            Version::latest(),
+            env!("CARGO_PKG_REPOSITORY"),
+        ));
+    }
+
+    Ok(settings)
+}
+
+/// Width and height overrides given by `--dimensions`
+fn conversion_options(dimensions_str: Option<&str>) -> ConversionOptions {
+    let mut dimensions = [None, None];
+
+    if let Some(dimensions_str) = dimensions_str {
+        dimensions_str
+            .split(',')
+            .map(|dimension_str| {
+                if dimension_str.is_empty() {
+                    None
+                } else {
+                    LengthListParser::from(dimension_str)
+                        .next()
+                        .transpose()
+                        .expect("could not parse dimension")
+                }
+            })
+            .take(2)
+            .enumerate()
+            .for_each(|(i, dimension_origin)| {
+                dimensions[i] = dimension_origin;
+            });
+    }
+    ConversionOptions { dimensions }
+}
+
+/// Answer conversion requests from standard input until it is closed, see `--serve`
+///
+/// A request that fails, even by panicking, is answered with its error and
+/// the process goes on with the next one.
+fn serve() -> io::Result<()> {
+    let stdin = io::stdin();
+    let mut input = stdin.lock();
+    let stdout = io::stdout();
+    let mut output = stdout.lock();
+
+    loop {
+        let mut length = [0u8; 4];
+        match input.read_exact(&mut length) {
+            Ok(()) => {}
+            Err(err) if err.kind() == io::ErrorKind::UnexpectedEof => return Ok(()),
+            Err(err) => return Err(err),
+        }
+        let mut request = vec![0u8; u32::from_be_bytes(length) as usize];
+        input.read_exact(&mut request)?;
+
+        let result = panic::catch_unwind(|| convert_request(&request)).unwrap_or_else(|payload| {
+            let reason = payload
+                .downcast_ref::<&str>()
+                .map(|reason| reason.to_string())
+                .or_else(|| payload.downcast_ref::<String>().cloned())
+                .unwrap_or_else(|| "unknown error".to_string());
+            Err(format!("svg2gcode panicked: {reason}"))
+        });
+        let (status, answer) = match result {
+            Ok(gcode) => (0u8, gcode),
+            Err(msg) => (1u8, msg.into_bytes()),
+        };
+        output.write_all(&[status])?;
+        output.write_all(&(answer.len() as u32).to_be_bytes())?;
+        output.write_all(&answer)?;
+        output.flush()?;
+    }
+}
+
+/// Convert the SVG of one `--serve` request with the options it carries
+fn convert_request(request: &[u8]) -> Result<Vec<u8>, String> {
+    let request: serde_json::Value =
+        serde_json::from_slice(request).map_err(|err| format!("Invalid request: {err}"))?;
+    let args = request["args"]
+        .as_array()
+        .ok_or("Request without args")?
+        .iter()
+        .map(|arg| arg.as_str().map(str::to_owned).ok_or("Request args must be strings"))
+        .collect::<Result<Vec<_>, _>>()?;
+    let svg = request["svg"].as_str().ok_or("Request without svg")?;
+
+    let opt = Opt::try_parse_from(std::iter::once("svg2gcode".to_owned()).chain(args))
+        .map_err(|err| err.to_string())?;
+    let settings = load_settings(&opt)?;
+    let options = conversion_options(opt.dimensions.as_deref());
+
+    let snippets = [
+        settings
+            .machine
+            .tool_on_sequence
+            .as_deref()
+            .map(snippet_parser)
+            .transpose(),
+        settings
+            .machine
+            .tool_off_sequence
+            .as_deref()
+            .map(snippet_parser)
+            .transpose(),
+        settings
+            .machine
+            .begin_sequence
+            .as_deref()
+            .map(snippet_parser)
+            .transpose(),
+        settings
+            .machine
+            .end_sequence
+            .as_deref()
+            .map(snippet_parser)
+            .transpose(),
+    ];
+    let machine = if let [Ok(tool_on_action), Ok(tool_off_action), Ok(program_begin_sequence), Ok(program_end_sequence)] =
+        snippets
+    {
+        Machine::new(
+            settings.machine.supported_functionality.clone(),
+            tool_on_action,
+            tool_off_action,
+            program_begin_sequence,
+            program_end_sequence,
+        )
+    } else {
+        return Err("Invalid G-code in the tool on/off, begin or end sequence".to_owned());
+    };
+
+    let document = roxmltree::Document::parse_with_options(
+        svg,
+        ParsingOptions {
+            allow_dtd: true,
+            ..Default::default()
+        },
+    )
+    .map_err(|err| format!("Invalid SVG: {err}"))?;
+
+    let program = svg2program(&document, &settings.conversion, options, machine);
+
+    let mut gcode = Vec::new();
+    format_gcode_io(
+        &program,
+        FormatOptions {
+            line_numbers: settings.postprocess.line_numbers,
+            checksums: settings.postprocess.checksums,
+            newline_before_comment: settings.postprocess.newline_before_comment,
+            ..Default::default()
+        },
+        &mut gcode,
+    )
+    .map_err(|err| err.to_string())?;
+    Ok(gcode)
+}
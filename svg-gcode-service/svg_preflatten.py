@@ -0,0 +1,497 @@
+import math
+import re
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# Elements whose children are drawn, elements that are drawn, and elements never drawn directly
+CONTAINERS = {"svg", "g", "a", "switch"}
+SHAPES = {"path", "rect", "circle", "ellipse", "line", "polyline", "polygon"}
+NOT_RENDERED = {"defs", "symbol", "clipPath", "mask", "pattern", "marker", "linearGradient", "radialGradient",
+                "filter", "metadata", "title", "desc", "style", "script"}
+
+NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+COMMAND = re.compile(r"[MmZzLlHhVvCcSsQqTtAa]")
+SEPARATOR = re.compile(r"[\s,]*")
+TRANSFORM = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+LENGTH = re.compile(r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+
+IDENTITY = np.eye(3)
+
+# Most elements visited per document, counting every instance a <use> expands, beyond it the SVG is rejected
+MAX_VISITED = 20000
+
+
+class PreflattenError(Exception):
+    pass
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def _length(value, default=0.0):
+    if value is None:
+        return default
+    match = LENGTH.match(value)
+    return float(match.group(1)) if match else default
+
+
+def _style(element):
+    """Presentation attributes overridden by the style attribute."""
+    properties = {key: element.attrib[key] for key in
+                  ("display", "visibility", "opacity", "fill", "stroke", "fill-opacity", "stroke-opacity")
+                  if key in element.attrib}
+    for declaration in element.attrib.get("style", "").split(";"):
+        if ":" in declaration:
+            key, value = declaration.split(":", 1)
+            properties[key.strip()] = value.strip()
+    return properties
+
+
+def _parse_transform(value):
+    matrix = np.eye(3)
+    for name, arguments in TRANSFORM.findall(value or ""):
+        args = [float(number) for number in NUMBER.findall(arguments)]
+        if name == "matrix" and len(args) == 6:
+            step = np.array([[args[0], args[2], args[4]], [args[1], args[3], args[5]], [0, 0, 1]])
+        elif name == "translate" and args:
+            step = np.array([[1, 0, args[0]], [0, 1, args[1] if len(args) > 1 else 0], [0, 0, 1]])
+        elif name == "scale" and args:
+            step = np.diag([args[0], args[1] if len(args) > 1 else args[0], 1.0])
+        elif name == "rotate" and args:
+            angle = math.radians(args[0])
+            cos, sin = math.cos(angle), math.sin(angle)
+            step = np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+            if len(args) == 3:
+                cx, cy = args[1], args[2]
+                step = np.array([[1, 0, cx], [0, 1, cy], [0, 0, 1]]) @ step @ np.array([[1, 0, -cx], [0, 1, -cy], [0, 0, 1]])
+        elif name == "skewX" and args:
+            step = np.array([[1, math.tan(math.radians(args[0])), 0], [0, 1, 0], [0, 0, 1]])
+        elif name == "skewY" and args:
+            step = np.array([[1, 0, 0], [math.tan(math.radians(args[0])), 1, 0], [0, 0, 1]])
+        else:
+            continue
+        matrix = matrix @ step
+    return matrix
+
+
+# ------------------ Path flattening ------------------
+
+def _cubic(p0, p1, p2, p3, tolerance):
+    # The chord error of n uniform steps is bounded by max|B''| / (8 n^2)
+    second = 6 * max(np.hypot(*(p0 - 2 * p1 + p2)), np.hypot(*(p1 - 2 * p2 + p3)))
+    steps = max(1, math.ceil(math.sqrt(second / (8 * tolerance))))
+    t = np.linspace(0, 1, steps + 1)[1:, None]
+    return (1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1 + 3 * (1 - t) * t ** 2 * p2 + t ** 3 * p3
+
+
+def _quadratic(p0, p1, p2, tolerance):
+    second = 2 * np.hypot(*(p0 - 2 * p1 + p2))
+    steps = max(1, math.ceil(math.sqrt(second / (8 * tolerance))))
+    t = np.linspace(0, 1, steps + 1)[1:, None]
+    return (1 - t) ** 2 * p0 + 2 * (1 - t) * t * p1 + t ** 2 * p2
+
+
+def _arc(p0, rx, ry, rotation, large_arc, sweep, p1, tolerance):
+    """Points of an SVG elliptical arc, from its endpoint to its center parameterization."""
+    if rx == 0 or ry == 0 or np.allclose(p0, p1):
+        return p1[None, :]
+    rx, ry = abs(rx), abs(ry)
+    phi = math.radians(rotation)
+    cos, sin = math.cos(phi), math.sin(phi)
+    dx, dy = (p0 - p1) / 2
+    x1 = cos * dx + sin * dy
+    y1 = -sin * dx + cos * dy
+    # Radii too small for the endpoints are scaled up, as the SVG spec prescribes
+    scale = x1 ** 2 / rx ** 2 + y1 ** 2 / ry ** 2
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    numerator = rx ** 2 * ry ** 2 - rx ** 2 * y1 ** 2 - ry ** 2 * x1 ** 2
+    denominator = rx ** 2 * y1 ** 2 + ry ** 2 * x1 ** 2
+    factor = math.sqrt(max(0.0, numerator / denominator)) if denominator else 0.0
+    if large_arc == sweep:
+        factor = -factor
+    cx1, cy1 = factor * rx * y1 / ry, -factor * ry * x1 / rx
+    center = np.array([cos * cx1 - sin * cy1, sin * cx1 + cos * cy1]) + (p0 + p1) / 2
+    start = math.atan2((y1 - cy1) / ry, (x1 - cx1) / rx)
+    end = math.atan2((-y1 - cy1) / ry, (-x1 - cx1) / rx)
+    delta = end - start
+    if sweep and delta < 0:
+        delta += 2 * math.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * math.pi
+    radius = max(rx, ry)
+    step = 2 * math.acos(max(-1.0, 1 - tolerance / radius)) if tolerance < radius else math.pi / 2
+    steps = max(1, math.ceil(abs(delta) / step))
+    angles = start + delta * np.linspace(0, 1, steps + 1)[1:]
+    x = rx * np.cos(angles)
+    y = ry * np.sin(angles)
+    points = np.column_stack((cos * x - sin * y, sin * x + cos * y)) + center
+    points[-1] = p1
+    return points
+
+
+class _PathReader:
+    """Reads numbers and arc flags from SVG path data, which may omit separators."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def _skip(self):
+        self.position = SEPARATOR.match(self.data, self.position).end()
+
+    def command(self):
+        self._skip()
+        match = COMMAND.match(self.data, self.position)
+        if match:
+            self.position = match.end()
+            return match.group()
+        return None
+
+    def has_number(self):
+        self._skip()
+        return NUMBER.match(self.data, self.position) is not None
+
+    def number(self):
+        self._skip()
+        match = NUMBER.match(self.data, self.position)
+        if not match:
+            raise PreflattenError(f"Number expected in path data at {self.position}.")
+        self.position = match.end()
+        return float(match.group())
+
+    def flag(self):
+        self._skip()
+        if self.position < len(self.data) and self.data[self.position] in "01":
+            self.position += 1
+            return self.data[self.position - 1] == "1"
+        raise PreflattenError(f"Arc flag expected in path data at {self.position}.")
+
+    def done(self):
+        self._skip()
+        return self.position >= len(self.data)
+
+
+def flatten_path(data, tolerance):
+    """Split path data into polylines (arrays of points), curves and arcs flattened to `tolerance`."""
+    reader = _PathReader(data)
+    polylines = []
+    current = []
+    position = np.zeros(2)
+    start = np.zeros(2)
+    last_control = None
+    command = None
+
+    def finish():
+        if len(current) > 1:
+            polylines.append(np.vstack(current))
+        current.clear()
+
+    while not reader.done():
+        explicit = reader.command()
+        if explicit:
+            command = explicit
+        elif command is None:
+            raise PreflattenError("Path data does not start with a command.")
+        elif command in "Mm":
+            # Coordinates after a moveto are implicit linetos
+            command = "l" if command == "m" else "L"
+        relative = command.islower()
+        origin = position if relative else np.zeros(2)
+        kind = command.upper()
+        control = None
+
+        if kind == "Z":
+            if current:
+                current.append(start[None, :])
+            finish()
+            position = start.copy()
+            current.append(position[None, :])
+            last_control = None
+            continue
+        if not reader.has_number():
+            raise PreflattenError(f"Missing coordinates for '{command}'.")
+
+        if kind == "M":
+            finish()
+            position = origin + [reader.number(), reader.number()]
+            start = position.copy()
+            current.append(position[None, :])
+        elif kind == "L":
+            position = origin + [reader.number(), reader.number()]
+            current.append(position[None, :])
+        elif kind == "H":
+            position = np.array([(position[0] if relative else 0) + reader.number(), position[1]])
+            current.append(position[None, :])
+        elif kind == "V":
+            position = np.array([position[0], (position[1] if relative else 0) + reader.number()])
+            current.append(position[None, :])
+        elif kind in "CS":
+            if kind == "C":
+                p1 = origin + [reader.number(), reader.number()]
+            else:
+                p1 = 2 * position - last_control[0] if last_control is not None and last_control[1] == "C" else position
+            p2 = origin + [reader.number(), reader.number()]
+            p3 = origin + [reader.number(), reader.number()]
+            current.append(_cubic(position, p1, p2, p3, tolerance))
+            position, control = p3, (p2, "C")
+        elif kind in "QT":
+            if kind == "Q":
+                p1 = origin + [reader.number(), reader.number()]
+            else:
+                p1 = 2 * position - last_control[0] if last_control is not None and last_control[1] == "Q" else position
+            p2 = origin + [reader.number(), reader.number()]
+            current.append(_quadratic(position, p1, p2, tolerance))
+            position, control = p2, (p1, "Q")
+        elif kind == "A":
+            rx, ry, rotation = reader.number(), reader.number(), reader.number()
+            large_arc, sweep = reader.flag(), reader.flag()
+            end = origin + [reader.number(), reader.number()]
+            current.append(_arc(position, rx, ry, rotation, large_arc, sweep, end, tolerance))
+            position = end
+        if not current:
+            current.append(position[None, :])
+        last_control = control
+    finish()
+    return polylines
+
+
+def _shape_path(name, attrib):
+    """Path data of a basic shape."""
+    number = lambda key: _length(attrib.get(key))
+    if name == "path":
+        return attrib.get("d", "")
+    if name == "line":
+        return f"M{number('x1')},{number('y1')} L{number('x2')},{number('y2')}"
+    if name in ("polyline", "polygon"):
+        points = NUMBER.findall(attrib.get("points", ""))
+        if len(points) < 4:
+            return ""
+        pairs = [f"{points[i]},{points[i + 1]}" for i in range(0, len(points) - 1, 2)]
+        return "M" + " L".join(pairs) + (" Z" if name == "polygon" else "")
+    if name in ("circle", "ellipse"):
+        cx, cy = number('cx'), number('cy')
+        rx = number('r') if name == "circle" else number('rx')
+        ry = number('r') if name == "circle" else number('ry')
+        if rx <= 0 or ry <= 0:
+            return ""
+        return f"M{cx - rx},{cy} A{rx},{ry} 0 1 0 {cx + rx},{cy} A{rx},{ry} 0 1 0 {cx - rx},{cy} Z"
+    if name == "rect":
+        x, y, width, height = number('x'), number('y'), number('width'), number('height')
+        if width <= 0 or height <= 0:
+            return ""
+        rx, ry = attrib.get('rx'), attrib.get('ry')
+        rx = _length(rx if rx is not None else ry)
+        ry = _length(ry if ry is not None else attrib.get('rx'))
+        rx, ry = min(rx, width / 2), min(ry, height / 2)
+        if rx <= 0 or ry <= 0:
+            return f"M{x},{y} H{x + width} V{y + height} H{x} Z"
+        return (f"M{x + rx},{y} H{x + width - rx} A{rx},{ry} 0 0 1 {x + width},{y + ry} V{y + height - ry} "
+                f"A{rx},{ry} 0 0 1 {x + width - rx},{y + height} H{x + rx} A{rx},{ry} 0 0 1 {x},{y + height - ry} "
+                f"V{y + ry} A{rx},{ry} 0 0 1 {x + rx},{y} Z")
+    return ""
+
+
+# ------------------ Simplification ------------------
+
+def simplify(points, tolerance):
+    """Ramer-Douglas-Peucker: keep the points needed to stay within `tolerance` of the polyline."""
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        segment = b - a
+        inner = points[first + 1:last]
+        length = math.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(*(inner - a).T)
+        else:
+            distances = np.abs(segment[0] * (inner[:, 1] - a[1]) - segment[1] * (inner[:, 0] - a[0])) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+# ------------------ Document ------------------
+
+def view_box(root):
+    """The root's viewBox as [x, y, width, height], its width and height in user units without one."""
+    values = [float(number) for number in NUMBER.findall(root.attrib.get("viewBox", ""))]
+    if len(values) == 4 and values[2] > 0 and values[3] > 0:
+        return values
+    width, height = _length(root.attrib.get("width")), _length(root.attrib.get("height"))
+    return [0.0, 0.0, width, height] if width > 0 and height > 0 else None
+
+
+def _is_hidden(style, inherited):
+    if style.get("display") == "none":
+        return True
+    if inherited["visibility"] in ("hidden", "collapse"):
+        return True
+    if inherited["opacity"] <= 0:
+        return True
+    fill_off = inherited["fill"] == "none" or inherited["fill_opacity"] <= 0
+    stroke_off = inherited["stroke"] == "none" or inherited["stroke_opacity"] <= 0
+    return fill_off and stroke_off
+
+
+def preflatten_svg(svg_code, tolerance):
+    """Rewrite an SVG as simplified polylines in the root's user space.
+
+    Hidden elements and elements entirely outside the viewBox are dropped,
+    transforms are applied, curves are flattened and every polyline is
+    simplified so that it stays within `tolerance` user units of the
+    original. The root's width, height and viewBox are kept, so the result
+    converts at the same size. Returns the new SVG and a report. A <use>
+    that refers back to an element it is part of is skipped, and documents
+    expanding to more than MAX_VISITED elements raise PreflattenError.
+    """
+    started = time.perf_counter()
+    root = ET.fromstring(svg_code)
+    if _local_name(root.tag) != "svg":
+        raise PreflattenError("The document is not an SVG.")
+    bounds = view_box(root)
+    ids = {element.attrib["id"]: element for element in root.iter() if "id" in element.attrib}
+    counts = {"elements": 0, "hidden": 0, "outside_view_box": 0, "unsupported": 0}
+    points_before = 0
+    visited = 0
+    # ids of the elements being visited, a <use> of one of them would expand itself again
+    expanding = set()
+    polylines = []
+
+    def visit(element, matrix, inherited, depth):
+        nonlocal points_before, visited
+        name = _local_name(element.tag)
+        if name in NOT_RENDERED or depth > 50:
+            return
+        visited += 1
+        if visited > MAX_VISITED:
+            raise PreflattenError(f"The document expands to more than {MAX_VISITED} elements.")
+        style = _style(element)
+        state = dict(inherited)
+        if "visibility" in style:
+            state["visibility"] = style["visibility"]
+        for key, field in (("fill", "fill"), ("stroke", "stroke")):
+            if key in style:
+                state[field] = style[key]
+        for key, field in (("opacity", "opacity"), ("fill-opacity", "fill_opacity"), ("stroke-opacity", "stroke_opacity")):
+            if key in style:
+                factor = _length(style[key], 1.0)
+                state[field] = state[field] * factor if field == "opacity" else factor
+        matrix = matrix @ _parse_transform(element.attrib.get("transform"))
+
+        if name in CONTAINERS or name == "use":
+            if style.get("display") == "none" or state["opacity"] <= 0:
+                counts["hidden"] += sum(1 for child in element.iter() if _local_name(child.tag) in SHAPES)
+                return
+            if element is not root and name == "svg":
+                matrix = matrix @ _parse_transform(f"translate({_length(element.attrib.get('x'))},{_length(element.attrib.get('y'))})")
+            if name == "use":
+                target = (element.attrib.get("href") or element.attrib.get(XLINK_HREF) or "").lstrip("#")
+                reference = ids.get(target)
+                if reference is None:
+                    return
+                if target in expanding:
+                    counts["unsupported"] += 1
+                    return
+                matrix = matrix @ _parse_transform(f"translate({_length(element.attrib.get('x'))},{_length(element.attrib.get('y'))})")
+                expanding.add(target)
+                try:
+                    visit(reference, matrix, state, depth + 1)
+                finally:
+                    expanding.discard(target)
+                return
+            element_id = element.attrib.get("id")
+            entered = element_id is not None and element_id not in expanding
+            if entered:
+                expanding.add(element_id)
+            try:
+                for child in element:
+                    visit(child, matrix, state, depth + 1)
+            finally:
+                if entered:
+                    expanding.discard(element_id)
+            return
+
+        if name not in SHAPES:
+            if name:
+                counts["unsupported"] += 1
+            return
+        counts["elements"] += 1
+        if _is_hidden(style, state):
+            counts["hidden"] += 1
+            return
+
+        # Flatten in the element's own coordinates, finely enough for the largest scale of its transform
+        local_scale = max(np.linalg.norm(matrix[:2, :2], 2), 1e-12)
+        try:
+            shapes = flatten_path(_shape_path(name, element.attrib), tolerance / 2 / local_scale)
+        except PreflattenError:
+            counts["unsupported"] += 1
+            return
+        transformed = [points @ matrix[:2, :2].T + matrix[:2, 2] for points in shapes]
+        if bounds is not None and transformed:
+            low = np.min([points.min(axis=0) for points in transformed], axis=0)
+            high = np.max([points.max(axis=0) for points in transformed], axis=0)
+            if (high[0] < bounds[0] or high[1] < bounds[1]
+                    or low[0] > bounds[0] + bounds[2] or low[1] > bounds[1] + bounds[3]):
+                counts["outside_view_box"] += 1
+                return
+        for points in transformed:
+            points_before += len(points)
+            polylines.append(simplify(points, tolerance / 2))
+
+    initial = {"visibility": "visible", "opacity": 1.0, "fill": "black", "stroke": "none",
+               "fill_opacity": 1.0, "stroke_opacity": 1.0}
+    # The root's own transform and viewBox mapping stay on the root element
+    for child in root:
+        visit(child, IDENTITY, _root_state(root, initial), 0)
+
+    digits = max(0, math.ceil(-math.log10(tolerance / 10))) if tolerance > 0 else 3
+    paths = []
+    for points in polylines:
+        coordinates = " L".join(f"{x:.{digits}f},{y:.{digits}f}" for x, y in points)
+        paths.append(f'<path d="M{coordinates}" fill="none" stroke="black"/>')
+    attributes = "".join(f' {key}="{root.attrib[key]}"' for key in ("width", "height", "viewBox", "transform",
+                                                                  "preserveAspectRatio") if key in root.attrib)
+    output = f'<svg xmlns="{SVG_NS}"{attributes}>' + "".join(paths) + "</svg>"
+
+    points_after = sum(len(points) for points in polylines)
+    report = {
+        "shapes": counts["elements"],
+        "dropped_hidden": counts["hidden"],
+        "dropped_outside_view_box": counts["outside_view_box"],
+        "skipped_unsupported": counts["unsupported"],
+        "polylines": len(polylines),
+        "points_before": points_before,
+        "points_after": points_after,
+        "bytes_before": len(svg_code.encode("utf-8")),
+        "bytes_after": len(output.encode("utf-8")),
+        "preflatten_seconds": round(time.perf_counter() - started, 4)
+    }
+    return output, report
+
+
+def _root_state(root, initial):
+    style = _style(root)
+    state = dict(initial)
+    for key, field in (("visibility", "visibility"), ("fill", "fill"), ("stroke", "stroke")):
+        if key in style:
+            state[field] = style[key]
+    return state
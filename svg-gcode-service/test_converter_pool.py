@@ -0,0 +1,71 @@
+import stat
+import sys
+
+import pytest
+
+from converter_pool import ConversionError, ConversionTimeout, ConverterPool
+
+# Speaks the --serve framing of svg2gcode/cli/src/main.rs and answers with its pid, or converts once without --serve
+FAKE_SVG2GCODE = f"""#!{sys.executable}
+import json, os, struct, sys, time
+if "--serve" not in sys.argv:
+    sys.stdout.write("once " + sys.stdin.read())
+    sys.exit(0)
+if os.environ.get("FAKE_NO_SERVE"):
+    sys.exit(2)
+while True:
+    header = sys.stdin.buffer.read(4)
+    if len(header) < 4:
+        break
+    request = json.loads(sys.stdin.buffer.read(struct.unpack(">I", header)[0]))
+    if request["svg"] == "crash":
+        os._exit(3)
+    if request["svg"] == "hang":
+        time.sleep(60)
+    status, answer = (1, b"Invalid SVG") if request["svg"] == "bad" else (0, f"{{os.getpid()}} {{request['args']}}".encode())
+    sys.stdout.buffer.write(struct.pack(">BI", status, len(answer)) + answer)
+    sys.stdout.buffer.flush()
+"""
+
+
+@pytest.fixture
+def executable(tmp_path):
+    path = tmp_path / "svg2gcode"
+    path.write_text(FAKE_SVG2GCODE)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_conversions_reuse_one_process(tmp_path, executable):
+    pool = ConverterPool(str(tmp_path), executable, workers=1)
+    first = pool.run([executable, "--dpi", "96"], "<svg/>")
+    second = pool.run([executable], "<svg/>")
+    assert first.split()[0] == second.split()[0]
+    assert first.endswith("['--dpi', '96']")
+    assert pool.stats()["mode"] == "serve"
+
+
+def test_failed_conversion_keeps_the_process(tmp_path, executable):
+    pool = ConverterPool(str(tmp_path), executable, workers=1)
+    pid = pool.run([executable], "<svg/>").split()[0]
+    with pytest.raises(ConversionError, match="Invalid SVG"):
+        pool.run([executable], "bad")
+    assert pool.run([executable], "<svg/>").split()[0] == pid
+
+
+@pytest.mark.parametrize("svg, error", [("crash", ConversionError), ("hang", ConversionTimeout)])
+def test_dead_or_killed_process_is_replaced(tmp_path, executable, svg, error):
+    pool = ConverterPool(str(tmp_path), executable, workers=1, timeout=1)
+    pid = pool.run([executable], "<svg/>").split()[0]
+    with pytest.raises(error):
+        pool.run([executable], svg)
+    assert pool.run([executable], "<svg/>").split()[0] != pid
+    assert pool.stats()["restarts"] == 1
+
+
+def test_executable_without_serve_mode_runs_once_per_conversion(tmp_path, executable, monkeypatch):
+    monkeypatch.setenv("FAKE_NO_SERVE", "1")
+    pool = ConverterPool(str(tmp_path), executable, workers=1)
+    assert pool.run([executable], "<svg/>") == "once <svg/>"
+    assert pool.run([executable], "<svg/>") == "once <svg/>"
+    assert pool.stats()["mode"] == "process"
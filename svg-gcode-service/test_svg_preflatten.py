@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pytest
+
+from svg_preflatten import MAX_VISITED, PreflattenError, flatten_path, preflatten_svg, simplify
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 100 100">{}</svg>'
+
+
+def test_use_is_expanded_with_its_offset():
+    output, report = preflatten_svg(SVG.format('<defs><rect id="r" width="10" height="10"/></defs>'
+                                               '<use href="#r" x="20" y="30"/>'), 0.1)
+    assert report["shapes"] == 1
+    assert "M20.00,30.00 L30.00,30.00" in output
+
+
+def test_recursive_use_is_skipped():
+    # Two groups using each other twice would expand 2^50 times with only the depth limit
+    svg = SVG.format('<g id="a"><use href="#b"/><use href="#b"/><rect width="1" height="1"/></g>'
+                     '<g id="b"><use xlink:href="#a"/><use href="#a"/></g>'
+                     '<g id="c"><use href="#c"/></g>')
+    started = time.perf_counter()
+    output, report = preflatten_svg(svg, 0.1)
+    assert time.perf_counter() - started < 1
+    assert report["shapes"] == 3
+    assert report["skipped_unsupported"] > 0
+
+
+def test_exponential_use_is_rejected():
+    # No cycle, but every level uses the next one twice
+    levels = "".join(f'<g id="l{i}"><use href="#l{i + 1}"/><use href="#l{i + 1}"/></g>' for i in range(40))
+    svg = SVG.format(f'<defs>{levels}<rect id="l40" width="1" height="1"/></defs><use href="#l0"/>')
+    with pytest.raises(PreflattenError, match=str(MAX_VISITED)):
+        preflatten_svg(svg, 0.1)
+
+
+def test_hidden_and_outside_elements_are_dropped():
+    output, report = preflatten_svg(SVG.format('<rect width="10" height="10" style="display:none"/>'
+                                               '<rect x="200" y="200" width="10" height="10"/>'
+                                               '<circle cx="50" cy="50" r="10"/>'), 0.1)
+    assert report["polylines"] == 1
+    assert report["dropped_outside_view_box"] == 1
+
+
+def test_flattened_curve_stays_within_tolerance():
+    tolerance = 0.05
+    [points] = flatten_path("M0,0 A50,50 0 0 1 100,0", tolerance)
+    # A chord between two points is farthest from the arc at its middle
+    middles = (points[1:] + points[:-1]) / 2
+    assert np.all(np.abs(np.linalg.norm(points - [50, 0], axis=1) - 50) < 1e-9)
+    assert np.all(50 - np.linalg.norm(middles - [50, 0], axis=1) <= tolerance)
+
+
+def test_simplify_keeps_endpoints_and_corners():
+    line = np.array([[0, 0], [1, 0.001], [2, 0], [2, 5], [2.001, 10]])
+    simplified = simplify(line, 0.01)
+    assert simplified[0].tolist() == [0, 0]
+    assert simplified[-1].tolist() == [2.001, 10]
+    assert [2, 0] in simplified.tolist()
+    assert len(simplified) < len(line)
@@ -1,17 +1,177 @@
 import os
-import subprocess
+import sys
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from text2gcode.romans import FONT, GLYPH_METRICS_PATH, load_glyph_metrics
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.batch import batch_response
+from common.configuration import ConfigError, is_number, watch_config
+from common.gcode_binary import MIMETYPE, encode
+from common.gcode_optimizer import optimize_for_config
+from common.gcode_cache import GcodeCache
+from common.gcode_lexer import iter_commands, format_command
+from common.gcode_simulator import MachineLimits
+from common import metrics
+from common.serving import run, ready_response
 
 app = Flask(__name__)
 
-CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "config.json"))
-with open(CONFIG_PATH, 'r') as config_file:
-    config = json.load(config_file)
+# config.json, validated once and replaced as a whole when the file changes
+config_watcher = watch_config()
+config = config_watcher.current
+
+
+#Font sizes from largest to smallest as (size, lineScale), checked once per version of fontSizes.json
+def load_font_sizes(path):
+    try:
+        with open(path, 'r') as font_data_file:
+            font_data = json.load(font_data_file)
+        sizes = tuple(sorted(((size, font_data[size]["lineScale"]) for size in font_data),
+                             key=lambda entry: float(entry[0]), reverse=True))
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}") from None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ConfigError(f"{path} must map font sizes to objects with a numeric lineScale: {e!r}") from None
+    if not sizes or not all(is_number(line_scale) and line_scale > 0 for _, line_scale in sizes):
+        raise ConfigError(f"{path} must map font sizes to objects with a positive lineScale")
+    return sizes
+
 
 FONT_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "text2gcode", "fontSizes.json")
-with open(FONT_DATA_PATH, 'r') as font_data_file:
-    font_data = json.load(font_data_file)
+font_sizes_watcher = watch_config(FONT_DATA_PATH, load=load_font_sizes, default=())
+
+# Advance widths and bounding boxes of every glyph, cached in text2gcode/glyphMetrics.json
+glyph_metrics = load_glyph_metrics(GLYPH_METRICS_PATH)
+
+# Repeated texts are served from the cache, it is emptied whenever the layout's cache_params change
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+gcode_cache = GcodeCache(
+    CACHE_DIR,
+    memory_items=config.get('cache_memory_items', 256),
+    disk_bytes=config.get('cache_disk_bytes', 64 * 1024 * 1024)
+)
+
+# Distance of the text to the coaster edges and to the logo area, in mm
+TEXT_MARGIN = 5
+
+
+#Where and how texts are drawn on the coaster, computed once per version of config.json and fontSizes.json.
+#None until the calibration and the font sizes are valid
+def compute_layout(config, font_sizes):
+    if not config.calibrated or not font_sizes:
+        return None
+    coaster_width = config['upper_right_corner_x'] - config['lower_left_corner_x']
+    coaster_height = config['upper_right_corner_y'] - config['lower_left_corner_y']
+    return {
+        "font_sizes": font_sizes,
+        "available_width": coaster_width - 2 * TEXT_MARGIN,
+        # The baseline sits TEXT_MARGIN above the lower edge, the logo area starts at a quarter of the height
+        "available_ascent": coaster_height / 4 - TEXT_MARGIN,
+        "available_descent": TEXT_MARGIN,
+        "mid_x": (config['lower_left_corner_x'] + config['upper_right_corner_x']) / 2,
+        "offset_y": config['lower_left_corner_y'] + TEXT_MARGIN,
+        # The font's pen heights are swapped for the configured ones
+        "z_heights": {'-72.685': str(config["z_drawing_height"]), '-70': str(config["z_safe_height"])},
+        "feedrate": str(config['feedrate']),
+        "cache_params": {"config": config.calibration(), "font_sizes": font_sizes}
+    }
+
+
+text_layout = compute_layout(config, font_sizes_watcher.current)
+
+
+#A recalibration or new font sizes apply from the next conversion on, without a restart
+@config_watcher.subscribe
+@font_sizes_watcher.subscribe
+def config_changed(old, new):
+    global text_layout, machine_limits
+    previous = text_layout
+    text_layout = compute_layout(config_watcher.current, font_sizes_watcher.current)
+    machine_limits = MachineLimits.from_config(config_watcher.current)
+    if previous is None or text_layout is None or previous["cache_params"] != text_layout["cache_params"]:
+        app.logger.warning("Text layout changed, emptying the G-code cache")
+        gcode_cache.invalidate()
+
+
+#Cache lookups by result, read by /metrics on every scrape
+def cache_lookups():
+    stats = gcode_cache.stats()
+    return {"memory_hit": stats["memory_hits"], "disk_hit": stats["disk_hits"], "miss": stats["misses"]}
+
+
+# Prometheus metrics at /metrics, "metrics_enabled": false turns them and the tracing off
+metrics.install(app, "text-gcode-service", enabled=config.get('metrics_enabled', True))
+TEXT2GCODE_SECONDS = metrics.histogram("text2gcode_seconds", "Time to lay out and render one text")
+metrics.collector("gcode_cache_lookups_total", "G-code cache lookups by result", cache_lookups,
+                  labels=("result",), kind="counter")
+metrics.collector("gcode_cache_hit_ratio", "Share of G-code cache lookups that were hits",
+                  lambda: gcode_cache.stats()["hit_rate"], aggregate="mean")
+
+# Plotter limits for the time estimate in binary jobs
+machine_limits = MachineLimits.from_config(config)
+
+# Largest number of texts accepted by /text2gcode/batch
+BATCH_MAX_ITEMS = config.get('batch_max_items', 500)
+
+
+#Pick the largest font size whose text fits the lower quarter of the coaster,
+#a text that does not fit even in the smallest one is still drawn in it, reaching past the edge
+def choose_font_size(text, layout=None):
+    layout = layout or text_layout
+    for size, lineScale in layout["font_sizes"]:
+        min_x, max_x, min_y, max_y = glyph_metrics.line_extent(text, lineScale)
+        if (max_x <= layout["available_width"] and max_y <= layout["available_ascent"]
+                and -min_y <= layout["available_descent"]):
+            return size, lineScale
+    app.logger.warning("Text %r does not fit the coaster even in the smallest font size", text)
+    return layout["font_sizes"][-1]
+
+#Convert a line of text to G-code, reusing the result of an identical earlier conversion
+def convert_text(text):
+    # One layout for the key and the conversion, even if config.json is replaced meanwhile
+    layout = text_layout
+    if layout is None:
+        raise ConfigError("Configuration file is missing or invalid.")
+    key = GcodeCache.key("text", text, layout["cache_params"])
+    gcode = gcode_cache.get(key)
+    if gcode is None:
+        with TEXT2GCODE_SECONDS.time():
+            gcode = generate_text_gcode(text, layout)
+        gcode_cache.put(key, gcode)
+    return gcode
+
+
+#Lay out the text centered in the lower quarter of the coaster and render it to G-code
+def generate_text_gcode(text, layout=None):
+    layout = layout or text_layout
+    fontSize, lineScale = choose_font_size(text, layout)
+
+    # Measure the line from the glyph table and render the strokes once with the final offset
+    line = text  
+    maximumX = glyph_metrics.max_x(line, lineScale)
+    if maximumX == float('-inf'):
+        raise ValueError("Text contains no drawable characters.")
+    offsetX = layout["mid_x"] - (maximumX / 2)  
+    offsetY = layout["offset_y"]
+    gcode_for_line = FONT.gcode_paths(FONT.get_string(line, lineScale), offsetX, offsetY)
+    gcode_output = gcode_for_line + "\n"
+
+    # Swap the font's pen heights for the configured ones and add the feedrate to drawing moves
+    z_heights = layout["z_heights"]
+    processed_gcode = ["G90", "G21"]
+    for words in iter_commands(gcode_output):
+        if ("G", "21") in words:
+            continue
+        words = [(letter, z_heights.get(value, value)) if letter == "Z" else (letter, value) for letter, value in words]
+        if ("G", "1") in words:
+            words.append(("F", layout["feedrate"]))
+        processed_gcode.append(format_command(words))
+    processed_gcode.append("G0 Z-30")
+    processed_gcode.append("M2")
+
+    return " ".join(processed_gcode)
+
 
 @app.route('/text2gcode', methods=['POST'])
 def text_to_gcode():
@@ -22,80 +182,54 @@ def text_to_gcode():
     if not text:
         return jsonify({"status": "error", "message": "Text is required."}), 400
 
-    # Calculate font size based on text length
-    text_length = len(text)
-    if text_length <= 5:
-        fontSize = 16
-    elif text_length == 6:
-        fontSize = 12
-    elif text_length == 7:
-        fontSize = 11
-    elif text_length == 8:
-        fontSize = 10
-    elif text_length == 9:
-        fontSize = 9
-    else:
-        fontSize = 8
-
-    if str(fontSize) in font_data:
-        font_settings = font_data[str(fontSize)]
-
-        lineScale = font_settings["lineScale"]
-    else:
-        return jsonify({"status": "error", "message": f"Font size {fontSize} not found"}), 400
-
-    def generate_gcode(line_text, offset_x, offset_y, scale, angle=0):
-        text2gcode_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "text2gcode")
-        command = ["java", "-cp", os.path.dirname(os.path.abspath(__file__)), "text2gcode.Romans", line_text, str(offset_x), str(offset_y), str(scale), str(angle)]
-        
-        result = subprocess.run(command, capture_output=True, text=True, cwd=text2gcode_folder)
-        
-        if result.returncode == 0:
-            return result.stdout
-        else:
-            raise Exception(f"Error generating G-code: {result.stderr}")
-
-    def get_maximum_x_for_line(lineText):
-        gcode = generate_gcode(lineText, 0, 0, lineScale)
-        max_x = float('-inf')
-        for line in gcode.splitlines():
-            if "X" in line:
-                parts = line.split()
-                for part in parts:
-                    if part.startswith("X"):
-                        x = float(part[1:])
-                        max_x = max(max_x, x)
-        return max_x
+    if text_layout is None:
+        return jsonify({"status": "error", "message": "Configuration file is missing or invalid."}), 500
 
-    line = text  
     try:
-        maximumX = get_maximum_x_for_line(line)
-        mid_x = (config['lower_left_corner_x'] + config['upper_right_corner_x']) / 2
-        offsetX = mid_x - (maximumX / 2)  
-        offsetY = config['lower_left_corner_y'] + 5 
-        gcode_for_line = generate_gcode(line, offsetX, offsetY, lineScale)
-        gcode_output = gcode_for_line + "\n"
+        gcode = convert_text(text)
+        if request.accept_mimetypes.best == MIMETYPE:
+            # The compact binary job grbl-service accepts as well, instead of the G-code in JSON. It is
+            # optimized here, grbl-service streams binary jobs as they are
+            gcode, report = optimize_for_config(gcode, config_watcher.current, machine_limits)
+            return Response(encode(gcode, machine_limits, optimized=report is not None), mimetype=MIMETYPE)
+        return jsonify({"status": "success", "gcode": gcode}), 200
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": f"Failed to generate G-code for the text: {e}"}), 500
 
-    # Post-process the G-code
-    processed_gcode = []
-    for line in gcode_output.splitlines():
-        if "G21" in line:
-            continue
-        line = line.replace('Z-72.685', f'Z{config["z_drawing_height"]}')
-        line = line.replace('Z-70', f'Z{config["z_safe_height"]}')
-        if "G1" in line:
-            line += f" F{config['feedrate']}"
-        processed_gcode.append(line)
-
-    processed_gcode.insert(0, "G90")
-    processed_gcode.insert(1, "G21")
-    processed_gcode.append("G0 Z-30")
-    processed_gcode.append("M2")
 
-    return jsonify({"status": "success", "gcode": " ".join(processed_gcode)}), 200
+@app.route('/text2gcode/batch', methods=['POST'])
+#Convert a list of texts in one request, sharing the loaded font, glyph table and cache
+def text_to_gcode_batch():
+    data = request.get_json(silent=True) or {}
+    texts = data.get('texts')
+    if not isinstance(texts, list) or not texts:
+        return jsonify({"status": "error", "message": "A non-empty list of texts is required."}), 400
+    if len(texts) > BATCH_MAX_ITEMS:
+        return jsonify({"status": "error", "message": f"At most {BATCH_MAX_ITEMS} texts per batch."}), 413
+    if text_layout is None:
+        return jsonify({"status": "error", "message": "Configuration file is missing or invalid."}), 500
+
+    def convert_item(text):
+        if not isinstance(text, str) or not text:
+            raise ValueError("Text is required.")
+        return convert_text(text)
+
+    # Conversions are pure Python and take milliseconds, more threads would only contend for the GIL
+    return batch_response(texts, convert_item, workers=1)
+
+
+@app.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    return jsonify(gcode_cache.stats()), 200
+
+
+@app.route('/ready', methods=['GET'])
+#Ready with a valid config.json and fontSizes.json, unless the service is shutting down
+def ready():
+    return ready_response(config=text_layout is not None)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5002)
+    run(app, "text-gcode-service", 5002)
@@ -0,0 +1,96 @@
+import argparse
+import difflib
+import json
+import os
+import subprocess
+import sys
+
+# Checks that romans.py renders byte for byte the G-code of the Java reference.
+#
+#   python text2gcode/check_romans.py                 compare with romansGolden.json
+#   python text2gcode/check_romans.py --regenerate    run `java text2gcode.Romans` again for every case
+#
+# The golden outputs are the stdout of Romans.main, so the check needs no JVM;
+# regenerating them needs `java` on the PATH (or --java) and Romans.class.
+
+SERVICE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SERVICE_PATH)
+from text2gcode.romans import FONT
+
+GOLDEN_PATH = os.path.join(SERVICE_PATH, "text2gcode", "romansGolden.json")
+
+# Arguments of `java text2gcode.Romans "text" offsetX offsetY scale angle`, as strings like on the command line
+CASES = [
+    # Every glyph of the table once
+    ["".join(chr(code) for code in range(0x20, 0x80)), "0", "0", "1", "0"],
+    ["ÑÜáéíñóúü", "0", "0", "1", "0"],
+    # Glyphs defined twice in Romans.java, where the second definition wins: "18:" as width, "13,21," as point
+    ["4 7 A B", "0", "0", "1", "0"],
+    ["ABBA 1947", "31.5", "13", "0.37", "0"],
+    # Sizes and offsets the text service uses on the coaster
+    ["Hello World", "42.13", "23.0", "0.47", "0"],
+    ["Happy birthday, Anna!", "26.881", "22.5", "0.37", "0"],
+    ["Café Müller", "51.92437", "21.75", "0.52", "0"],
+    # Characters without a glyph advance nothing and draw nothing, space is 12 units wide
+    ["aäb\tc  d", "10", "10", "1", "0"],
+    ["", "0", "0", "1", "0"],
+    # Float.toString: scales that are not exact in binary, and the shortest digits that round back
+    ["0123456789", "0", "0", "0.1", "0"],
+    ["Float", "0.3", "0.7", "0.333333", "0"],
+    ["xyz", "-0.05", "-0.05", "0.0123", "0"],
+    # Float.toString switches to E notation below 10^-3 and from 10^7 on
+    ["i.", "0.0001", "0.0002", "0.00001", "0"],
+    ["W", "12345678", "9999999", "2", "0"],
+    # Negative zero: 0 * -1 + -0.0 keeps the sign, Java prints it as -0.0
+    ["._", "0", "-0", "-1", "0"],
+    # Rotation runs in double precision and is rounded to float per point
+    ["Rotate", "50", "50", "0.5", "0.5"],
+    ["Upside down", "0", "0", "1", "3.14159265"],
+    ["@&%$", "-20", "15", "0.75", "-1.2"],
+]
+
+
+def render(text, x, y, scale, angle):
+    return FONT.gcode_paths(FONT.rotate(FONT.get_string(text, float(scale)), float(angle)), float(x), float(y))
+
+
+def regenerate(java):
+    cases = []
+    for args in CASES:
+        # The JVM decodes its arguments and encodes its output with the locale's charset
+        result = subprocess.run([java, "-cp", SERVICE_PATH, "text2gcode.Romans", *args],
+                                capture_output=True, encoding="utf-8", check=True,
+                                env=dict(os.environ, LC_ALL="C.UTF-8"))
+        cases.append({"args": args, "gcode": result.stdout})
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as golden_file:
+        json.dump(cases, golden_file, indent=4, ensure_ascii=False)
+        golden_file.write("\n")
+    print(f"{len(cases)} outputs of the Java reference stored in {GOLDEN_PATH}")
+
+
+def check():
+    with open(GOLDEN_PATH, "r", encoding="utf-8") as golden_file:
+        cases = json.load(golden_file)
+    failed = 0
+    for case in cases:
+        gcode = render(*case["args"])
+        if gcode != case["gcode"]:
+            failed += 1
+            print(f"MISMATCH for {case['args']!r}:", file=sys.stderr)
+            sys.stderr.writelines(difflib.unified_diff(case["gcode"].splitlines(True), gcode.splitlines(True),
+                                                       "java", "romans.py", n=1))
+    if failed:
+        print(f"{failed} of {len(cases)} cases differ from the Java reference", file=sys.stderr)
+        sys.exit(1)
+    print(f"All {len(cases)} cases are identical to the Java reference")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare romans.py with the G-code of Romans.java")
+    parser.add_argument("--regenerate", action="store_true", help="store the current output of the Java reference")
+    parser.add_argument("--java", default="java", help="java executable used by --regenerate")
+    arguments = parser.parse_args()
+    if arguments.regenerate:
+        regenerate(arguments.java)
+    else:
+        check()
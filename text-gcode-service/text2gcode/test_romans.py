@@ -0,0 +1,13 @@
+import json
+
+import pytest
+
+from check_romans import GOLDEN_PATH, render
+
+with open(GOLDEN_PATH, "r", encoding="utf-8") as golden_file:
+    CASES = json.load(golden_file)
+
+
+@pytest.mark.parametrize("case", CASES, ids=[repr(case["args"])[:40] for case in CASES])
+def test_gcode_is_identical_to_the_java_reference(case):
+    assert render(*case["args"]) == case["gcode"]